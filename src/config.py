@@ -30,6 +30,9 @@ DEBUG_MP = 0
 DEBUG_NEUROGLANCER = 0
 VERBOSE_SWIM = 0
 LOG_RECIPE_TO_FILE = 0
+LOG_MAX_BYTES = 10 * 1024 ** 2  # size at which a project log is rotated
+LOG_BACKUPS = 3  # rotated project logs kept
+LOG_HOT_PATH_QUIET = True  # skip per-ingredient progress messages (logpipe.HOTPATH) in alignment workers
 # TACC_MAX_CPUS = 58 # x3 is > 304
 # TACC_MAX_CPUS = 90 # x3 is > 304
 # QTWEBENGINE_RASTER_THREADS = 1024
@@ -37,6 +40,46 @@ LOG_RECIPE_TO_FILE = 0
 QTWEBENGINE_RASTER_THREADS = 512
 TARGET_THUMBNAIL_SIZE = 256
 USE_POOL_FOR_SWIM = True
+USE_POOL_SERVICE = True  # keep one warm worker pool for all stages instead of a new pool per stage
+ADAPTIVE_CONCURRENCY = True  # adjust tasks in flight to the memory pool workers use while a stage runs
+MEMORY_HIGH_WATER = 0.85  # fraction of RAM in use above which fewer tasks are handed out
+MEMORY_LOW_WATER = 0.70  # fraction of RAM in use below which more tasks may be handed out
+MEMORY_SAMPLE_SECONDS = 1.0  # interval between samples of worker memory
+MEMORY_MODEL = True  # size pools from the peak RSS measured for past tasks on this machine
+MEMORY_MODEL_FILE = '.swift_memory.json'  # per-host measurements, in the user's home directory
+MEMORY_MODEL_SAMPLES = 500  # most recent tasks per stage the model is fitted to
+MEMORY_MODEL_MIN_SAMPLES = 8  # tasks measured before the model replaces the heuristic estimate
+SCHEDULE_BY_COST = True  # dispatch alignment tasks costliest first, from past timings and window sizes
+RETRY_COST_FACTOR = 2.0  # cost multiplier of sections whose previous alignment failed
+RUNS_PER_WORKER = 4  # contiguous runs of sections per worker when neighbours are reused
+DISPATCH_QUEUE_DIR = None  # shared directory of a task queue served by agents on other nodes (see dispatch.py)
+DISPATCH_LOCAL_AGENTS = 0  # agents to start on this machine for the queue, e.g. to test without other nodes
+DISPATCH_POLL_SECONDS = 0.5  # interval at which the queue is checked for results and tasks
+DISPATCH_AGENT_TIMEOUT = 60  # seconds without a heartbeat before an agent's tasks are re-queued
+CANCEL_TIMEOUT = 5.0  # seconds cancelled workers and their subprocesses get to exit before they are killed
+CHECKPOINT_EVERY = 50  # alignment results ingested between checkpoints (cache pickle + project save)
+CHECKPOINT_SECONDS = 300  # longest time between checkpoints during an alignment run
+PROJECT_JOURNAL = True  # autosaves append changed sections to <project>.journal instead of rewriting the project
+JOURNAL_COMPACT_RECORDS = 500  # journal records at which they are folded into the project file in the background
+JOURNAL_COMPACT_SECONDS = 600  # longest time an autosaved change stays in the journal only
+PROJECT_BINARY = False  # save projects as binary containers whose levels load on first access (see src/models/container.py)
+DEFAULT_SWIM_BACKEND = 'binary'  # 'binary' (C swim executable) or 'python' (in-process, see src/core/swimengine.py)
+MIR_ETHRESH = 0  # RMS error (px) above which the worst SWIM match is dropped when composing the affine, 0 disables
+MEMMAP_IMAGES = False  # memory-map uncompressed section TIFFs during alignment instead of decoding them
+ALIGN_CONTIGUOUS_RUNS = False  # align contiguous runs of sections per worker, reusing images/patch FFTs of neighbours
+USE_SWIM_COPROCESS = True  # keep one batch-mode swim process alive per pool worker and window size
+BINARY_TIMEOUT = 600  # seconds before a swim/mir/iscale2 request is abandoned
+SWIM_READ_ZARR_WINDOWS = False  # in-process SWIM reads only the raw Zarr chunks covering each window
+ZARR_WINDOW_HALO = 16  # px added around transformed (moving) windows read from Zarr
+ADAPTIVE_RECIPES = False  # stop SWIM-MIR refinement once consecutive passes agree, add passes if they don't
+RECIPE_AFM_TOLERANCE = 0.5  # px, largest change of the affine within the image for passes to agree
+RECIPE_SNR_TOLERANCE = 0.02  # largest relative change of mean SNR for passes to agree
+RECIPE_MAX_EXTRA_PASSES = 2  # SWIM-MIR passes added to sections that have not converged
+DEFER_THUMBNAILS = True  # render thumbnails/GIFs in a separate post-alignment pool instead of in each recipe
+THUMBNAIL_WORKERS = 2  # processes of the post-alignment thumbnail pool
+THUMBNAIL_NICE = 10  # niceness increment of the thumbnail pool's processes
+SWIM_IMAGE_STORE = True  # keep signals/matches in one chunked Zarr store per level instead of as TIFFs
+SWIM_STORE_INGREDIENTS = 8  # ingredients per section with room in the store
 # USE_EXTRA_THREADING = True
 # UI_UPDATE_TIMEOUT = 300 #ms
 # UI_UPDATE_TIMEOUT = 350  # ms
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+'''Run stage tasks on worker agents on other nodes.
+
+A DispatchService stands in for the PoolService of the align and generate
+stages. Their tasks (run_recipe, run_mir, convert_zarr_block, ...) are then
+executed by headless agents, possibly on other nodes, instead of on this
+machine. Coordinator and agents share a FileQueue, a directory on a file
+system that every node mounts (e.g. $SCRATCH on TACC):
+
+    pending/<job>-<n>               chunks of tasks waiting for an agent
+    claimed/<agent>~<job>-<n>       chunks being run (claimed by an atomic rename)
+    results/<job>-<n>               (ok, results or exception) of finished chunks
+    agents/<agent>                  heartbeat of each agent (mtime)
+    cancelled/<job>                 jobs whose results are no longer wanted
+
+Each agent runs its chunks on a local PoolService of `processes` workers.
+A chunk claimed by an agent that has stopped sending heartbeats for
+DISPATCH_AGENT_TIMEOUT seconds is put back into pending/.
+
+Start an agent per node from the repository directory, e.g. from a batch job:
+
+    srun -N 4 -n 4 python -m src.core.dispatch --queue $SCRATCH/alignem_queue
+
+and set DISPATCH_QUEUE_DIR to the same directory. With DISPATCH_LOCAL_AGENTS,
+the main window starts that many agents on this machine itself, so that the
+whole path can be run (and tested) on one Linux box.'''
+
+import argparse
+import logging
+import multiprocessing as mp
+import os
+import pickle
+import platform
+import signal
+import subprocess as sp
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+import src.config as cfg
+from src.core.poolservice import PoolService, _chunks, _run_chunk
+
+__all__ = ['FileQueue', 'DispatchService', 'run_agent']
+
+logger = logging.getLogger(__name__)
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+
+class FileQueue:
+
+    def __init__(self, root):
+        self.root = root
+        self._beats = {}  # agent -> (heartbeat mtime, time.time() here when it was first seen)
+        for d in ('pending', 'claimed', 'results', 'agents', 'cancelled'):
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    def _path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def _write(self, path, obj):
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def put(self, name, payload):
+        self._write(self._path('pending', name), payload)
+
+    def claim(self, agent):
+        '''(name, payload) of the first pending chunk this agent could claim, or None.'''
+        for name in sorted(n for n in os.listdir(self._path('pending')) if not n.endswith('.tmp')):
+            claimed = self._path('claimed', f'{agent}~{name}')
+            try:
+                os.rename(self._path('pending', name), claimed)
+            except FileNotFoundError:
+                continue  # Claimed by another agent first
+            with open(claimed, 'rb') as f:
+                return name, pickle.load(f)
+        return None
+
+    def finish(self, agent, name, out):
+        '''Store the outcome of a claimed chunk (unless its job was cancelled) and release it.'''
+        if not self.is_cancelled(name.split('-')[0]):
+            self._write(self._path('results', name), out)
+        self.release(agent, name, requeue=False)
+
+    def release(self, agent, name, requeue=True):
+        claimed = self._path('claimed', f'{agent}~{name}')
+        try:
+            if requeue:
+                os.rename(claimed, self._path('pending', name))
+            else:
+                os.remove(claimed)
+        except FileNotFoundError:
+            pass
+
+    def take_results(self, job):
+        '''Yield (name, outcome) of the finished chunks of job, removing them from the queue.'''
+        for name in sorted(os.listdir(self._path('results'))):
+            if name.startswith(job + '-') and not name.endswith('.tmp'):
+                path = self._path('results', name)
+                with open(path, 'rb') as f:
+                    out = pickle.load(f)
+                os.remove(path)
+                yield name, out
+
+    def cancel(self, job):
+        '''Withdraw the pending chunks of job and discard the results of its claimed ones.'''
+        open(self._path('cancelled', job), 'w').close()
+        for d in ('pending', 'results'):
+            for name in os.listdir(self._path(d)):
+                if name.startswith(job + '-'):
+                    try:
+                        os.remove(self._path(d, name))
+                    except FileNotFoundError:
+                        pass
+
+    def is_cancelled(self, job):
+        return os.path.exists(self._path('cancelled', job))
+
+    def heartbeat(self, agent):
+        p = self._path('agents', agent)
+        with open(p, 'a'):
+            os.utime(p)
+
+    def retire(self, agent):
+        try:
+            os.remove(self._path('agents', agent))
+        except FileNotFoundError:
+            pass
+
+    def agents(self, timeout):
+        '''Agents whose heartbeat changed within the last timeout seconds, by this machine's clock.
+        The mtimes are set by the file server's clock, so they are only compared with each other.'''
+        now = time.time()
+        beats, alive = {}, []
+        for name in os.listdir(self._path('agents')):
+            try:
+                mtime = os.path.getmtime(self._path('agents', name))
+            except FileNotFoundError:
+                continue
+            seen = self._beats.get(name)
+            beats[name] = seen if seen and seen[0] == mtime else (mtime, now)
+            if now - beats[name][1] < timeout:
+                alive.append(name)
+        self._beats = beats
+        return alive
+
+    def requeue_stale(self, timeout):
+        '''Put chunks claimed by agents without a recent heartbeat back into pending/.'''
+        alive = set(self.agents(timeout))
+        n = 0
+        for entry in os.listdir(self._path('claimed')):
+            agent, _, name = entry.partition('~')
+            if agent not in alive:
+                self.release(agent, name)
+                n += 1
+        if n:
+            logger.warning(f'Re-queued {n} chunks of agents that stopped responding')
+        return n
+
+
+class DispatchService:
+    '''Runs stream() through a FileQueue at root instead of a local pool (same interface as PoolService).'''
+
+    remote = True  # tasks may run on other nodes
+
+    def __init__(self, root, local_agents=0, processes=None, poll=None, agent_timeout=None):
+        self.queue = FileQueue(root)
+        self.poll = cfg.DISPATCH_POLL_SECONDS if poll is None else poll
+        self.agent_timeout = cfg.DISPATCH_AGENT_TIMEOUT if agent_timeout is None else agent_timeout
+        self.logs = self
+        self._cancel = threading.Event()
+        self._local = []
+        for _ in range(local_agents):
+            self._local.append(self.start_local_agent(processes))
+
+    def start_local_agent(self, processes=None):
+        '''Start an agent on this machine, as if it were another node.'''
+        cmd = [sys.executable, '-m', 'src.core.dispatch', '--queue', self.queue.root]
+        if processes:
+            cmd += ['--processes', str(processes)]
+        logger.info(f'Starting local agent: {" ".join(cmd)}')
+        return sp.Popen(cmd, cwd=_REPO_ROOT)
+
+    def set_logs_dir(self, logs_dir):
+        '''Agents write their own logs (see the --logs option of the agent).'''
+
+    def stream(self, func, tasks, processes=None, chunksize=1, governor=None):
+        '''Run func on each of tasks on the agents, yielding results in completion order.
+        processes and governor are up to the agents. A task's exception is raised here.'''
+        self._cancel.clear()
+        job = uuid.uuid4().hex[:12]
+        remaining = set()
+        for n, chunk in enumerate(_chunks(list(tasks), chunksize)):
+            name = f'{job}-{n:06d}'
+            self.queue.put(name, (func, chunk))
+            remaining.add(name)
+        logger.info(f'Dispatched {len(remaining)} chunks as job {job} to {self.queue.root}')
+        t_check, warned = time.time(), False
+        try:
+            while remaining and not self._cancel.is_set():
+                got = False
+                for name, (ok, r) in self.queue.take_results(job):
+                    if name not in remaining:
+                        continue  # Re-queued from an agent that looked stale, and finished by both
+                    remaining.discard(name)
+                    if not ok:
+                        raise r
+                    got = True
+                    yield from r
+                    if self._cancel.is_set():
+                        return
+                if time.time() - t_check > self.agent_timeout / 2:
+                    t_check = time.time()
+                    self.queue.requeue_stale(self.agent_timeout)
+                    if not self.queue.agents(self.agent_timeout) and not warned:
+                        warned = True
+                        logger.warning(f'No agents are serving {self.queue.root}. Start them with: '
+                                       f'python -m src.core.dispatch --queue {self.queue.root}')
+                if not got:
+                    time.sleep(self.poll)
+        finally:
+            # Withdraw what is left, and have agents discard the results of chunks still running twice
+            self.queue.cancel(job)
+
+    def cancel(self):
+        '''Stop waiting for the running stream(s); their pending chunks are withdrawn.'''
+        self._cancel.set()
+
+    def abort(self, timeout=None):
+        '''Cancel. Chunks already claimed finish on their agents, and their results are discarded.'''
+        self.cancel()
+
+    def shutdown(self):
+        for p in self._local:
+            p.terminate()
+        for p in self._local:
+            try:
+                p.wait(timeout=10)
+            except sp.TimeoutExpired:
+                p.kill()
+        self._local = []
+
+
+def run_agent(root, processes=None, logs_dir=None, idle_exit=None, poll=None):
+    '''Claim chunks from the FileQueue at root and run them on a local pool until stopped
+    (or until idle for idle_exit seconds).'''
+    queue = FileQueue(root)
+    agent = f'{platform.node()}-{os.getpid()}'
+    poll = cfg.DISPATCH_POLL_SECONDS if poll is None else poll
+    pool = PoolService(log_quiet=cfg.LOG_HOT_PATH_QUIET)
+    pool.resize(processes or max(mp.cpu_count() - 2, 1))
+    pool.logs.set_logs_dir(logs_dir)
+    logger.info(f'Agent {agent} serving {root} with {pool.size} workers')
+    running = {}
+    t_idle = t_beat = 0.0
+    try:
+        while True:
+            if time.time() - t_beat > cfg.DISPATCH_AGENT_TIMEOUT / 4:
+                t_beat = time.time()
+                queue.heartbeat(agent)
+            while len(running) < pool.size:
+                claimed = queue.claim(agent)
+                if claimed is None:
+                    break
+                name, (func, chunk) = claimed
+                running[name] = pool.submit(_run_chunk, func, chunk)
+            for name, ar in list(running.items()):
+                if ar.ready():
+                    try:
+                        out = (True, ar.get())
+                    except Exception as e:
+                        out = (False, _picklable(e))
+                    queue.finish(agent, name, out)
+                    del running[name]
+            if running or not t_idle:
+                t_idle = time.time()
+            elif idle_exit and time.time() - t_idle > idle_exit:
+                logger.info(f'Agent {agent} idle for {idle_exit}s, exiting')
+                break
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for name in running:
+            queue.release(agent, name)
+        queue.retire(agent)
+        pool.shutdown()
+
+
+def _picklable(e):
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return RuntimeError(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Headless agent running alignment tasks from a shared queue')
+    ap.add_argument('--queue', required=True, help='Queue directory shared with the coordinating process')
+    ap.add_argument('--processes', type=int, default=None, help='Worker processes (default: cores - 2)')
+    ap.add_argument('--logs', default=None, help='Directory for the worker logs of this agent')
+    ap.add_argument('--idle-exit', type=float, default=None, help='Exit after this many idle seconds')
+    args = ap.parse_args()
+    # Let finally release the claimed chunks when the agent is terminated
+    signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    run_agent(args.queue, processes=args.processes, logs_dir=args.logs, idle_exit=args.idle_exit)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+'''Runtime control of how many tasks of a stage run at once.
+
+compute_worker_count() sizes a stage once, before it starts, from an estimate
+of the memory a task needs. That estimate is either too cautious (cores idle)
+or, on stacks of mixed image and window sizes, too optimistic (the OOM killer
+ends the run). A MemoryGovernor is handed to PoolService.stream() instead. The
+pool is started with `ceiling` workers, and while the stage runs the governor
+samples the RSS of the pool workers together with their swim/mir/iscale2
+children and the memory left on the machine:
+
+  - above the high water mark (fraction of RAM in use), the number of tasks
+    allowed in flight drops by one per sample, so that no new task is handed
+    out until enough running ones have finished;
+  - below the low water mark, it rises by one if the largest worker seen so
+    far would still fit under the high water mark.
+
+Tasks already running are never interrupted.'''
+
+import logging
+import time
+
+import psutil
+
+import src.config as cfg
+
+__all__ = ['MemoryGovernor', 'stage_ceiling', 'for_stage']
+
+logger = logging.getLogger(__name__)
+
+
+def stage_ceiling(n_tasks, info, idle_bytes=250 * 1024 * 1024):
+    '''Most workers worth starting for a stage: one per core (as in compute_worker_count),
+    no more than there are tasks, and no more than fit in the available RAM while idle.'''
+    by_ram = int(psutil.virtual_memory().available * 0.70) // max(idle_bytes, 1)
+    return max(1, min(info['max_by_cpu'], n_tasks, by_ram), info['cpus'])
+
+
+def for_stage(pool, n_tasks, info):
+    '''Governor for a stage sized by compute_worker_count (info), starting at info['cpus'] workers,
+    or None if concurrency is fixed (ADAPTIVE_CONCURRENCY off, or no local PoolService).'''
+    if not hasattr(pool, 'worker_pids') or not cfg.ADAPTIVE_CONCURRENCY or n_tasks <= 1:
+        return None
+    return MemoryGovernor(start=info['cpus'], ceiling=stage_ceiling(n_tasks, info))
+
+
+class MemoryGovernor:
+
+    def __init__(self, start, ceiling, floor=1, high=None, low=None, interval=None):
+        self.ceiling = max(1, int(ceiling))
+        self.floor = max(1, min(int(floor), self.ceiling))
+        self.limit_ = max(self.floor, min(int(start), self.ceiling))
+        self.high = cfg.MEMORY_HIGH_WATER if high is None else high
+        self.low = cfg.MEMORY_LOW_WATER if low is None else low
+        self.interval = cfg.MEMORY_SAMPLE_SECONDS if interval is None else interval
+        self.peak_worker_rss = 0  # largest RSS of one worker and its children
+        self.peak_rss = 0  # largest RSS of all workers and their children
+        self.n_lowered = 0
+        self.n_raised = 0
+        self._pids = lambda: []
+        self._procs = {}
+        self._t_sample = 0.0
+
+    def attach(self, pids):
+        '''pids: callable returning the PIDs of the pool workers.'''
+        self._pids = pids
+        return self
+
+    def limit(self, in_flight=0):
+        '''Number of tasks allowed in flight, re-evaluated at most once per interval.'''
+        if time.time() - self._t_sample >= self.interval:
+            self.sample(in_flight)
+        return self.limit_
+
+    def sample(self, in_flight=0):
+        self._t_sample = time.time()
+        total, largest = self.worker_rss()
+        self.peak_rss = max(self.peak_rss, total)
+        self.peak_worker_rss = max(self.peak_worker_rss, largest)
+        vm = psutil.virtual_memory()
+        used = 1.0 - vm.available / vm.total
+        if used > self.high and self.limit_ > self.floor:
+            self.limit_ -= 1
+            self.n_lowered += 1
+            logger.info(f'Memory {used:.0%} in use (workers {total / 1024 ** 3:.1f} GB), '
+                        f'{in_flight} in flight: lowering concurrency to {self.limit_}')
+        elif used < self.low and self.limit_ < self.ceiling and in_flight >= self.limit_:
+            headroom = vm.total * self.high - (vm.total - vm.available)
+            if headroom > self.peak_worker_rss:
+                self.limit_ += 1
+                self.n_raised += 1
+                logger.info(f'Memory {used:.0%} in use, {headroom / 1024 ** 3:.1f} GB headroom: '
+                            f'raising concurrency to {self.limit_}')
+
+    def worker_rss(self):
+        '''(total, largest) RSS of the pool workers, each counted with its child processes.'''
+        total = largest = 0
+        procs = {}
+        for pid in self._pids():
+            try:
+                p = self._procs.get(pid) or psutil.Process(pid)
+                rss = p.memory_info().rss
+                for c in p.children(recursive=True):
+                    try:
+                        rss += c.memory_info().rss
+                    except (psutil.NoSuchProcess, psutil.AccessDenied):
+                        pass
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            procs[pid] = p
+            total += rss
+            largest = max(largest, rss)
+        self._procs = procs
+        return total, largest
+
+    def summary(self):
+        return (f'concurrency {self.limit_}/{self.ceiling} (lowered {self.n_lowered}x, raised {self.n_raised}x), '
+                f'peak {self.peak_rss / 1024 ** 3:.1f} GB workers, {self.peak_worker_rss / 1024 ** 2:.0f} MB/worker')
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+'''Per-stage memory model fitted to the measured peak RSS of past tasks.
+
+Pool workers are sized from the memory a task is expected to need.
+estimate_swim_memory() and the overheads of the scale and generate stages are
+hand-tuned guesses. With a recorder, imap_unordered() instead runs each task
+under a PeakSampler, which tracks the RSS of the worker together with its
+swim/mir/iscale2 children. The parent records the peak against the task's
+features (image pixels, largest SWIM window pixels) and its stage ('align',
+'scale', 'scale_zarr', 'generate', 'generate_zarr').
+
+For each stage, MemoryModel fits
+
+    peak = a + b * image_px + c * window_px
+
+by least squares to the last MEMORY_MODEL_SAMPLES samples of this machine.
+Predictions add two standard deviations of the residuals. Each sample also
+keeps what the model predicted for it before it was added, so error() reports
+the out-of-sample prediction error. Until a stage has MEMORY_MODEL_MIN_SAMPLES
+samples, predict() returns the heuristic it is given. Models are saved per
+host in ~/.swift_memory.json.'''
+
+import json
+import logging
+import os
+import platform
+import threading
+
+import numpy as np
+import psutil
+
+import src.config as cfg
+
+__all__ = ['MemoryModel', 'PeakSampler', 'StageRecorder', 'get_model', 'measured', 'predict', 'recorder']
+
+logger = logging.getLogger(__name__)
+
+_model = None
+
+
+def get_model():
+    '''The memory model of this machine, loaded once per process.'''
+    global _model
+    if _model is None:
+        _model = MemoryModel(os.path.join(os.path.expanduser('~'), cfg.MEMORY_MODEL_FILE))
+    return _model
+
+
+def predict(stage, image_px, window_px=0, default=None):
+    '''Bytes per worker for the largest task of a stage, default if MEMORY_MODEL is off or not yet fitted.'''
+    if not cfg.MEMORY_MODEL:
+        return default
+    return get_model().predict(stage, image_px, window_px, default=default)
+
+
+def recorder(stage, features):
+    '''StageRecorder for tasks with features [(image_px, window_px), ...], None if MEMORY_MODEL is off.'''
+    return StageRecorder(stage, features) if cfg.MEMORY_MODEL else None
+
+
+class PeakSampler:
+    '''Context manager polling the RSS of this process and its children; peak is the largest seen.'''
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._proc = psutil.Process()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, self.rss())
+            if self._stop.wait(self.interval):
+                return
+
+    def rss(self):
+        try:
+            rss = self._proc.memory_info().rss
+            for c in self._proc.children(recursive=True):
+                try:
+                    rss += c.memory_info().rss
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    pass
+            return rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return 0
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+
+
+def measured(task):
+    '''Pool task wrapper: task is (func, func's task, i). Returns (i, result, peak RSS).'''
+    func, t, i = task
+    with PeakSampler() as ps:
+        r = func(t)
+    return i, r, ps.peak
+
+
+class StageRecorder:
+    '''Records the peaks measured for the tasks of one stage. features[i] is (image_px, window_px) of task i.'''
+
+    def __init__(self, stage, features, model=None):
+        self.stage = stage
+        self.features = features
+        self.model = model or get_model()
+
+    def record(self, i, peak):
+        image_px, window_px = self.features[i]
+        self.model.record(self.stage, image_px, window_px, peak)
+
+    def done(self):
+        logger.info(f"Memory model '{self.stage}': {self.model.describe(self.stage)}")
+        self.model.save()
+
+
+class MemoryModel:
+
+    def __init__(self, path):
+        self.path = path
+        self.host = platform.node() or 'localhost'
+        self.samples = {}  # stage -> [[image_px, window_px, peak, predicted], ...]
+        self._fits = {}
+        self._lock = threading.Lock()
+        try:
+            if os.path.exists(path):
+                with open(path) as f:
+                    self.samples = json.load(f).get(self.host, {})
+        except:
+            logger.warning(f'Unable to read memory model {path}, starting a new one')
+
+    def record(self, stage, image_px, window_px, peak):
+        with self._lock:
+            predicted = self._predict_fit(stage, image_px, window_px)
+            s = self.samples.setdefault(stage, [])
+            s.append([int(image_px), int(window_px), int(peak), int(predicted) if predicted else 0])
+            del s[:-cfg.MEMORY_MODEL_SAMPLES]
+            self._fits.pop(stage, None)
+
+    def predict(self, stage, image_px, window_px=0, default=None):
+        '''Peak bytes per worker expected for a task of stage, or default while the model is not fitted.'''
+        with self._lock:
+            p = self._predict_fit(stage, image_px, window_px)
+        return default if p is None else p
+
+    def _predict_fit(self, stage, image_px, window_px):
+        fit = self._fit(stage)
+        if fit is None:
+            return None
+        coef, margin, floor = fit
+        return int(max(coef @ [1.0, image_px, window_px] + margin, floor))
+
+    def _fit(self, stage):
+        if stage in self._fits:
+            return self._fits[stage]
+        s = self.samples.get(stage, [])
+        fit = None
+        if len(s) >= cfg.MEMORY_MODEL_MIN_SAMPLES:
+            a = np.asarray(s, dtype='float64')
+            x = np.column_stack([np.ones(len(a)), a[:, 0], a[:, 1]])
+            coef = np.linalg.lstsq(x, a[:, 2], rcond=None)[0]
+            resid = a[:, 2] - x @ coef
+            fit = (coef, 2.0 * float(resid.std()), float(a[:, 2].min()))
+        self._fits[stage] = fit
+        return fit
+
+    def error(self, stage):
+        '''Out-of-sample error of the predictions made for recorded samples of stage:
+        n, mean relative error, and the largest under-prediction in bytes.'''
+        a = np.asarray([r for r in self.samples.get(stage, []) if r[3]], dtype='float64').reshape(-1, 4)
+        if not len(a):
+            return {'n': 0, 'mean_rel_error': None, 'max_under': None}
+        diff = a[:, 3] - a[:, 2]
+        return {'n': len(a), 'mean_rel_error': float(np.mean(np.abs(diff) / np.maximum(a[:, 2], 1))),
+                'max_under': float(max(0.0, -diff.min()))}
+
+    def describe(self, stage):
+        err = self.error(stage)
+        if not err['n']:
+            return f'{len(self.samples.get(stage, []))} samples, not fitted'
+        return (f"{len(self.samples[stage])} samples, prediction error {err['mean_rel_error']:.0%} "
+                f"(worst under-prediction {err['max_under'] / 1024 ** 2:.0f} MB)")
+
+    def save(self):
+        try:
+            data = {}
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    data = json.load(f)
+            with self._lock:
+                data[self.host] = self.samples
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except:
+            logger.warning(f'Unable to save memory model {self.path}')
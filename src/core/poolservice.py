@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+'''A warm process pool shared by the scale, align and generate stages.
+
+The main window owns one PoolService. Its worker processes are started once
+and kept between stages (and between scale levels), so each stage only pays
+for pickling its tasks, not for starting processes and importing NumPy,
+zarr and tensorstore again. On platforms using forkserver, those modules are
+also preloaded into the fork server, so workers start with them imported.
+
+Stages run their tasks with stream(). It yields results as they complete,
+keeps at most `processes` chunks in flight (so a stage limited by memory
+never runs more workers than it asked for), and stops handing out work once
+cancel() is called. abort() goes further: it terminates the workers together
+with the swim/mir/iscale2 processes they started, within a bounded time.
+Each worker leads its own process group for this. Given a MemoryGovernor (see memgovernor), the number of
+chunks in flight instead follows the memory the workers use as the stage runs. The pool only grows between stages, unless it is more
+than twice the size a stage asks for.
+
+imap_unordered() runs tasks on a PoolService if one is given, and on a
+throwaway pool otherwise, so that workers can be used with or without a
+main window.'''
+
+import logging
+import multiprocessing as mp
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+from src.utils import logpipe
+
+__all__ = ['PoolService', 'imap_unordered', 'get_context', 'kill_process_groups', 'process_group_init']
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRELOAD = ['numpy', 'zarr', 'tensorstore', 'tifffile', 'imageio.v3', 'src.core.recipemaker']
+
+_POLL = 0.25  # seconds between checks for cancellation while waiting for results
+
+
+def get_context():
+    if sys.platform == 'win32':
+        return mp.get_context('spawn')
+    return mp.get_context('forkserver')
+
+
+class PoolService:
+
+    def __init__(self, preload=DEFAULT_PRELOAD, log_quiet=True):
+        self.ctx = get_context()
+        if self.ctx.get_start_method() == 'forkserver' and preload:
+            # Only takes effect if the fork server has not been started yet
+            self.ctx.set_forkserver_preload(list(preload))
+        # Workers log to log_queue for as long as they live; the listener drains it into the
+        # logs of whichever project the current stage belongs to (see logpipe).
+        self.log_queue = self.ctx.Queue()
+        self.log_quiet = log_quiet
+        self.logs = logpipe.LogListener(None, queue=self.log_queue).start()
+        self.size = 0
+        self._pool = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    def resize(self, processes):
+        '''Make sure at least processes workers are up. A pool more than twice as large is shrunk.'''
+        processes = max(1, int(processes))
+        with self._lock:
+            if self._pool is not None and processes <= self.size <= 2 * processes:
+                return self
+            self._terminate()
+            logger.info(f'Starting {processes} pool workers...')
+            self._pool = self.ctx.Pool(processes=processes, initializer=process_group_init,
+                                       initargs=(logpipe.worker_init, (self.log_queue, self.log_quiet)))
+            self.size = processes
+        return self
+
+    def submit(self, func, *args, callback=None, error_callback=None):
+        if self._pool is None:
+            self.resize(mp.cpu_count())
+        return self._pool.apply_async(func, args, callback=callback, error_callback=error_callback)
+
+    def stream(self, func, tasks, processes=None, chunksize=1, governor=None):
+        '''Run func on each of tasks, yielding results in completion order. At most processes
+        chunks of chunksize tasks are in flight at once, or as many as governor allows.
+        chunksize may also be a list of the sizes of successive chunks (e.g. from scheduler.schedule),
+        each of which runs on one worker. A task's exception is raised here.'''
+        processes = max(1, int(processes or self.size or mp.cpu_count()))
+        if governor is not None:
+            self.resize(governor.ceiling)
+            governor.attach(self.worker_pids)
+        else:
+            self.resize(processes)
+        self._cancel.clear()
+        chunks = iter(_chunks(list(tasks), chunksize))
+        done = queue.Queue()
+
+        def feed():
+            chunk = next(chunks, None)
+            if chunk is None:
+                return False
+            self._pool.apply_async(_run_chunk, (func, chunk), callback=lambda r: done.put((True, r)),
+                                   error_callback=lambda e: done.put((False, e)))
+            return True
+
+        def limit():
+            return governor.limit(in_flight) if governor is not None else processes
+
+        in_flight = 0
+        while in_flight < limit() and feed():
+            in_flight += 1
+        while in_flight:
+            try:
+                ok, r = done.get(timeout=min(governor.interval, _POLL) if governor is not None else _POLL)
+            except queue.Empty:
+                if self._cancel.is_set():
+                    return
+                # Nothing finished; hand out more work if the governor found headroom
+                while not self._cancel.is_set() and in_flight < limit() and feed():
+                    in_flight += 1
+                continue
+            in_flight -= 1
+            if not ok:
+                raise r
+            while not self._cancel.is_set() and in_flight < limit() and feed():
+                in_flight += 1
+            yield from r
+            if self._cancel.is_set():
+                return
+
+    def worker_pids(self):
+        pool = self._pool
+        return [p.pid for p in getattr(pool, '_pool', [])] if pool is not None else []
+
+    def cancel(self):
+        '''Stop handing out the tasks of the running stream(s). Tasks in flight finish.'''
+        self._cancel.set()
+
+    def abort(self, timeout=5.0):
+        '''Cancel, and terminate the workers and their child processes (in flight tasks are lost).
+        The next stage starts a new pool.'''
+        self.cancel()
+        with self._lock:
+            self._terminate(timeout)
+
+    def shutdown(self):
+        with self._lock:
+            self._terminate()
+        self.logs.stop()
+        self.log_queue.close()
+
+    def _terminate(self, timeout=5.0):
+        if self._pool is not None:
+            pids = self.worker_pids()
+            self._pool.terminate()
+            self._pool.join()
+            kill_process_groups(pids, timeout)
+            self._pool = None
+            self.size = 0
+
+
+def process_group_init(initializer=None, initargs=()):
+    '''Pool initializer: lead a process group, so that the worker's subprocesses can be
+    terminated with it, then run initializer.'''
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def kill_process_groups(pids, timeout=5.0):
+    '''Terminate the process groups led by pids (what is left of them), killing those
+    still alive after timeout seconds. On Windows, the process trees of pids instead.'''
+    if not hasattr(os, 'killpg'):
+        import psutil
+        procs = []
+        for pid in pids:
+            try:
+                p = psutil.Process(pid)
+                procs += [p] + p.children(recursive=True)
+            except psutil.NoSuchProcess:
+                pass
+        for p in procs:
+            try:
+                p.terminate()
+            except psutil.NoSuchProcess:
+                pass
+        _, alive = psutil.wait_procs(procs, timeout=timeout)
+        for p in alive:
+            p.kill()
+        return
+    groups = set(_signal_groups(pids, signal.SIGTERM))
+    t0 = time.time()
+    while groups and time.time() - t0 < timeout:
+        time.sleep(0.05)
+        groups = set(_signal_groups(groups, 0))
+    if groups:
+        logger.warning(f'Killing {len(groups)} process groups still alive after {timeout}s')
+        list(_signal_groups(groups, signal.SIGKILL))
+
+
+def _signal_groups(pgids, sig):
+    '''Send sig to each group, yielding those that still have members.'''
+    for g in pgids:
+        try:
+            os.killpg(g, sig)
+            yield g
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def _chunks(tasks, chunksize):
+    if isinstance(chunksize, (list, tuple)):
+        out, i = [], 0
+        for n in chunksize:
+            out.append(tasks[i:i + n])
+            i += n
+        if i < len(tasks):
+            out.append(tasks[i:])
+        return [c for c in out if c]
+    return [tasks[i:i + chunksize] for i in range(0, len(tasks), max(1, chunksize))]
+
+
+def _run_chunk(func, chunk):
+    return [func(task) for task in chunk]
+
+
+def imap_unordered(func, tasks, processes, chunksize=1, service=None, initializer=None, initargs=(),
+                   governor=None, recorder=None):
+    '''Results of func over tasks in completion order, computed on service if given,
+    else on a pool of processes workers that lives as long as this generator.
+    governor only applies to a service; a throwaway pool always runs processes workers.
+    With a recorder (see memmodel), the peak RSS of each task is measured and recorded, unless the
+    service runs the tasks on other machines: the model is per machine.'''
+    if recorder is not None and not getattr(service, 'remote', False):
+        from src.core.memmodel import measured
+        results = imap_unordered(measured, [(func, t, i) for i, t in enumerate(tasks)], processes,
+                                 chunksize=chunksize, service=service, initializer=initializer,
+                                 initargs=initargs, governor=governor)
+        try:
+            for i, r, peak in results:
+                recorder.record(i, peak)
+                yield r
+        finally:
+            recorder.done()
+        return
+    if service is not None:
+        yield from service.stream(func, tasks, processes=processes, chunksize=chunksize, governor=governor)
+        return
+    if isinstance(chunksize, (list, tuple)):
+        # A plain pool only takes a fixed chunksize: use the mean of the scheduled ones
+        chunksize = max(1, round(len(tasks) / max(len(chunksize), 1)))
+    with get_context().Pool(processes=processes, initializer=process_group_init,
+                            initargs=(initializer, initargs)) as pool:
+        pids = [p.pid for p in pool._pool]
+        try:
+            yield from pool.imap_unordered(func, tasks, chunksize=chunksize)
+        finally:
+            # Closed early (e.g. cancelled): stop the workers and whatever they started
+            pool.terminate()
+            pool.join()
+            kill_process_groups(pids)
@@ -8,8 +8,8 @@ import logging
 import os
 import platform
 import re
-import subprocess as sp
 import sys
+import tempfile
 import time
 import traceback
 import warnings
@@ -20,6 +20,12 @@ import imageio.v3 as iio
 import numpy as np
 import psutil
 
+from src.core.swimengine import ResidentImages, SwimEngine, worker_engine, worker_windows, reset_worker, mir_compose, \
+    format_mir_affine
+from src.core.swimstore import SwimImageStore
+from src.utils.coprocess import run_swim, run_binary, shutdown as shutdown_coprocesses
+from src.utils import logpipe
+
 warnings.filterwarnings("ignore")
 
 # import libtiff
@@ -37,6 +43,7 @@ __all__ = ['run_recipe']
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
+RMlogger = logging.getLogger('recipemaker')
 # logger = logging.getLogger('alignEM')
 
 def applyAffine(afm, xy):
@@ -84,10 +91,37 @@ def cached(func):
     return wrapper
 
 
+_worker_stage = None  # stage of the last recipe run by this (pool worker) process
+_worker_scratch = None  # directory of this process for the images swim writes, see scratch_dir()
+
+
+def enter_stage(stage):
+    '''Pool workers outlive stages, and their images, patch FFTs, Zarr chunks and swim co-processes
+    are cached by file name. Images may be replaced under the same name between stages, so these
+    caches are dropped by the first recipe of each stage run by this worker.'''
+    global _worker_stage
+    if stage != _worker_stage:
+        _worker_stage = stage
+        reset_worker()
+        shutdown_coprocesses()
+
+
+def scratch_dir():
+    '''Directory of this process where the swim binary writes the signals and matches bound for the
+    level's store. They are read back and deleted right away, so they stay off the project's
+    filesystem: the directory is on tmpfs where there is one.'''
+    global _worker_scratch
+    if _worker_scratch is None or not os.path.isdir(_worker_scratch):
+        base = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        _worker_scratch = tempfile.mkdtemp(prefix=f'swim-{os.getpid()}-', dir=base)
+    return _worker_scratch
+
+
 def run_recipe(data):
     '''Assemble and execute an alignment recipe
     :param data: data for one pairwise alignment as Python dictionary.'''
 
+    enter_stage(data['glob_cfg'].get('stage'))
     recipe = align_recipe(data)
 
     if data['first_index']:
@@ -95,7 +129,7 @@ def run_recipe(data):
     else:
         recipe.assemble_recipe()
         rc = recipe.execute_recipe()   
-    if data['glob_cfg']['generate_thumbnails']:
+    if data['glob_cfg']['generate_thumbnails'] and not data['glob_cfg'].get('defer_thumbnails'):
         recipe.generate_thumbnail()
 
     try:
@@ -110,10 +144,149 @@ def run_recipe(data):
             'index': data['index'],
             'complete': False
         }
+    if recipe.swim_store:
+        recipe.write_swim_images(failed=not mr.get('complete'))
+    if not recipe.reuse_neighbours:
+        recipe.images.clear()
 
     return mr
 
 
+def generate_thumbnail(ss, afm, mir_c, images=None, timeout=None):
+    '''Render the transformed thumbnail of a section through afm with mir, and the GIF
+    that flickers between it and the reference thumbnail.'''
+    if images is None:
+        images = ResidentImages()
+    #Fix This is almost certainly the culprit for the mir errors
+    # return
+
+    ifp = ss['path_thumb_src']
+    ofd = ss['wd']
+    fn, ext = os.path.splitext(ss['name'])
+    ofp = os.path.join(ofd, fn + '.thumb' + ext)
+
+    # if ss['first_index']:
+    #     logger.debug(f"\n"
+    #                     f"{ifp}\n"
+    #                     f"{ofp}")
+
+    # if os.path.exists(ofp):
+    #     logger.info(f'Cache hit (transformed img, afm): {ofp}')
+    #     return
+    # os.makedirs(os.path.dirname(ofd), exist_ok=True)
+    # # Path(os.path.dirname(ofd)).mkdir(parents=True, exist_ok=True)
+
+    tn_scale = ss['thumbnail_scale_factor']
+    sf = int(ss['level'][1:]) / tn_scale #scale factor
+
+
+    # Todo add flag to force regenerate
+    os.makedirs(os.path.dirname(ofp), exist_ok=True)
+    # Path(os.path.dirname(ofp)).mkdir(parents=True, exist_ok=True)
+    afm = np.array(afm, dtype=np.float64)
+    afm[0][2] *= sf
+    afm[1][2] *= sf
+
+    border = 128  # Todo get exact median greyscale value
+
+    w, h = ss['img_size']
+    # rect = [0, 0, w * sf, h * sf]  # might need to swap w/h for Zarr
+    # rect = [0, 0, w * sf, h * sf]  # might need to swap w/h for Zarr
+    rect = [-20, -20, int(w * sf + 40), int(h * sf + 40)]  # might need to swap w/h for Zarr
+    p1 = applyAffine(afm, (0, 0))  # Transform Origin To Output Space
+    p2 = applyAffine(afm, (rect[0], rect[1]))  # Transform BB Lower Left To Output Space
+    offset_x, offset_y = p2 - p1  # Offset Is Difference of 'p2' and 'p1'
+    afm[0][2] = afm[0][2] + offset_x
+    afm[1][2] = afm[1][2] + offset_y
+
+    bb_x, bb_y = rect[2], rect[3]
+    afm = np.array([afm[0][0], afm[0][1], afm[0][2], afm[1][0], afm[1][1],
+                    afm[1][2]], dtype=np.float64).reshape((-1, 3))
+
+    if os.path.exists(ofp):
+        logger.info(f'Cache hit (transformed img, afm): {ofp}')
+        return
+    os.makedirs(os.path.dirname(ofd), exist_ok=True)
+    # Path(os.path.dirname(ofd)).mkdir(parents=True, exist_ok=True)
+
+    a = afm[0][0]
+    c = afm[0][1]
+    e = afm[0][2]
+    b = afm[1][0]
+    d = afm[1][1]
+    f = afm[1][2]
+    mir_script = \
+        'B %d %d 1\n' \
+        'Z %g\n' \
+        'F %s\n' \
+        'A %g %g %g %g %g %g\n' \
+        'RW %s\n' \
+        'E' % (bb_x, bb_y, border, ifp, a, c, e, b, d, f, ofp)
+    # print(f"\n{mir_script}\n")
+    out, err, rc = run_binary(mir_c, cmd_input=mir_script, timeout=timeout)
+    if rc == 1:
+        logger.critical("ERROR Return code = 1")
+
+
+    # return
+
+    pA = ss['path_thumb_transformed']
+    pB = ss['path_thumb_src_ref']
+    out = ss['path_gif']
+
+    try:
+        assert os.path.exists(pA)
+    except AssertionError:
+        print(f'\nError: Image not found: {pA}\n')
+        return
+    try:
+        assert os.path.exists(pB)
+    except AssertionError:
+        print(f'\nError: Image not found: {pB}\n')
+        return
+
+    # ERROR:src.core.recipemaker:
+    # Image not found: /Users/joelyancey/alignem_data/alignments/666/data/35/s4/7910856802294028582/R34CA1-BS12.136.thumb.tif
+    # print('writing gif...')
+    try:
+        _M = np.zeros(rect[2:][::-1]) # zeroth dimension corresponds to the window height (y)
+        _M.fill(128)
+
+        imA = images.get(pA, memmap=False)
+        # _imA[20:][20:] = imA
+        imB = images.get(pB, memmap=False)
+        #_M[20:rect[2]-20, 20:rect[3]-20] = imB
+        _M[20:rect[3]-20, 20:rect[2]-20] = imB #swap rect[2] and rect[3] here to match imB shape
+        iio.imwrite(pA, imA) # monkey patch - fixes metadata
+        iio.imwrite(pB, imB)  # monkey patch - fixes metadata
+        # iio.imwrite(out, [imA, imB], format='GIF', duration=1, loop=0)
+        iio.imwrite(out, [imA, _M], format='GIF', duration=1, loop=0)
+    except:
+        print_exception()
+    finally:
+        images.evict(pA)
+        images.evict(pB)
+
+
+def run_thumbnail(task):
+    '''Post-alignment stage: generate the thumbnail and GIF of one aligned section.
+    :param task: swim settings of the section (as passed to run_recipe) with its final 'afm'.'''
+    try:
+        generate_thumbnail(task, task['afm'], binary_path('mir'),
+                           timeout=task['glob_cfg'].get('binary_timeout'))
+    except:
+        print_exception(extra=f"Unable to generate thumbnail (Section #{task['index']})")
+    return task['index']
+
+
+def binary_path(name):
+    '''Platform-specific file_path to the C SWiFT-IR executable name.'''
+    slug = (('linux', 'darwin')[platform.system() == 'Darwin'], 'tacc')[
+        'tacc.utexas' in platform.node()]
+    p = os.path.dirname(os.path.split(os.path.realpath(__file__))[0])
+    return '%s/lib/bin_%s/%s' % (p, slug, name)
+
+
 class align_recipe:
 
     # def __init__(self, swim_settings, config):
@@ -142,33 +315,55 @@ class align_recipe:
         self.initial_rotation = float(self.ss['initial_rotation'])
         # self.afm = np.array([[1., 0., 0.], [0., 1., 0.]])
         # Configure platform-specific file_path to executables for C SWiFT-IR
-        slug = (('linux', 'darwin')[platform.system() == 'Darwin'], 'tacc')[
-            'tacc.utexas' in platform.node()]
-        p = os.path.dirname(os.path.split(os.path.realpath(__file__))[0])
-        self.swim_c = '%s/lib/bin_%s/swim' % (p, slug)
-        self.mir_c = '%s/lib/bin_%s/mir' % (p, slug)
-        self.iscale2_c = '%s/lib/bin_%s/iscale2' % (p, slug)
+        self.swim_c = binary_path('swim')
+        self.mir_c = binary_path('mir')
+        self.iscale2_c = binary_path('iscale2')
+        # 'binary' runs the C swim executable, 'python' matches windows in-process
+        self.swim_backend = self.config.get('swim_backend', 'binary')
+        # Images decoded at most once per recipe and shared by all ingredients and the thumbnail step.
+        # When aligning contiguous runs of sections, images and patch FFTs are kept by the worker
+        # process across recipes instead, since section i's moving image is section i+1's reference.
+        self.reuse_neighbours = self.config.get('reuse_neighbours', False)
+        if self.reuse_neighbours:
+            engine = worker_engine(memmap=self.config.get('memmap_images', False))
+            self.images = engine.images
+        else:
+            engine = None
+            self.images = ResidentImages(memmap=self.config.get('memmap_images', False))
+        if self.swim_backend == 'python':
+            self.swim_engine = engine or SwimEngine(self.images)
+            # Optionally cut SWIM windows from the raw Zarr chunks that cover them, not whole TIFFs
+            self.swim_engine.windows = None
+            if self.config.get('zarr_windows', False) and self.ss.get('path_zarr_raw'):
+                windows = worker_windows(self.ss['path_zarr_raw'], halo=self.config.get('window_halo', 0))
+                if windows:
+                    windows.register(self.path, self.index)
+                    windows.register(self.path_ref, self.ss.get('reference_index'))
+                    self.swim_engine.windows = windows
+        else:
+            self.swim_engine = None
 
         self.signals_dir = self.ss['dir_signals']
         self.matches_dir = self.ss['dir_matches']
         self.dir_tmp = self.ss['dir_tmp']
+        # Signals and matches kept in the level's chunked store rather than as files, see swimstore.py.
+        # They are collected per (ingredient, quadrant) and written once the recipe is done.
+        self.swim_store = self.ss.get('path_swim_store') if self.config.get('swim_store') else None
+        # Where swim writes the images it is asked to keep; the in-process engine writes none with the store
+        self.dir_swim_out = scratch_dir() if self.swim_store and not self.swim_engine else self.dir_tmp
+        self.kept_signals = {}
+        self.kept_matches = {}
 
 
     def configure_logging(self):
         MAlogger = logging.getLogger('MAlogger')
-        RMlogger = logging.getLogger('recipemaker')
-        Exceptlogger = logging.getLogger('exceptlogger')
         tnLogger = logging.getLogger('tnLogger')
 
         if self.config['log_recipe_to_file']:
-            Exceptlogger.addHandler(logging.FileHandler(os.path.join(self.config['file_path'],
-                                             'logs', 'exceptions.log')))
-            MAlogger.addHandler(logging.FileHandler(os.path.join(
-                self.config['file_path'], 'logs', 'manual_align.log')))
-            RMlogger.addHandler(logging.FileHandler(os.path.join(
-                self.config['file_path'], 'logs', 'recipemaker.log')))
-            tnLogger.addHandler(logging.FileHandler(os.path.join(
-                self.config['file_path'], 'logs', 'thumbnails.log')))
+            # Pool workers send their records to the parent's listener (see logpipe.worker_init),
+            # anything else writes the project logs directly. Either way, handlers are added once.
+            if not logpipe.has_handlers():
+                logpipe.attach_file_handlers(os.path.join(self.config['file_path'], 'logs'))
         else:
             MAlogger.disabled = True
             RMlogger.disabled = True
@@ -385,11 +580,12 @@ class align_recipe:
             logger.critical(f"\nExecuting recipe (# Ingredients: {len(self.ingredients)})...\n")
 
 
-        if self.ss['glob_cfg']['keep_signals']:
+        if self.ss['glob_cfg']['keep_signals'] and not self.swim_store:
             os.makedirs(self.signals_dir, exist_ok=True)
-        if self.ss['glob_cfg']['keep_matches']:
+        if self.ss['glob_cfg']['keep_matches'] and not self.swim_store:
             os.makedirs(self.matches_dir, exist_ok=True)
-        os.makedirs(self.dir_tmp, exist_ok=True)
+        if not self.swim_store:
+            os.makedirs(self.dir_tmp, exist_ok=True)
         # Path(os.path.dirname(self.signals_dir)).mkdir(parents=True, exist_ok=True)
         # Path(os.path.dirname(self.matches_dir)).mkdir(parents=True, exist_ok=True)
         # Path(os.path.dirname(self.dir_tmp)).mkdir(parents=True, exist_ok=True)
@@ -411,6 +607,8 @@ class align_recipe:
         # The ingredients are daisy-chained together with the afm of one ingredient being the input afm of the next
         # Also the final pmov of each ingredient is the input pmov of the next (if pmov of next is initialized to None) 
         if not self.ss['first_index']:
+            if self.config.get('adaptive_recipe', False):
+                return self.execute_adaptive()
             for i, ingredient in enumerate(self.ingredients):
                 try:
                     ingredient.afm = self.afm  # Initialize afm of ingredient with the current value of recipe afm
@@ -421,6 +619,68 @@ class align_recipe:
         return 0
 
 
+    def execute_adaptive(self):
+        '''Execute the ingredients like execute_recipe, but stop refining as soon as two consecutive
+        SWIM-MIR passes agree (the affine moves less than 'afm_tolerance' px anywhere in the image
+        and the mean SNR changes by less than a fraction 'snr_tolerance'), skipping the remaining
+        passes. Sections that have not converged by the final SWIM-SNR ingredient get up to
+        'max_extra_passes' more passes. Ingredients that were not executed are dropped.'''
+        max_extra = self.config.get('max_extra_passes', 0)
+        n_extra = 0
+        self.converged = False
+        i = 0
+        while i < len(self.ingredients):
+            ingredient = self.ingredients[i]
+            prev = self.ingredients[i - 1] if i else None
+            if ingredient.mode == 'SWIM-SNR' and prev is not None and prev.mode == 'SWIM-MIR' and \
+                    not self.converged and n_extra < max_extra:
+                n_extra += 1
+                extra = align_ingredient(recipe=self, mode='SWIM-MIR', ww=prev.ww, psta=prev.psta,
+                                         pmov=None, ID=f'{prev.ID}+{n_extra}')
+                self.ingredients.insert(i, extra)
+                self._renumber_ingredients()
+                continue
+            afm_prev, snr_prev = self.afm, self.snr
+            failed = False
+            try:
+                ingredient.afm = self.afm
+                self.afm, self.snr = ingredient.execute_ingredient()
+                failed = getattr(ingredient, 'swim_output', None) == ['']
+            except:
+                print_exception(extra=f'ERROR ing{i}/{len(self.ingredients)}')
+                failed = True
+            i += 1
+            if failed:
+                # An unchanged afm would look like convergence
+                self.converged = False
+            elif ingredient.mode == 'SWIM-MIR' and prev is not None and prev.mode == 'SWIM-MIR' and \
+                    np.shape(prev.psta) == np.shape(ingredient.psta):
+                self.converged = self._has_converged(afm_prev, snr_prev)
+                if self.converged:
+                    # Skip ahead to the ingredient that measures the final SNR
+                    while i < len(self.ingredients) and self.ingredients[i].mode == 'SWIM-MIR':
+                        del self.ingredients[i]
+                    self._renumber_ingredients()
+        logger.debug(f"[{self.index}] Used {len(self.ingredients)} ingredients "
+                     f"(converged: {self.converged}, extra passes: {n_extra})")
+        return 0
+
+
+    def _has_converged(self, afm_prev, snr_prev):
+        d = np.array(self.afm) - np.array(afm_prev)
+        # Largest displacement the change in affine causes within the image
+        half = max(self.ss['img_size']) / 2.0
+        shift = np.abs(d[:, 2]).max() + np.abs(d[:, 0:2]).sum(axis=1).max() * half
+        snr, snr_prev = np.mean(self.snr), np.mean(snr_prev)
+        plateau = abs(snr - snr_prev) <= self.config.get('snr_tolerance', 0.0) * max(abs(snr_prev), 1e-9)
+        return shift <= self.config.get('afm_tolerance', 0.0) and plateau
+
+
+    def _renumber_ingredients(self):
+        for idx, ingredient in enumerate(self.ingredients):
+            ingredient.idx = idx
+
+
     def set_results(self):
         # afm = np.array([[1., 0., 0.], [0., 1., 0.]])
         # snr = np.array([0.0])
@@ -431,6 +691,9 @@ class align_recipe:
         # mr['memory_mb'] = self.megabytes()
         # mr['memory_gb'] = self.gigabytes()
         mr['complete'] = self._return_afm
+        mr['n_ingredients'] = len(self.ingredients)
+        if hasattr(self, 'converged'):
+            mr['converged'] = self.converged
         # if hasattr(self,'ingredients') and self.ingredients:
         #     if self._return_afm: #NOTE: POSSIBLY CRITICAL
         # try:
@@ -527,119 +790,27 @@ class align_recipe:
         self.results = mr
         return mr
 
+    def write_swim_images(self, failed=False):
+        '''Replace the section's images in the level's store with the ones kept, or drop them if the
+        alignment failed.'''
+        try:
+            store = SwimImageStore(self.swim_store)
+            if failed:
+                store.clear(self.index)
+            else:
+                store.write_section(self.index, self.kept_signals, self.kept_matches, ss_hash=self.ss['ss_hash'])
+        except:
+            print_exception(extra=f"[{self.index}] Unable to write signals and matches to {self.swim_store}")
+        self.kept_signals, self.kept_matches = {}, {}
+
     def add_ingredients(self, ingredients):
         for idx, ingredient in enumerate(ingredients):
             ingredient.idx = idx
             self.ingredients.append(ingredient)
 
     def generate_thumbnail(self):
-        #Fix This is almost certainly the culprit for the mir errors
-        # return
-
-        ifp = self.ss['path_thumb_src']
-        ofd = self.ss['wd']
-        fn, ext = os.path.splitext(self.ss['name'])
-        ofp = os.path.join(ofd, fn + '.thumb' + ext)
-
-        # if self.ss['first_index']:
-        #     logger.debug(f"\n"
-        #                     f"{ifp}\n"
-        #                     f"{ofp}")
-
-        # if os.path.exists(ofp):
-        #     logger.info(f'Cache hit (transformed img, afm): {ofp}')
-        #     return
-        # os.makedirs(os.path.dirname(ofd), exist_ok=True)
-        # # Path(os.path.dirname(ofd)).mkdir(parents=True, exist_ok=True)
-
-        tn_scale = self.ss['thumbnail_scale_factor']
-        sf = int(self.ss['level'][1:]) / tn_scale #scale factor
-
-
-        # Todo add flag to force regenerate
-        os.makedirs(os.path.dirname(ofp), exist_ok=True)
-        # Path(os.path.dirname(ofp)).mkdir(parents=True, exist_ok=True)
-        afm = copy.deepcopy(self.afm)
-        afm[0][2] *= sf
-        afm[1][2] *= sf
-
-        border = 128  # Todo get exact median greyscale value
-
-        w, h = self.ss['img_size']
-        # rect = [0, 0, w * sf, h * sf]  # might need to swap w/h for Zarr
-        # rect = [0, 0, w * sf, h * sf]  # might need to swap w/h for Zarr
-        rect = [-20, -20, int(w * sf + 40), int(h * sf + 40)]  # might need to swap w/h for Zarr
-        p1 = applyAffine(afm, (0, 0))  # Transform Origin To Output Space
-        p2 = applyAffine(afm, (rect[0], rect[1]))  # Transform BB Lower Left To Output Space
-        offset_x, offset_y = p2 - p1  # Offset Is Difference of 'p2' and 'p1'
-        afm[0][2] = afm[0][2] + offset_x
-        afm[1][2] = afm[1][2] + offset_y
-
-        bb_x, bb_y = rect[2], rect[3]
-        afm = np.array([afm[0][0], afm[0][1], afm[0][2], afm[1][0], afm[1][1],
-                        afm[1][2]], dtype=np.float64).reshape((-1, 3))
-
-        if os.path.exists(ofp):
-            logger.info(f'Cache hit (transformed img, afm): {ofp}')
-            return
-        os.makedirs(os.path.dirname(ofd), exist_ok=True)
-        # Path(os.path.dirname(ofd)).mkdir(parents=True, exist_ok=True)
-
-        a = afm[0][0]
-        c = afm[0][1]
-        e = afm[0][2]
-        b = afm[1][0]
-        d = afm[1][1]
-        f = afm[1][2]
-        mir_script = \
-            'B %d %d 1\n' \
-            'Z %g\n' \
-            'F %s\n' \
-            'A %g %g %g %g %g %g\n' \
-            'RW %s\n' \
-            'E' % (bb_x, bb_y, border, ifp, a, c, e, b, d, f, ofp)
-        # print(f"\n{mir_script}\n")
-        out, err, rc = run_command(self.mir_c, arg_list=[], cmd_input=mir_script)
-        if rc == 1:
-            logger.critical("ERROR Return code = 1")
-
-
-        # return
-
-        pA = self.ss['path_thumb_transformed']
-        pB = self.ss['path_thumb_src_ref']
-        out = self.ss['path_gif']
-        time.sleep(.1)
-
-        try:
-            assert os.path.exists(pA)
-        except AssertionError:
-            print(f'\nError: Image not found: {pA}\n')
-            return
-        try:
-            assert os.path.exists(pB)
-        except AssertionError:
-            print(f'\nError: Image not found: {pB}\n')
-            return
-
-        # ERROR:src.core.recipemaker:
-        # Image not found: /Users/joelyancey/alignem_data/alignments/666/data/35/s4/7910856802294028582/R34CA1-BS12.136.thumb.tif
-        # print('writing gif...')
-        try:
-            _M = np.zeros(rect[2:][::-1]) # zeroth dimension corresponds to the window height (y)
-            _M.fill(128)
- 
-            imA = iio.imread(pA)
-            # _imA[20:][20:] = imA
-            imB = iio.imread(pB)
-            #_M[20:rect[2]-20, 20:rect[3]-20] = imB
-            _M[20:rect[3]-20, 20:rect[2]-20] = imB #swap rect[2] and rect[3] here to match imB shape
-            iio.imwrite(pA, imA) # monkey patch - fixes metadata
-            iio.imwrite(pB, imB)  # monkey patch - fixes metadata
-            # iio.imwrite(out, [imA, imB], format='GIF', duration=1, loop=0)
-            iio.imwrite(out, [imA, _M], format='GIF', duration=1, loop=0)
-        except:
-            print_exception()
+        generate_thumbnail(self.ss, self.afm, self.mir_c, images=self.images,
+                           timeout=self.config.get('binary_timeout'))
 
 
 class align_ingredient:
@@ -695,7 +866,7 @@ class align_ingredient:
 
     def execute_ingredient(self):
         if self.recipe.solo:
-            print('\nExecuting ingredient...\n')
+            logpipe.hot(RMlogger, 'Executing ingredient...')
         # Returns an affine matrix
         if self.recipe.method == 'manual':
             self.clr_indexes = copy.deepcopy(self.recipe.clr_indexes)
@@ -710,19 +881,22 @@ class align_ingredient:
             else:
                 self.ingest_swim_output(swim_output) #parse swim output and call mir with result.
 
+        if self.recipe.swim_store:
+            if self.mode != 'MIR' and not self.recipe.swim_engine:
+                self.collect_swim_images()
         # if this is the last ingredient in the recipe then check to keep signals and matches
-        if self.idx == self.recipe.ingredients[-1].idx:
-            if self.recipe.ss['glob_cfg']['keep_signals']:
+        elif self.idx == self.recipe.ingredients[-1].idx:
+            if self.recipe.ss['glob_cfg']['keep_signals'] and not self.recipe.swim_engine:
                 self.crop_match_signals() # crop central portion of signal images
             if self.recipe.ss['glob_cfg']['keep_matches']:
                 self.reduce_matches() # downscale size of match images
-        try:
-            np.set_printoptions(linewidth=np.inf)
-            np.set_printoptions(formatter={'float': lambda x: "{0:.15g}".format(x)})
-            ing_str = f"[{self.recipe.index}, {self.ID}] | SNR: {self.snr} | AFM: {self.afm}"
-            print(ing_str)
-        except:
-            print_exception()
+        if logpipe.hot_enabled(RMlogger):
+            try:
+                with np.printoptions(linewidth=np.inf, formatter={'float': lambda x: "{0:.15g}".format(x)}):
+                    ing_str = f"[{self.recipe.index}, {self.ID}] | SNR: {self.snr} | AFM: {self.afm}"
+                RMlogger.log(logpipe.HOTPATH, ing_str)
+            except:
+                print_exception()
         return copy.deepcopy(self.afm), copy.deepcopy(self.snr)
 
 
@@ -732,7 +906,7 @@ class align_ingredient:
         #       swim {832x832} -i 10 -w -0.65 -f3 -b /path/to/signals/file.tif /path/to/ref/image.tif 512 512 /path/to/moving/image.tif 512 512 afm[0,0] afm[0,1] afm[1,0] afm[1,1]        
 
         if self.recipe.solo:
-            print('\nGetting SWIM args...\n')
+            logpipe.hot(RMlogger, 'Getting SWIM args...')
 
         self.cx = int(self.recipe.ss['img_size'][0] / 2.0)
         self.cy = int(self.recipe.ss['img_size'][1] / 2.0)
@@ -741,6 +915,7 @@ class align_ingredient:
         fn, suffix = os.path.splitext(basename)
         multi_arg_str = ArgString(sep='\n')
         self.ms_paths = []
+        self.swim_windows = []  # (column, signal path, match paths, quadrant) per window
         m = self.recipe.method
         # iters = str(self.recipe.ss['iterations'])
         whiten = str(self.recipe.ss['whitening'])
@@ -778,8 +953,10 @@ class align_ingredient:
             else:
                 ind = i
             # correlation signals argument (output file_path)
-            b_arg = os.path.join(self.recipe.signals_dir, '%s_%s_%d%s' % (fn, m, ind, suffix))
+            b_dir = self.recipe.dir_swim_out if self.recipe.swim_store else self.recipe.signals_dir
+            b_arg = os.path.join(b_dir, '%s_%s_%d%s' % (fn, m, ind, suffix))
             self.ms_paths.append(b_arg)
+            match_paths = None
             args = ArgString(sep=' ')
             # arg for swim window size
             args.append("%dx%d" % (self.ww[0], self.ww[1]))
@@ -806,13 +983,15 @@ class align_ingredient:
                 # if this is the last ingredient in the recipe then check to keep signals and matches
                 if self.idx == self.recipe.ingredients[-1].idx:
                     k_arg_name = '%s_%s_k_%d%s' % (fn, m, ind, suffix)
-                    k_arg_path = os.path.join(self.recipe.dir_tmp, k_arg_name)
+                    k_arg_path = os.path.join(self.recipe.dir_swim_out, k_arg_name)
                     args.add_flag(flag='-k', arg=k_arg_path)
                     self.matches_filenames.append(k_arg_path)
                     t_arg_name = '%s_%s_t_%d%s' % (fn, m, ind, suffix)
-                    t_arg_path = os.path.join(self.recipe.dir_tmp, t_arg_name)
+                    t_arg_path = os.path.join(self.recipe.dir_swim_out, t_arg_name)
                     args.add_flag(flag='-t', arg=t_arg_path)
                     self.matches_filenames.append(t_arg_path)
+                    match_paths = (k_arg_path, t_arg_path)
+            self.swim_windows.append((i, b_arg, match_paths, ind))
             # args.append(self.recipe.ss['extra_kwargs'])
             # arg for ref image name, a.k.a. tgt image name
             args.append(self.recipe.path_ref)
@@ -852,27 +1031,86 @@ class align_ingredient:
 
 
     def run_swim(self):
+        if self.recipe.swim_engine:
+            return self.run_swim_inprocess()
         self.multi_swim_arg_str = self.get_swim_args()
 
         # if self.recipe.solo:
         #     print(f'\nSwimming...\n{self.multi_swim_arg_str()}\n')
-        logging.getLogger('recipemaker').debug(
-            f'Multi-SWIM Argument String:\n{self.multi_swim_arg_str()}')
-        print(f'Multi-SWIM Argument String:\n{self.multi_swim_arg_str()}')
+        if logpipe.hot_enabled(RMlogger):
+            RMlogger.log(logpipe.HOTPATH, f'Multi-SWIM Argument String:\n{self.multi_swim_arg_str()}')
         arg = "%dx%d" % (self.ww[0], self.ww[1])
         t0 = time.time()
-        out, err, rc = run_command(
-            self.recipe.swim_c,
-            arg_list=[arg],
-            cmd_input=self.multi_swim_arg_str(),
-            desc=f'SWIM alignment'
-        )
+        timeout = self.recipe.config.get('binary_timeout')
+        if self.recipe.config.get('swim_coprocess', False):
+            # Stream the commands through this worker's long-running swim for window size 'arg'
+            out, err, rc = run_swim(self.recipe.swim_c, arg, self.multi_swim_arg_str(), timeout=timeout)
+        else:
+            out, err, rc = run_binary(self.recipe.swim_c, [arg], cmd_input=self.multi_swim_arg_str(),
+                                      timeout=timeout)
         self.t_swim = time.time() - t0
         self.swim_output = out.strip().split('\n')
         self.swim_err_lines = err.strip().split('\n')
         return self.swim_output
 
 
+    def run_swim_inprocess(self):
+        '''Same as run_swim, but matches the windows with the in-process SWIM engine.'''
+        self.get_swim_args()
+        if self.recipe.ss['clobber']:
+            logger.warning(f"[{self.recipe.index}] Fixed-pattern noise clobber is only supported "
+                           f"by the swim binary and is ignored by the in-process backend")
+        cols = [w[0] for w in self.swim_windows]
+        store = self.recipe.swim_store
+        keep_signals = self.recipe.ss['glob_cfg']['keep_signals'] and \
+                       (store or self.idx == self.recipe.ingredients[-1].idx)
+        match_paths = [w[2] for w in self.swim_windows]
+        keep_matches = bool(match_paths) and all(match_paths)
+        signals, matches = [], []
+        t0 = time.time()
+        try:
+            self.swim_output = self.recipe.swim_engine.swim(
+                self.recipe.path_ref, self.psta[:, cols],
+                self.recipe.path, self.pmov[:, cols],
+                self.afm, self.ww,
+                iters=self.iters,
+                whiten=self.recipe.ss['whitening'],
+                signal_paths=[w[1] for w in self.swim_windows] if keep_signals and not store else None,
+                match_paths=match_paths if keep_matches and not store else None,
+                signals_out=signals if keep_signals and store else None,
+                matches_out=matches if keep_matches and store else None,
+            )
+            self.swim_err_lines = []
+            for w, img in zip(self.swim_windows, signals):
+                self.recipe.kept_signals[(self.idx, w[3])] = img
+            for w, pair in zip(self.swim_windows, matches):
+                self.recipe.kept_matches[(self.idx, w[3])] = pair
+        except:
+            print_exception(extra=f"[{self.recipe.index}] In-process SWIM failed")
+            self.swim_output = ['']
+            self.swim_err_lines = [traceback.format_exc()]
+        self.t_swim = time.time() - t0
+        return self.swim_output
+
+
+    def collect_swim_images(self):
+        '''Move the signal and match images written by the swim binary into the recipe's
+        kept images, to be cropped/reduced and written to the level's store.'''
+        for _, b_path, match_paths, q in self.swim_windows:
+            paths = [b_path] + list(match_paths or ())
+            try:
+                if os.path.exists(b_path):
+                    self.recipe.kept_signals[(self.idx, q)] = iio.imread(b_path)
+                if match_paths and all(os.path.exists(p) for p in match_paths):
+                    self.recipe.kept_matches[(self.idx, q)] = tuple(iio.imread(p) for p in match_paths)
+            except:
+                print_exception(extra=f"[{self.recipe.index}, {self.ID}] Unable to read SWIM images")
+            for p in paths:
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+
     def crop_match_signals(self):
         px_keep = 128
         # w, h = '%d' % self.ww[0], '%d' % self.ww[1]
@@ -898,10 +1136,10 @@ class align_ingredient:
             self.crop_str_mir = ' '.join(self.crop_str_args)
             # print(self.crop_str_mir)
             logger.debug(f'MIR crop string:\n{self.crop_str_mir}')
-            _ ,_ ,_ = run_command(
+            _ ,_ ,_ = run_binary(
                 self.recipe.mir_c,
                 cmd_input=self.crop_str_mir,
-                desc=f'Crop match signals'
+                timeout=self.recipe.config.get('binary_timeout'),
             )
             # print(f"out:\n{out}")
             # print(f"err:\n{err}")
@@ -946,6 +1184,7 @@ class align_ingredient:
             # loop over SWIM output to get final pmov and SNR, and optionally build the MIR script:
 
             self.pmov = np.zeros_like(self.psta, dtype=np.float64)
+            pa, pb = [], []
             idx = 0
             for i in range(self.psta.shape[1]):
                 if self.recipe.method == 'grid' and not self.recipe.ss['method_opts']['quadrants'][i]:
@@ -959,6 +1198,8 @@ class align_ingredient:
                     self.mir_toks[idx] = str(toks)
                     mir_toks = [toks[k] for k in [2, 3, 5, 6]] 
                     self.mir_script += ' '.join(mir_toks) + '\n'
+                    pa.append([float(toks[2]), float(toks[3])])
+                    pb.append([float(toks[5]), float(toks[6])])
 
                 snr_list.append(float(toks[0][0:-1]))
                 self.pmov[:,i] = np.array([float(toks[5]), float(toks[6])])
@@ -967,35 +1208,23 @@ class align_ingredient:
             if self.mode != 'SWIM-SNR':
                 self.mir_script += 'R\n'
 
+                # Solve the affine in-process rather than piping self.mir_script to the mir binary
                 t0 = time.time()
-                out, err, rc = run_command(
-                    self.recipe.mir_c,
-                    cmd_input=self.mir_script,
-                    desc=f'MIR compose affine',
-                )
-                self.t_mir = time.time() - t0
-                self.mir_out_lines = out.strip().split('\n')
-                self.mir_err_lines = err.strip().split('\n')
-                # self.mir_aim = np.eye(2, 3, dtype=np.float32)
-                # self.mir_afm = np.eye(2, 3, dtype=np.float32)
                 self.mir_aim = np.eye(2, 3)   # default is dtype=np.float64
                 self.mir_afm = np.eye(2, 3)   # default is dtype=np.float64
-                for line in self.mir_out_lines:
-                    toks = line.strip().split()
-                    if (toks[0] == 'AI'):
-                        self.mir_aim[0, 0] = float(toks[1])
-                        self.mir_aim[0, 1] = float(toks[2])
-                        self.mir_aim[0, 2] = float(toks[3]) + self.swim_drift
-                        self.mir_aim[1, 0] = float(toks[4])
-                        self.mir_aim[1, 1] = float(toks[5])
-                        self.mir_aim[1, 2] = float(toks[6]) + self.swim_drift
-                    if (toks[0] == 'AF'):
-                        self.mir_afm[0, 0] = float(toks[1])
-                        self.mir_afm[0, 1] = float(toks[2])
-                        self.mir_afm[0, 2] = float(toks[3]) - self.swim_drift
-                        self.mir_afm[1, 0] = float(toks[4])
-                        self.mir_afm[1, 1] = float(toks[5])
-                        self.mir_afm[1, 2] = float(toks[6]) - self.swim_drift
+                self.mir_err_lines = []
+                try:
+                    afm, aim, self.mir_rms, self.mir_npts = mir_compose(
+                        np.array(pa).transpose(), np.array(pb).transpose(),
+                        ethresh=self.recipe.config.get('mir_ethresh'))
+                    self.mir_aim = aim + np.array([[0., 0., self.swim_drift], [0., 0., self.swim_drift]])
+                    self.mir_afm = afm - np.array([[0., 0., self.swim_drift], [0., 0., self.swim_drift]])
+                except:
+                    print_exception(extra=f"[{self.recipe.index}, {self.ID}] Failed to compose affine")
+                    self.mir_err_lines = [traceback.format_exc()]
+                self.t_mir = time.time() - t0
+                self.mir_out_lines = [format_mir_affine('AF', self.mir_afm),
+                                      format_mir_affine('AI', self.mir_aim)]
             else:
                 # In SWIM-SNR mode copy the mir and points results from the previous ingredient
                 self.mir_afm = self.recipe.ingredients[self.idx - 1].mir_afm
@@ -1010,37 +1239,32 @@ class align_ingredient:
 
     def run_manual_mir(self):
         mir_script_mp = ''
-        print(f"----\n"
-              f"len(self.psta): {len(self.psta)}\n"
-              f"self.psta: {self.psta}")
+        if logpipe.hot_enabled(RMlogger):
+            RMlogger.log(logpipe.HOTPATH, f"len(self.psta): {len(self.psta)}\nself.psta: {self.psta}")
+        pa, pb = [], []
         for i in range(len(self.psta[0])):
             if self.psta[0][i] and self.psta[1][i]:
                 mir_script_mp += f'{self.psta[0][i]} {self.psta[1][i]} ' \
                                  f'{self.pmov[0][i]} {self.pmov[1][i]}\n'
+                pa.append([float(self.psta[0][i]), float(self.psta[1][i])])
+                pb.append([float(self.pmov[0][i]), float(self.pmov[1][i])])
         # print(f"mir_script_mp:\n{mir_script_mp}")
         mir_script_mp += 'R'
         self.mir_script = mir_script_mp
-        out, err, rc = run_command(
-            self.recipe.mir_c,
-            cmd_input=mir_script_mp,
-            desc='MIR to compose affine (strict manual)',
-        )
-        mir_mp_out_lines = out.strip().split('\n')
-        mir_mp_err_lines = err.strip().split('\n')
+        afm = np.eye(2, 3)  # default is dtype=np.float64
+        mir_mp_err_lines = []
+        t0 = time.time()
+        try:
+            _, afm, _, _ = mir_compose(np.array(pa).transpose(), np.array(pb).transpose())
+        except:
+            print_exception(extra=f"[{self.recipe.index}] Failed to compose manual affine")
+            mir_mp_err_lines = [traceback.format_exc()]
+        self.t_mir = time.time() - t0
+        mir_mp_out_lines = [format_mir_affine('AI', afm)]
         logging.getLogger('MAlogger').debug(
             f'\n==========\nManual MIR script:\n{mir_script_mp}\n'
             f'stdout >>\n{mir_mp_out_lines}\nstderr >>\n{mir_mp_err_lines}')
-        afm = np.eye(2, 3)  # default is dtype=np.float64
         self.mir_out_lines = mir_mp_out_lines
-        for line in mir_mp_out_lines:
-            toks = line.strip().split()
-            if (toks[0] == 'AI'):
-                afm[0, 0] = float(toks[1])
-                afm[0, 1] = float(toks[2])
-                afm[0, 2] = float(toks[3])
-                afm[1, 0] = float(toks[4])
-                afm[1, 1] = float(toks[5])
-                afm[1, 2] = float(toks[6])
         self.afm = afm
         self.snr = np.zeros(len(self.psta[0]))
         return self.afm
@@ -1083,7 +1307,7 @@ class align_ingredient:
             ofn = os.path.join(od, os.path.basename(fn))
             args = ['+%d' % scale_factor, 'of=%s' % ofn, '%s' % fn]
             # tnLogger.critical(f"Args:\n{args}")
-            out, err, rc = run_command(self.recipe.iscale2_c, args, desc="Reduce Matches")
+            out, err, rc = run_binary(self.recipe.iscale2_c, args, timeout=self.recipe.config.get('binary_timeout'))
             try:
                 if os.path.exists(fn):
                     os.remove(fn)
@@ -1092,24 +1316,6 @@ class align_ingredient:
 
 
 
-def run_command(cmd, arg_list=(), cmd_input=None, desc=''):
-    cmd_arg_list = [cmd]
-    cmd_arg_list.extend(arg_list)
-    # Note: decode bytes if universal_newlines False
-    with sp.Popen(
-        cmd_arg_list,
-        stdin=sp.PIPE,
-        stdout=sp.PIPE,
-        stderr=sp.PIPE,
-        universal_newlines=True,
-        ) as cmd_proc:
-        # env=os.environ.copy()) as cmd_proc:
-        cmd_stdout, cmd_stderr = cmd_proc.communicate(cmd_input)
-
-    return cmd_stdout, cmd_stderr, cmd_proc.returncode
-    # return cmd_stdout, cmd_stderr
-
-
 class ArgString:
     def __init__(self, sep):
         self.args = []
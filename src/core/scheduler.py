@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+'''Cost-ordered dispatch of alignment tasks.
+
+Sections aligned with larger windows, manual points or extra passes take
+much longer than the rest. When they are handed out in section order, the
+last of them keep a few workers busy long after the others have finished.
+Each task gets an estimated cost:
+
+  - the time its previous alignment at this level took (the t_swim + t_mir of
+    its ingredients), if it has one;
+  - otherwise the FFT work of its recipe (windows x area x log2(area), summed
+    over ingredients), converted to seconds at the rate seen for the sections
+    that do have timings;
+  - multiplied by RETRY_COST_FACTOR if its previous alignment failed.
+
+schedule() orders the tasks longest first. With contiguous runs (see
+ALIGN_CONTIGUOUS_RUNS), the stack is instead cut into runs of neighbouring
+sections of about equal cost. Each run is handed to a single worker as one
+chunk, so the worker can reuse its images, and the runs are handed out
+longest first.'''
+
+import logging
+import math
+import statistics
+
+import src.config as cfg
+
+__all__ = ['recipe_work', 'past_time', 'estimate_costs', 'schedule']
+
+logger = logging.getLogger(__name__)
+
+
+def recipe_work(ss):
+    '''FFT work of the recipe of an alignment task (arbitrary units).'''
+    mo = ss['method_opts']
+
+    def work(ww, n_windows, passes):
+        area = max(ww[0] * ww[1], 2)
+        return passes * n_windows * area * math.log2(area)
+
+    if mo['method'] == 'grid':
+        # Three SWIM-MIR passes and one SWIM-SNR pass of the 2x2 quadrants,
+        # preceded at the coarsest level by the 1x1 window
+        w = work(mo['size_2x2'], 4, 4)
+        if not ss.get('is_refinement', False):
+            w += work(mo['size_1x1'], 1, 1)
+        if ss.get('glob_cfg', {}).get('adaptive_recipe'):
+            w += work(mo['size_2x2'], 4, ss['glob_cfg'].get('max_extra_passes', 0)) / 2
+        return w
+    n_points = max(1, sum(1 for p in mo['points']['coords']['ref'] if p))
+    return work([mo['size'], mo['size']], n_points, 4)
+
+
+def past_time(result):
+    '''Seconds the ingredients of a previous alignment result took, or None.'''
+    if not result:
+        return None
+    t, found = 0.0, False
+    for k, ing in result.items():
+        if k.startswith('ing') and k[3:].isdigit() and isinstance(ing, dict):
+            for key in ('t_swim', 't_mir'):
+                if isinstance(ing.get(key), (int, float)):
+                    t += ing[key]
+                    found = True
+    return t if found else None
+
+
+def estimate_costs(tasks, previous):
+    '''Estimated seconds of each task. previous[i] is the last result of tasks[i] (or None).'''
+    work = [recipe_work(ss) for ss in tasks]
+    past = [past_time(r) for r in previous]
+    rates = [t / w for t, w in zip(past, work) if t and w]
+    rate = statistics.median(rates) if rates else 1.0
+    costs = []
+    for w, t, r in zip(work, past, previous):
+        c = t if t else w * rate
+        if r and not r.get('complete', True):
+            c *= cfg.RETRY_COST_FACTOR
+        costs.append(c)
+    return costs
+
+
+def schedule(tasks, costs, n_workers, contiguous=False):
+    '''(tasks in dispatch order, chunk sizes). Without contiguous runs, every chunk is one task.'''
+    if not tasks:
+        return [], []
+    if not contiguous:
+        order = sorted(range(len(tasks)), key=lambda i: costs[i], reverse=True)
+        return [tasks[i] for i in order], [1] * len(tasks)
+
+    order = sorted(range(len(tasks)), key=lambda i: tasks[i]['index'])
+    n_runs = max(1, min(len(tasks), n_workers * cfg.RUNS_PER_WORKER))
+    target = sum(costs) / n_runs
+    runs, run, acc = [], [], 0.0
+    for i in order:
+        # Start a new run at a gap in the stack or once this one has its share of the cost
+        if run and (acc >= target or tasks[i]['index'] != tasks[run[-1]]['index'] + 1):
+            runs.append((acc, run))
+            run, acc = [], 0.0
+        run.append(i)
+        acc += costs[i]
+    runs.append((acc, run))
+    runs.sort(key=lambda r: r[0], reverse=True)
+    logger.info(f'{len(runs)} runs of contiguous sections, estimated cost {runs[0][0]:.3g} (costliest) '
+                f'to {runs[-1][0]:.3g} (cheapest)')
+    return [tasks[i] for _, run in runs for i in run], [len(run) for _, run in runs]
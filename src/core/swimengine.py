@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+'''In-process SWIM and MIR backends.
+
+SwimEngine performs SWIM window matching with the NumPy implementation in
+src.utils.swiftir instead of fork/exec'ing the C `swim` binary. Results are
+formatted exactly like the lines printed by the binary, i.e.
+
+    snr: path_ref psta_x psta_y path pmov_x pmov_y  a00 a01 a10 a11 (dx dy m0)
+
+so that align_ingredient.ingest_swim_output() parses either backend unchanged.
+
+ResidentImages holds the images a recipe works on, so that the reference and
+moving images are decoded (or memory-mapped) once and shared by every
+ingredient and the thumbnail step. worker_engine() returns an engine that
+lives as long as the pool worker process, so that a worker aligning a
+contiguous run of sections reuses each image (section i's moving image is
+section i+1's reference) and each patch FFT at most once per run.
+
+ZarrWindows lets the engine read only the chunks of the scale's raw Zarr
+array (images_path/zarr/sN, one section per z) that cover a SWIM window,
+instead of decoding whole section images.
+
+mir_compose() solves the point-match affine that the `mir` binary used to be
+scripted for ("x y x' y' ... R"), returning its AF and AI matrices directly.'''
+
+import logging
+import os
+from collections import OrderedDict
+
+import imageio.v3 as iio
+import numpy as np
+import tifffile
+
+try:
+    import tensorstore as ts
+except ImportError:
+    ts = None
+
+from src.utils import swiftir
+
+__all__ = ['SWIM_BACKENDS', 'ResidentImages', 'ZarrWindows', 'SwimEngine', 'worker_engine', 'worker_windows', 'reset_worker', 'mir_compose', 'format_mir_affine']
+
+logger = logging.getLogger(__name__)
+
+SWIM_BACKENDS = ('binary', 'python')
+
+_worker_engine = None
+_worker_windows = None
+
+
+class ResidentImages:
+    '''Images decoded once and shared for the lifetime of a recipe, keyed by path.
+    With memmap=True, uncompressed TIFFs are memory-mapped read-only instead of
+    decoded, so only the pages touched by SWIM windows are ever read.
+    If capacity is given, only the most recently used images are kept.'''
+
+    def __init__(self, memmap=False, capacity=None):
+        self.memmap = memmap
+        self.capacity = capacity
+        self._images = OrderedDict()
+
+    def __contains__(self, path):
+        return path in self._images
+
+    def get(self, path, memmap=None):
+        '''Pass memmap=False for images whose file is about to be rewritten.'''
+        img = self._images.get(path)
+        if img is None:
+            img = self._images[path] = self._load(path, self.memmap if memmap is None else memmap)
+            while self.capacity and len(self._images) > self.capacity:
+                self._images.popitem(last=False)
+        else:
+            self._images.move_to_end(path)
+        return img
+
+    def evict(self, path):
+        self._images.pop(path, None)
+
+    def clear(self):
+        self._images.clear()
+
+    def _load(self, path, memmap):
+        if os.path.splitext(path)[1].lower() not in ('.tif', '.tiff'):
+            return iio.imread(path)
+        if memmap:
+            try:
+                return tifffile.memmap(path, mode='r')
+            except:
+                logger.debug(f'{path} can not be memory-mapped, decoding instead')
+        return swiftir.loadImage(path)
+
+
+class ZarrWindows:
+    '''Reads rectangular regions of section images from a scale's raw Zarr array
+    (shape (x, y, n_sections), as written by the scaling step) through TensorStore,
+    so that only the chunks covering a window are fetched and decompressed.
+    Section images are registered by path, with their z index in the array.
+    halo (px) pads the region read for transformed (moving) windows, so that
+    the window refined by later SWIM iterations still falls in chunks that
+    are already in the TensorStore cache.'''
+
+    def __init__(self, zarr_path, halo=0, cache_bytes=256 * 1024 ** 2):
+        if ts is None:
+            raise ImportError('tensorstore is required to read SWIM windows from Zarr')
+        self.zarr_path = zarr_path
+        self.halo = halo
+        self._arr = ts.open({
+            'driver': 'zarr',
+            'kvstore': {'driver': 'file', 'path': zarr_path},
+            'context': {'cache_pool': {'total_bytes_limit': cache_bytes}},
+            'recheck_cached_data': 'open',
+        }, read=True).result()
+        self.shape = tuple(self._arr.shape)
+        self._z = {}
+
+    def __contains__(self, path):
+        return path in self._z
+
+    def register(self, path, z):
+        if z is not None and 0 <= z < self.shape[2]:
+            self._z[path] = int(z)
+
+    def size(self, path):
+        '''(width, height) of the section image at path.'''
+        return self.shape[0], self.shape[1]
+
+    def read(self, path, x0, y0, x1, y1):
+        '''Region [y0:y1, x0:x1] of the image at path (clipped to the image), and its origin (x0, y0).'''
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.shape[0]), min(y1, self.shape[1])
+        region = self._arr[x0:x1, y0:y1, self._z[path]].read().result()
+        return np.ascontiguousarray(region.transpose()), (x0, y0)
+
+
+class SwimEngine:
+    '''Matches SWIM windows between a reference and a moving image in-process.
+    Images come from a ResidentImages, so all ingredients of a recipe share one
+    decode of each image. If patch_capacity is non-zero, the most recently used
+    patch FFTs are kept too, keyed by (path, window centre, size, afm).
+    Images registered with a ZarrWindows (windows) are never decoded whole;
+    each patch is cut from the covering region only.'''
+
+    def __init__(self, images=None, patch_capacity=0, windows=None):
+        self.images = ResidentImages() if images is None else images
+        self.patch_capacity = patch_capacity
+        self.windows = windows
+        self._patches = OrderedDict()
+
+    def image(self, path):
+        return self.images.get(path)
+
+    def region(self, path, xy, tfm, ww, halo=0):
+        '''(img, xy) where img covers the window of size ww centered on xy and sampled
+        through the 2x2 matrix tfm, and xy is the window centre in img's coordinates.
+        This is the whole image unless path is registered with self.windows.'''
+        if self.windows is None or path not in self.windows:
+            return self.image(path), xy
+        hw, hh = ww[0] / 2, ww[1] / 2
+        corners = np.array([[-hw, hw, -hw, hw], [-hh, -hh, hh, hh]])
+        pts = np.matmul(tfm, corners) + np.reshape(xy, (2, 1))
+        pad = 2 + halo  # bilinear interpolation reaches one pixel beyond the corners
+        img, (x0, y0) = self.windows.read(
+            path,
+            int(np.floor(pts[0].min())) - pad, int(np.floor(pts[1].min())) - pad,
+            int(np.ceil(pts[0].max())) + pad + 1, int(np.ceil(pts[1].max())) + pad + 1)
+        return img, np.array([xy[0] - x0, xy[1] - y0], dtype='float64')
+
+    def stationary_patch(self, path, xy, ww):
+        '''Apodized FFT of the window of size ww centered on xy in the image at path.'''
+        key = ('sta', path, float(xy[0]), float(xy[1]), int(ww[0]), int(ww[1]))
+
+        def compute():
+            img, c = self.region(path, xy, np.eye(2), ww)
+            return swiftir.stationaryPatches(img, np.reshape(c, (2, 1)), ww)[0]
+        return self._patch(key, compute)
+
+    def moving_patch(self, path, xy, afm, ww):
+        '''FFT of the window of size ww centered on xy in the image at path,
+        sampled through the 2x2 part of afm.'''
+        key = ('mov', path, float(xy[0]), float(xy[1]), int(ww[0]), int(ww[1])) + \
+              tuple(float(v) for v in np.ravel(afm[:, 0:2]))
+
+        def compute():
+            halo = self.windows.halo if self.windows is not None else 0
+            img, c = self.region(path, xy, afm[:, 0:2], ww, halo=halo)
+            return swiftir.movingPatches(img, np.reshape(c, (2, 1)), afm, ww)[0]
+        return self._patch(key, compute)
+
+    def clear(self):
+        self._patches.clear()
+        self.images.clear()
+
+    def _patch(self, key, compute):
+        if not self.patch_capacity:
+            return compute()
+        fft = self._patches.get(key)
+        if fft is None:
+            fft = self._patches[key] = compute()
+            while len(self._patches) > self.patch_capacity:
+                self._patches.popitem(last=False)
+        else:
+            self._patches.move_to_end(key)
+        return fft
+
+    def swim(self, path_ref, psta, path, pmov, afm, ww, iters=3, whiten=-0.65,
+             signal_paths=None, match_paths=None, signal_px=128, signals_out=None, matches_out=None):
+        '''Match windows of size ww centered on the columns of psta (2xN, reference
+        image) against windows centered on the columns of pmov (2xN, moving image)
+        sampled through the 2x2 part of afm. pmov is refined iters times.
+        Optionally writes correlation signals (one path per window, cropped to
+        signal_px) and match windows (one (k, t) path pair per window), or
+        appends them, one per window, to the lists signals_out and matches_out.
+        Returns a list of SWIM-formatted output lines, one per window.'''
+        psta = np.array(psta, dtype='float64')
+        pmov = np.array(pmov, dtype='float64')
+        afm = np.array(afm, dtype='float64')
+        ww = swiftir.si_unpackSize(ww)
+        whiten = float(whiten)
+        n = psta.shape[1]
+        stas = [self.stationary_patch(path_ref, psta[:, k], ww) for k in range(n)]
+        pmov_start = pmov
+        snr = np.zeros(n)
+        for _ in range(max(int(iters), 1)):
+            movs = [self.moving_patch(path, pmov[:, k], afm, ww) for k in range(n)]
+            dp, _, snr = swiftir.multiSwim(stas, movs, wht=whiten, pp=pmov, afm=afm)
+            pmov = pmov + dp
+
+        if signal_paths or signals_out is not None:
+            for k in range(n):
+                movk = self.moving_patch(path, pmov[:, k], afm, ww)
+                shf = _crop(np.fft.fftshift(swiftir.alignmentImage(stas[k], movk, whiten)), signal_px)
+                if signals_out is not None:
+                    signals_out.append(shf)
+                else:
+                    self._write(signal_paths[k], shf)
+        if match_paths or matches_out is not None:
+            for k in range(n):
+                mov, c = self.region(path, pmov[:, k], afm[:, 0:2], ww)
+                k_img = swiftir.extractTransformedWindow(mov, c, afm[:, 0:2], ww)
+                ref, c = self.region(path_ref, psta[:, k], np.eye(2), ww)
+                t_img = swiftir.extractStraightWindow(ref, c, ww)
+                if matches_out is not None:
+                    matches_out.append((k_img, t_img))
+                else:
+                    self._write(match_paths[k][0], k_img)
+                    self._write(match_paths[k][1], t_img)
+
+        # As swim, report the total drift from the initial pattern position (dx dy m0)
+        drift = pmov - pmov_start
+        m0 = np.hypot(drift[0], drift[1])
+        lines = []
+        for k in range(pmov.shape[1]):
+            lines.append('%.9g: %s %.9g %.9g %s %.9g %.9g  %.9g %.9g %.9g %.9g (%.9g %.9g %.9g)' % (
+                snr[k], path_ref, psta[0, k], psta[1, k], path, pmov[0, k], pmov[1, k],
+                afm[0, 0], afm[0, 1], afm[1, 0], afm[1, 1],
+                drift[0, k], drift[1, k], m0[k]))
+        return lines
+
+    def _write(self, path, img):
+        img = np.asarray(img, dtype='float32')
+        lo, hi = float(img.min()), float(img.max())
+        if hi > lo:
+            img = (img - lo) * (255.0 / (hi - lo))
+        else:
+            img = np.zeros_like(img)
+        try:
+            tifffile.imwrite(path, img.astype('uint8'))
+        except:
+            logger.warning(f'Unable to write SWIM image {path}')
+
+
+def worker_engine(memmap=False, image_capacity=3, patch_capacity=32):
+    '''SwimEngine shared by all recipes run in this (pool worker) process.'''
+    global _worker_engine
+    e = _worker_engine
+    if e is None or e.images.memmap != memmap or e.images.capacity != image_capacity or \
+            e.patch_capacity != patch_capacity:
+        e = _worker_engine = SwimEngine(ResidentImages(memmap=memmap, capacity=image_capacity),
+                                        patch_capacity=patch_capacity)
+    return e
+
+
+def worker_windows(zarr_path, halo=0):
+    '''ZarrWindows on zarr_path shared by all recipes run in this (pool worker) process,
+    so that its TensorStore chunk cache outlives each recipe. None if it can not be opened.'''
+    global _worker_windows
+    w = _worker_windows
+    if w is None or w.zarr_path != zarr_path or w.halo != halo:
+        try:
+            w = ZarrWindows(zarr_path, halo=halo)
+        except:
+            logger.warning(f'Unable to open {zarr_path} for window reads, reading whole images instead')
+            w = None
+        _worker_windows = w
+    return w
+
+
+def reset_worker():
+    '''Drop the engine and window reader of this worker, with the images and chunks they hold.'''
+    global _worker_engine, _worker_windows
+    _worker_engine = _worker_windows = None
+
+
+def _crop(img, px):
+    '''Central px x px region of img (the whole image if smaller).'''
+    h, w = img.shape
+    y0, x0 = max((h - px) // 2, 0), max((w - px) // 2, 0)
+    return img[y0:y0 + px, x0:x0 + px]
+
+
+def mir_compose(psta, pmov, ethresh=None, leastpts=4):
+    '''Least-squares affine for matching points psta (2xN, reference image) and
+    pmov (2xN, moving image), as computed by a 'mir' compose script.
+    Returns (mir_afm, mir_aim, rms, npts) where mir_aim maps psta onto pmov
+    (mir's 'AI' line) and mir_afm is its inverse (mir's 'AF' line).
+    If ethresh is given, the worst matching point is dropped until the RMS
+    error is below ethresh, keeping at least leastpts points.'''
+    psta = np.asarray(psta, dtype='float64').reshape(2, -1)
+    pmov = np.asarray(pmov, dtype='float64').reshape(2, -1)
+    if ethresh:
+        mir_aim, rms, npts = swiftir.mirIterate(psta, pmov, ethresh=ethresh, leastpts=leastpts)
+    else:
+        mir_aim, rms, _ = swiftir.mirAffine(psta, pmov)
+        npts = psta.shape[1]
+    mir_aim = np.array(mir_aim, dtype='float64')
+    mir_afm = swiftir.invertAffine(mir_aim)
+    return mir_afm, mir_aim, rms, npts
+
+
+def format_mir_affine(tag, afm):
+    '''An affine as printed by mir, e.g. 'AI a b c d e f'.'''
+    return '%s %s' % (tag, ' '.join('%.15g' % v for v in np.asarray(afm).ravel()))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+'''Chunked store for SWIM correlation signals and match windows.
+
+Instead of one small TIFF per signal and match window (each cropped by a
+`mir` call or downscaled by an `iscale2` call), a level's signals and matches
+are kept in a Zarr group (data_dir/swim/sN) of arrays indexed by
+(section, ingredient, quadrant):
+
+    signals      (n_sections, n_ingredients, 4, signal_px, signal_px)  uint8
+    matches      (n_sections, n_ingredients, 4, 2, match_px, match_px)  uint8, [k, t]
+    match_shape  (n_sections, n_ingredients, 4, 2)                      valid (h, w) of each match
+    written      (n_sections, n_ingredients, 4)                         SIGNAL | MATCH flags
+    ss_hash      (n_sections,)                                          int64, ssHash of their swim settings
+
+As the signals/ and matches/ directories they replace, the images of a section
+belong to its swim settings: readers compare ss_hash with the current ssHash.
+Every array is chunked by section, so each section is one file per array,
+and pool workers aligning different sections never write the same chunk.
+Signals are cropped to their central signal_px and match windows are
+block-averaged down to fit match_px in NumPy as they are written.'''
+
+import logging
+import math
+
+import numpy as np
+import zarr
+from numcodecs import Blosc
+
+__all__ = ['SwimImageStore', 'SIGNAL', 'MATCH']
+
+logger = logging.getLogger(__name__)
+
+SIGNAL = 1
+MATCH = 2
+
+
+class SwimImageStore:
+
+    def __init__(self, path, mode='r+'):
+        self.path = path
+        self._group = zarr.open_group(path, mode=mode)
+        self.signals = self._group['signals']
+        self.matches = self._group['matches']
+        self.match_shape = self._group['match_shape']
+        self.written = self._group['written']
+        self.ss_hash = self._group['ss_hash']
+        self.n_ingredients = self.signals.shape[1]
+        self.signal_px = self.signals.shape[3]
+        self.match_px = self.matches.shape[4]
+
+    @classmethod
+    def create(cls, path, n_sections, n_ingredients=8, signal_px=128, match_px=256):
+        '''Open the store at path, creating (or growing to n_sections) its arrays.'''
+        g = zarr.open_group(path, mode='a')
+        compressor = Blosc(cname='zstd', clevel=1)
+        shapes = {
+            'signals': ((n_sections, n_ingredients, 4, signal_px, signal_px), 'uint8'),
+            'matches': ((n_sections, n_ingredients, 4, 2, match_px, match_px), 'uint8'),
+            'match_shape': ((n_sections, n_ingredients, 4, 2), 'uint16'),
+            'written': ((n_sections, n_ingredients, 4), 'uint8'),
+            'ss_hash': ((n_sections,), 'int64'),
+        }
+        for name, (shape, dtype) in shapes.items():
+            if name in g and g[name].shape[1:] != shape[1:]:
+                logger.info(f'{path}/{name} has shape {g[name].shape}, recreating it as {shape}')
+                del g[name]
+            if name not in g:
+                g.zeros(name=name, shape=shape, chunks=(1,) + shape[1:], dtype=dtype, compressor=compressor)
+            elif g[name].shape[0] < n_sections:
+                g[name].resize(shape)
+        return cls(path)
+
+    def write_section(self, section, signals=None, matches=None, ss_hash=0):
+        '''Write all signals and matches of one section in one go, replacing earlier ones.
+        :param signals: {(ingredient, quadrant): correlation signal}
+        :param matches: {(ingredient, quadrant): (k window, t window)}
+        :param ss_hash: ssHash of the swim settings of the section'''
+        sig = np.zeros(self.signals.shape[1:], dtype='uint8')
+        mat = np.zeros(self.matches.shape[1:], dtype='uint8')
+        shp = np.zeros(self.match_shape.shape[1:], dtype='uint16')
+        flags = np.zeros(self.written.shape[1:], dtype='uint8')
+        for (ing, q), img in (signals or {}).items():
+            if self._in_range(section, ing, q):
+                sig[ing, q] = _fit(_to_uint8(_crop(img, self.signal_px)), self.signal_px)
+                flags[ing, q] |= SIGNAL
+        for (ing, q), pair in (matches or {}).items():
+            if self._in_range(section, ing, q):
+                for j, img in enumerate(pair):
+                    small = _reduce(img, self.match_px)
+                    mat[ing, q, j] = _fit(_to_uint8(small), self.match_px)
+                    shp[ing, q] = small.shape
+                flags[ing, q] |= MATCH
+        self.signals[section] = sig
+        self.matches[section] = mat
+        self.match_shape[section] = shp
+        self.written[section] = flags
+        self.ss_hash[section] = ss_hash
+
+    def signal(self, section, ingredient, quadrant):
+        '''Correlation signal, or None if it was not kept.'''
+        if not self.written[section, ingredient, quadrant] & SIGNAL:
+            return None
+        return self.signals[section, ingredient, quadrant]
+
+    def match(self, section, ingredient, quadrant):
+        '''(k, t) match windows, or None if they were not kept.'''
+        if not self.written[section, ingredient, quadrant] & MATCH:
+            return None
+        h, w = self.match_shape[section, ingredient, quadrant]
+        k, t = self.matches[section, ingredient, quadrant]
+        return k[:h, :w], t[:h, :w]
+
+    def holds(self, section, ss_hash):
+        '''Whether the images of section were made with the swim settings of hash ss_hash.'''
+        return section < self.ss_hash.shape[0] and int(self.ss_hash[section]) == ss_hash
+
+    def last_ingredient(self, section):
+        '''Index of the last ingredient of section with anything written, or None.'''
+        used = np.flatnonzero(self.written[section].any(axis=1))
+        return int(used[-1]) if len(used) else None
+
+    def clear(self, section):
+        self.written[section] = 0
+        self.ss_hash[section] = 0
+
+    def _in_range(self, section, ing, q):
+        if section < self.signals.shape[0] and ing < self.n_ingredients and q < 4:
+            return True
+        logger.warning(f'{self.path}: no room for section {section}, ingredient {ing}, quadrant {q}')
+        return False
+
+
+def _crop(img, px):
+    '''Central px x px region of img (the whole image if smaller).'''
+    h, w = img.shape
+    y0, x0 = max((h - px) // 2, 0), max((w - px) // 2, 0)
+    return img[y0:y0 + px, x0:x0 + px]
+
+
+def _reduce(img, px):
+    '''img block-averaged by the smallest integer factor that fits it in px x px.'''
+    f = max(1, math.ceil(max(img.shape) / px))
+    if f == 1:
+        return np.asarray(img)
+    h, w = img.shape[0] // f * f, img.shape[1] // f * f
+    return np.asarray(img[:h, :w], dtype='float32').reshape(h // f, f, w // f, f).mean(axis=(1, 3))
+
+
+def _fit(img, px):
+    '''img placed in the top left corner of a zeroed px x px array.'''
+    out = np.zeros((px, px), dtype=img.dtype)
+    out[:img.shape[0], :img.shape[1]] = img
+    return out
+
+
+def _to_uint8(img):
+    if img.dtype == np.uint8:
+        return img
+    img = np.asarray(img, dtype='float32')
+    lo, hi = float(img.min()), float(img.max())
+    if hi <= lo:
+        return np.zeros(img.shape, dtype='uint8')
+    return ((img - lo) * (255.0 / (hi - lo))).astype('uint8')
@@ -2,12 +2,17 @@
 '''
 A hash table class.
 
+Between full pickles, flush() appends the entries put or removed since to
+<cache>.journal, which unpickle() replays.
+
 '''
 import os
 import json
 import pickle
 import logging
+import threading
 from pathlib import Path
+import src.config as cfg
 from src.utils.helpers import path_to_str
 
 logger = logging.getLogger(__name__)
@@ -19,6 +24,11 @@ class Cache:
         self.data = {}
         self.name = name
         self.path = path_to_str(Path(self.dm.data_dir_path).with_suffix('') / self.name)
+        self.journal = self.path + '.journal'
+        self._ops = []  # ('put', key, value), ('remove', key) or ('clear',) since the last flush
+        self._n_journaled = 0
+        self._lock = threading.RLock()
+        self._thread = None
         self.unpickle()
 
     def __len__(self):
@@ -26,7 +36,9 @@ class Cache:
 
     def clear(self):
         logger.warn('Clearing cached data!')
-        self.data = {}
+        with self._lock:
+            self.data = {}
+            self._ops.append(('clear',))
 
     @property
     def count(self):
@@ -39,8 +51,58 @@ class Cache:
 
     def pickle(self):
         print(f'Pickling {self.path}...')
-        with open(self.path, 'wb') as f:
-            pickle.dump(self.data, f)
+        with self._lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(self.data, f)
+            os.replace(tmp, self.path)
+            self._ops = []
+            self._n_journaled = 0
+            if os.path.exists(self.journal):
+                os.remove(self.journal)
+
+    def flush(self):
+        '''Append the changes since the last flush to the journal; pickle in the background once it is long.'''
+        with self._lock:
+            if self._ops:
+                with open(self.journal, 'ab') as f:
+                    for op in self._ops:
+                        pickle.dump(op, f)
+                self._n_journaled += len(self._ops)
+                self._ops = []
+            compact = self._n_journaled >= cfg.JOURNAL_COMPACT_RECORDS
+        if compact and not (self._thread and self._thread.is_alive()):
+            self._thread = threading.Thread(target=self.pickle, daemon=True)
+            self._thread.start()
+
+    def _replay(self):
+        n = 0
+        with open(self.journal, 'rb+') as f:
+            while True:
+                good = f.tell()
+                try:
+                    op = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception:
+                    logger.warning(f'Dropping a truncated record at the end of {self.journal}')
+                    f.truncate(good)
+                    break
+                if op[0] == 'put':
+                    bucket = self.data.setdefault(self._hash(op[1]), [])
+                    if (op[1], op[2]) not in bucket:
+                        bucket.append((op[1], op[2]))
+                elif op[0] == 'remove':
+                    try:
+                        self.remove(op[1])
+                    except KeyError:
+                        pass
+                elif op[0] == 'clear':
+                    self.data = {}
+                n += 1
+        self._ops = []
+        self._n_journaled = n
+        logger.info(f'Replayed {n} cache journal records')
 
     def unpickle(self):
         print(f'Unpickling {self.path}...')
@@ -50,9 +112,12 @@ class Cache:
             print(f'Unpickling cache file {self.path}...')
             with open(self.path, "rb") as f:
                 self.data = pickle.load(f)
-            self._migrate_hash_keys()
         else:
             logger.info('Cache file does not exist.')
+        if os.path.exists(self.journal):
+            self._replay()
+        if self.data:
+            self._migrate_hash_keys()
 
     def _migrate_hash_keys(self):
         """Re-key cache data using deterministic hashes and normalize keys.
@@ -122,9 +187,11 @@ class Cache:
         """Insert a key-value pair into the hash data."""
         hashkey = self._hash(key)
         # print(f'Putting data at hash key {hashkey}')
-        if hashkey not in self.data:
-            self.data[hashkey] = []
-        self.data[hashkey].append((key, value))
+        with self._lock:
+            if hashkey not in self.data:
+                self.data[hashkey] = []
+            self.data[hashkey].append((key, value))
+            self._ops.append(('put', key, value))
 
     def get(self, key):
         """Retrieve the value associated with the given key."""
@@ -157,11 +224,13 @@ class Cache:
     def remove(self, key):
         """Remove a key-value pair from the hash data."""
         hashkey = self._hash(key)
-        if hashkey in self.data:
-            for i, (k, v) in enumerate(self.data[hashkey]):
-                if k == key:
-                    del self.data[hashkey][i]
-                    return
+        with self._lock:
+            if hashkey in self.data:
+                for i, (k, v) in enumerate(self.data[hashkey]):
+                    if k == key:
+                        del self.data[hashkey][i]
+                        self._ops.append(('remove', key))
+                        return
         raise KeyError(f"Key '{key}' not found in the hash data.")
 
     def __str__(self):
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+'''
+Binary project container.
+
+With PROJECT_BINARY, a project (.align) is written as one binary file instead
+of one JSON document:
+
+    magic, offset and length of the header (24 bytes)
+    per level: the JSON list of the level dicts of every section, and the
+               numeric results of the level (the LevelResults columns) as raw
+               arrays, each starting at a multiple of 64 bytes
+    header     JSON: the top-level keys, the section dicts without 'levels',
+               and where the blobs of each level are
+
+read_container() reads only the header. The file is memory-mapped, and the
+level dicts of all sections at one level are parsed the first time any of them
+is accessed (see _Levels). The numeric results are not parsed at all: the
+DataModel builds the LevelResults of a level from views of the mapped arrays
+(copy-on-write), so lists and plots of SNR or matrices do not load the level.
+
+When a project read from a container is written again, the levels that were
+never loaded are copied from it as raw bytes. JSON remains readable everywhere
+read_project() is used, and is written when PROJECT_BINARY is off. Convert an
+existing project either way with:
+
+    python -m src.models.container project.align --to binary|json
+
+'''
+import argparse
+import gc
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+import src.config as cfg
+from src.models.results import LevelResults
+
+__all__ = ['is_container', 'read_container', 'write_container', 'container_of', 'load_all', 'convert']
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'\x93ALIGN\x01\x00'
+_PREAMBLE = struct.Struct('<8sQQ')  # magic, header offset, header length
+_ALIGN = 64
+_COLUMNS = ('afm', 'cafm', 'alt_cafm', 'snr', 'snr_std', 'snr_components', 't_swim', 't_mir')
+
+
+def is_container(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def _loads(b):
+    enabled = gc.isenabled()
+    gc.disable()  # Parsing allocates many containers; collecting in between only slows it down
+    try:
+        return json.loads(b)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def container_of(data):
+    '''The Container data was read from, or None if it was read from JSON (or created).'''
+    return getattr(data, 'container', None)
+
+
+def load_all(data):
+    '''Load every level of a project read from a container, e.g. before encoding it as JSON
+    (the C encoder reads dicts directly, without going through _Levels).'''
+    container = container_of(data)
+    if container:
+        for s in sorted(container.pending):
+            container.load(s)
+    return data
+
+
+class _Project(dict):
+    '''Project dict read from a container.'''
+
+    def __reduce_ex__(self, protocol):
+        return dict, (dict(self),)
+
+
+class _Levels(dict):
+    '''The 'levels' dict of one section. Holds the levels loaded so far; any other access to
+    a level of the container loads that level for every section.'''
+
+    __slots__ = ('_container', '_index')
+
+    def __init__(self, container, index):
+        dict.__init__(self)
+        self._container = container
+        self._index = index
+
+    def __missing__(self, s):
+        if s in self._container.pending:
+            self._container.load(s)
+            return dict.__getitem__(self, s)
+        raise KeyError(s)
+
+    def __setitem__(self, s, d):
+        self._container.replaced.setdefault(s, set()).add(self._index)
+        dict.__setitem__(self, s, d)
+
+    def __contains__(self, s):
+        return dict.__contains__(self, s) or s in self._container.pending
+
+    def get(self, s, default=None):
+        try:
+            return self[s]
+        except KeyError:
+            return default
+
+    def setdefault(self, s, default=None):
+        if s in self._container.pending:
+            self._container.load(s)
+        return dict.setdefault(self, s, default)
+
+    def pop(self, s, *default):
+        if s in self._container.pending:
+            self._container.load(s)
+        return dict.pop(self, s, *default)
+
+    def copy(self):
+        return dict(self.items())
+
+    def loaded(self):
+        '''(level, dict) of the levels loaded so far.'''
+        return dict.items(self)
+
+    def _load_all(self):
+        for s in list(self._container.pending):
+            self._container.load(s)
+
+    def keys(self):
+        self._load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+    def __iter__(self):
+        self._load_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        return len(set(dict.keys(self)) | self._container.pending)
+
+    def __reduce_ex__(self, protocol):
+        return dict, (dict(self.items()),)
+
+
+class Container:
+    '''A memory-mapped project container and the project dict read from it.'''
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, 'rb') as f:
+            magic, off, length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError(f'{self.path} is not a project container')
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.header = _loads(self.mm[off:off + length])
+        self.levels = self.header['levels']
+        self.pending = set(self.levels)  # levels not loaded yet
+        self.replaced = {}  # level -> sections whose level dict was assigned before the level was loaded
+        self.on_load = None  # called with (level, {section: level dict}) of the dicts a load adds
+        self.data = _Project(self.header['top'])
+        self.data.container = self
+        self.stack = self.header['sections']
+        self.n = len(self.stack)
+        for i, section in enumerate(self.stack):
+            section['levels'] = _Levels(self, i)
+        self.data['stack'] = self.stack
+
+    def load(self, s):
+        '''Parse the level dicts of level s. Dicts assigned since the container was read are kept.'''
+        if s not in self.pending:
+            return
+        t0 = time.time()
+        self.pending.discard(s)
+        off, length = self.levels[s]['json']
+        dicts = _loads(self.mm[off:off + length])
+        added = {}
+        for i, (section, d) in enumerate(zip(self.stack, dicts)):
+            if not dict.__contains__(section['levels'], s):
+                dict.__setitem__(section['levels'], s, d)
+                added[i] = d
+        if self.on_load:
+            self.on_load(s, added)
+        logger.info(f'Loaded level {s} of {len(dicts)} sections from {self.path} in {time.time() - t0:.3g}s')
+
+    def arrays(self, s):
+        '''{column: array} of the numeric results of level s, as writable copy-on-write views.'''
+        out = {}
+        for name, (off, dtype, shape) in self.levels[s].get('arrays', {}).items():
+            count = int(np.prod(shape))
+            out[name] = np.frombuffer(self.mm, dtype=dtype, count=count, offset=off).reshape(shape)
+        return out
+
+    def results(self, s, n):
+        '''LevelResults of level s built from the mapped arrays, or None if they do not fit.'''
+        arrays = self.arrays(s) if s in self.levels else {}
+        if len(arrays) != len(_COLUMNS) or len(arrays['afm']) != n:
+            return None
+        r = LevelResults.of(arrays)
+        for l in self.replaced.get(s, ()):
+            r.mark(l)
+        return r
+
+    def copyable(self, s):
+        '''Whether level s can be written as the raw bytes it was read from.'''
+        return s in self.pending and not self.replaced.get(s) and \
+               self.data['stack'] is self.stack and len(self.stack) == self.n
+
+    def blob(self, s, name=None):
+        if name is None:
+            off, length = self.levels[s]['json']
+            return self.mm[off:off + length]
+        off, dtype, shape = self.levels[s]['arrays'][name]
+        return self.mm[off:off + int(np.prod(shape)) * np.dtype(dtype).itemsize]
+
+
+def read_container(path):
+    '''The project dict of the container at path; its levels are loaded on first access.'''
+    t0 = time.time()
+    data = Container(path).data
+    logger.info(f'Read {path} ({len(data["stack"])} sections) in {time.time() - t0:.3g}s')
+    return data
+
+
+def write_container(path, data, results=None):
+    '''Write data to path as a container, atomically. results: {level: LevelResults} already up to
+    date with data (computed from the level dicts for any other level written).'''
+    t0 = time.time()
+    src = container_of(data)
+    results = results or {}
+    stack = data['stack']
+    levels = list(src.levels) if src else []
+    for section in stack[:1]:
+        for s in dict.keys(section['levels']):  # without loading
+            if s not in levels:
+                levels.append(s)
+    header = {'version': cfg.VERSION,
+              'top': {k: v for k, v in data.items() if k != 'stack'},
+              'sections': [{k: v for k, v in section.items() if k != 'levels'} for section in stack],
+              'levels': {}}
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, 0, 0))
+
+        def put(b):
+            f.write(b'\0' * (-f.tell() % _ALIGN))
+            off = f.tell()
+            f.write(b)
+            return off
+
+        for s in levels:
+            entry = header['levels'][s] = {}
+            if src and src.copyable(s):
+                b = src.blob(s)
+                entry['json'] = [put(b), len(b)]
+                entry['arrays'] = {}
+                for name, (_, dtype, shape) in src.levels[s].get('arrays', {}).items():
+                    entry['arrays'][name] = [put(src.blob(s, name)), dtype, shape]
+                continue
+            b = json.dumps([section['levels'][s] for section in stack], ensure_ascii=False,
+                           separators=(',', ':')).encode('utf-8')
+            entry['json'] = [put(b), len(b)]
+            r = results.get(s)
+            if r is None or r.n != len(stack):
+                r = LevelResults(len(stack)).refresh(stack, s)
+            entry['arrays'] = {}
+            for name in _COLUMNS:
+                a = np.ascontiguousarray(getattr(r, name), dtype='<f8')
+                entry['arrays'][name] = [put(a.tobytes()), a.dtype.str, list(a.shape)]
+        b = json.dumps(header, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        off = put(b)
+        f.seek(0)
+        f.write(_PREAMBLE.pack(MAGIC, off, len(b)))
+    os.replace(tmp, path)
+    logger.info(f'Wrote {path} ({len(levels)} levels, '
+                f'{sum(not (src and src.copyable(s)) for s in levels)} re-encoded) in {time.time() - t0:.3g}s')
+
+
+def convert(path, to):
+    '''Rewrite the project at path (with its journal) as a container (to='binary') or as JSON.'''
+    from src.models.journal import read_project, write_project
+    data = read_project(path)
+    if data is None:
+        raise ValueError(f'Unable to read {path}')
+    write_project(path, data, binary=(to == 'binary'))
+    for p in (f'{path}.journal', f'{path}.journal.compacting'):
+        if os.path.exists(p):
+            os.remove(p)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Convert a project between JSON and the binary container')
+    ap.add_argument('path', help='Project file (.align)')
+    ap.add_argument('--to', choices=('binary', 'json'), required=True)
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    convert(args.path, args.to)
@@ -30,11 +30,15 @@ import numpy as np
 import zarr
 from qtpy.QtCore import QObject, Signal
 
-from src.utils.funcs_image import ComputeBoundingRect, SetStackCafm, alt_SetStackCafm
+from src.utils.funcs_image import ComputeBoundingRect, SetStackCafm, StackAfms, UpdateStackCafm, alt_SetStackCafm
 from src.models.cache import Cache
+from src.models.container import container_of, load_all
+from src.models.journal import Journal
+from src.models.results import LevelResults
 from src.utils.helpers import print_exception, path_to_str
-from src.utils.writers import write
 from src.core.files import DirectoryStructure
+from src.core.swimengine import SWIM_BACKENDS
+from src.core.swimstore import SwimImageStore
 import src.config as cfg
 
 __all__ = ['DataModel']
@@ -73,6 +77,13 @@ class DataModel:
     """ Encapsulate datamodel dictionary and wrap with methods for convenience """
     def __init__(self, data=None, file_path=None, images_path=None, readonly=False, init=False, images_info=None):
         self._current_version = cfg.VERSION
+        self._cafm_cache = {}  # level -> arrays of the last set_stack_cafm() without polynomial bias
+        self._cafm_dirty = {}  # level -> lowest section whose afm or include changed since
+        self._results = {}  # level -> LevelResults, columnar copy of the numeric results
+        self._swim_stores = {}  # level -> (path, mtime, SwimImageStore) opened for reading
+        self._journal = None
+        self._saved = None  # what the project file (with its journal) holds, see _mark_saved
+        self._unsaved = set()  # (section, level) level dicts and (section, None) section keys changed since
         if data:
             self._data = data  # Load project data from file
 
@@ -98,6 +109,12 @@ class DataModel:
             self._upgradeDatamodel()
             self.signals = Signals()
             self.ds = DirectoryStructure(self)
+            container = container_of(self._data)
+            if container:
+                # Levels are loaded on first access. The file and its journal are what was just read.
+                container.on_load = self._on_level_load
+                self._journal = Journal(self.data_file_path)
+                self._mark_saved()
 
         if readonly:
             clr = inspect.stack()[1].function
@@ -110,7 +127,7 @@ class DataModel:
         self._migrate_data_dirs()
 
 
-    def _migrate_data_dirs(self):
+    def _migrate_data_dirs(self, pairs=None):
         """Recovery fallback: rename data directories when old→new hash mapping was lost.
 
         This handles the case where the cache was already migrated (old hash values
@@ -120,33 +137,34 @@ class DataModel:
 
         The primary migration path is Cache._migrate_hash_keys() + _rename_data_dirs(),
         which uses precise old→new hash mappings from the cache entries.
+
+        Levels of a project container are checked as they are loaded (pairs).
         """
         data_dir = os.path.join(self.data_dir_path, 'data')
         if not os.path.isdir(data_dir):
             return
         n_renamed = 0
         n_skipped = 0
-        for i in range(len(self)):
-            for level in self.levels:
-                expected_hash = str(self.ssHash(s=level, l=i))
-                level_dir = os.path.join(data_dir, str(i), level)
-                if not os.path.isdir(level_dir):
-                    continue
-                expected_path = os.path.join(level_dir, expected_hash)
-                if os.path.isdir(expected_path):
-                    continue  # Already correct
-                # Collect all hash directories
-                subdirs = [d for d in os.listdir(level_dir)
-                           if os.path.isdir(os.path.join(level_dir, d))]
-                if len(subdirs) == 1:
-                    old_path = os.path.join(level_dir, subdirs[0])
-                    try:
-                        os.rename(old_path, expected_path)
-                        n_renamed += 1
-                    except OSError as e:
-                        logger.warning(f'Failed to rename {old_path} -> {expected_path}: {e}')
-                elif len(subdirs) > 1:
-                    n_skipped += 1
+        for i, level, _ in (self._level_dicts() if pairs is None else pairs):
+            expected_hash = str(self.ssHash(s=level, l=i))
+            level_dir = os.path.join(data_dir, str(i), level)
+            if not os.path.isdir(level_dir):
+                continue
+            expected_path = os.path.join(level_dir, expected_hash)
+            if os.path.isdir(expected_path):
+                continue  # Already correct
+            # Collect all hash directories
+            subdirs = [d for d in os.listdir(level_dir)
+                       if os.path.isdir(os.path.join(level_dir, d))]
+            if len(subdirs) == 1:
+                old_path = os.path.join(level_dir, subdirs[0])
+                try:
+                    os.rename(old_path, expected_path)
+                    n_renamed += 1
+                except OSError as e:
+                    logger.warning(f'Failed to rename {old_path} -> {expected_path}: {e}')
+            elif len(subdirs) > 1:
+                n_skipped += 1
         if n_renamed > 0:
             logger.info(f'Recovered {n_renamed} data directories to deterministic hash names')
         if n_skipped > 0:
@@ -164,15 +182,10 @@ class DataModel:
         self._data['modified'] = date_time()
         self['protected'].setdefault('force_reallocate_zarr_flag', False)
         self['state']['neuroglancer'].setdefault('transformed', False)
+        self['state'].setdefault('swim_backend', cfg.DEFAULT_SWIM_BACKEND)
         # ident = np.array([[1., 0., 0.], [0., 1., 0.]]).tolist()
-        for i in range(len(self)):
-            for level in self.levels:
-                d = self['stack'][i]['levels'][level]
-                if 'saved_swim_settings' in d:
-                    d.pop('saved_swim_settings')
-                d.setdefault('results', {})
-                # self['stack'][i]['levels'][level]['results'].setdefault('mir_afm', ident)
-                # self['stack'][i]['levels'][level].setdefault('alt_cafm', np.array([[1., 0., 0.], [0., 1., 0.]]).tolist())
+        for _, _, d in self._level_dicts():
+            self._upgradeLevel(d)
 
         for level in self.levels:
             if not 'chunkshape' in self['level_data'][level]:
@@ -181,6 +194,38 @@ class DataModel:
                 self['protected']['force_reallocate_zarr_flag'] = True
 
 
+    def _upgradeLevel(self, d):
+        if 'saved_swim_settings' in d:
+            d.pop('saved_swim_settings')
+        if 'swim_settings' in d:
+            # Tracks its own changes, so that its hash is only recomputed after one
+            d['swim_settings'] = SwimSettings(d['swim_settings'])
+        d.setdefault('results', {})
+        # d['results'].setdefault('mir_afm', ident)
+        # d.setdefault('alt_cafm', np.array([[1., 0., 0.], [0., 1., 0.]]).tolist())
+
+    def _level_dicts(self):
+        '''(section, level, level dict) of every level in memory. Levels of a project container
+        that were not accessed yet are not loaded.'''
+        for i, section in enumerate(self['stack']):
+            levels = section['levels']
+            for level, d in (levels.loaded() if hasattr(levels, 'loaded') else levels.items()):
+                yield i, level, d
+
+    def _on_level_load(self, s, added):
+        '''Upgrades the level dicts just loaded from the project container, as if loaded on open.'''
+        for d in added.values():
+            self._upgradeLevel(d)
+        self._migrate_data_dirs(pairs=[(i, s, d) for i, d in added.items()])
+        if s not in self._results:
+            r = container_of(self._data).results(s, len(self['stack']))
+            if r:
+                self._results[s] = r
+        if self._saved is not None:
+            for i, d in added.items():
+                ss = d.get('swim_settings')
+                self._saved['ss'][(i, s)] = (ss, getattr(ss, '_version', None))
+
     def __iter__(self):
         for section in cfg.pt.dm['stack']:
             yield section
@@ -469,6 +514,16 @@ class DataModel:
         return self['stack'][l]['levels'][s]['swim_settings']['method_opts']['quadrants']
 
 
+    @property
+    def swim_backend(self):
+        '''SWIM implementation used to align this project, 'binary' or 'python'.'''
+        return self['state'].get('swim_backend', cfg.DEFAULT_SWIM_BACKEND)
+
+    @swim_backend.setter
+    def swim_backend(self, backend):
+        assert backend in SWIM_BACKENDS
+        self['state']['swim_backend'] = backend
+
     @property
     def poly_order(self):
         return self['level_data'][self.level]['output_settings']['polynomial_bias']
@@ -665,6 +720,69 @@ class DataModel:
         path = os.path.join(self.data_dir_path, 'data', str(l), s, ss_hash, 'matches')
         return path
 
+    def path_swim_store(self, s=None) -> str:
+        if s == None: s = self.level
+        return os.path.join(self.data_dir_path, 'swim', s)
+
+    def swim_store(self, s=None):
+        '''The level's store of kept signals and matches (see swimstore.py), or None.
+        Reopened when an alignment has (re)created or grown it since.'''
+        if s == None: s = self.level
+        path = self.path_swim_store(s=s)
+        try:
+            mtime = os.stat(os.path.join(path, 'written', '.zarray')).st_mtime_ns
+        except OSError:
+            self._swim_stores.pop(s, None)
+            return None
+        cached = self._swim_stores.get(s)
+        if cached and cached[:2] == (path, mtime):
+            return cached[2]
+        try:
+            store = SwimImageStore(path, mode='r')
+        except:
+            print_exception()
+            return None
+        self._swim_stores[s] = (path, mtime, store)
+        return store
+
+    def swim_signals(self, s=None, l=None):
+        '''Correlation signals of the last ingredient of section l by quadrant (None where there is none),
+        from the level's store; None if the store holds none made with the current settings of section l
+        (they are kept as files, or were not kept).'''
+        if s == None: s = self.level
+        if l == None: l = self.zpos
+        store = self.swim_store(s=s)
+        if store is None or not store.holds(l, self.ssHash(s=s, l=l)):
+            return None
+        ing = store.last_ingredient(l)
+        if ing is None:
+            return None
+        return [store.signal(l, ing, q) for q in range(4)]
+
+    def swim_matches(self, s=None, l=None):
+        '''(k, t) match windows of the last ingredient of section l by quadrant (None where there are none),
+        from the level's store; None if the store holds none made with the current settings of section l.'''
+        if s == None: s = self.level
+        if l == None: l = self.zpos
+        store = self.swim_store(s=s)
+        if store is None or not store.holds(l, self.ssHash(s=s, l=l)):
+            return None
+        ing = store.last_ingredient(l)
+        if ing is None:
+            return None
+        return [store.match(l, ing, q) for q in range(4)]
+
+    def clear_swim_images(self, l, s=None):
+        '''Drop the signals and matches of section l from the level's store, if it has one.'''
+        if s == None: s = self.level
+        store = self.swim_store(s=s)
+        if store is None or l >= store.written.shape[0]:
+            return
+        try:
+            SwimImageStore(store.path).clear(l)
+        except:
+            print_exception(extra=f'Unable to clear section {l} of {store.path}')
+
     def dir_tmp(self, s=None, l=None) -> str:
         if s == None: s = self.level
         if l == None: l = self.zpos
@@ -911,12 +1029,13 @@ class DataModel:
         if s == None: s = self.level
         if l == None: l = self.zpos
         self._data['stack'][l]['notes'] = text
+        self._unsaved.add((l, None))
 
     def sl(self):
         return (self.level, self.zpos)
 
     def to_json(self):
-        return json.dumps(self._data)
+        return json.dumps(load_all(self._data))
 
     def to_dict(self):
         return self._data
@@ -1185,13 +1304,13 @@ class DataModel:
 
     def snr_list(self, s=None) -> list[float]:
         try:
-            return [self.snr(s=s, l=i) for i in range(len(self))]
+            return self.results(s=s).snr.tolist()
         except Exception as e:
             logger.warning(f"Failed to create SNR list. Reason: {e.__class__.__name__}")
             return [0] * len(self)
 
     def indexes_to_snr_list(self, indexes, s=None) -> list[float]:
-        return [self.snr(s=s, l=i) for i in indexes]
+        return self.results(s=s).snr[list(indexes)].tolist()
 
 
     def delta_snr_list(self, after, before):
@@ -1232,7 +1351,7 @@ class DataModel:
     def snr_errorbars(self, s=None):
         '''Note Length Of Return Array has size self.n_sections() - 1 (!)'''
         if s == None: s = self.level
-        return np.array([self.snr_errorbar_size(s=s, l=l) for l in range(0, len(self))])
+        return self.results(s=s).snr_std.copy()
 
 
     def check_snr_status(self, s=None) -> list:
@@ -1262,7 +1381,7 @@ class DataModel:
     def snr_lowest(self, n, s=None) -> zip:
         '''Returns the lowest n snr indices '''
         if s == None: s = self.level
-        idx, val = zip(*nsmallest(n + 1, enumerate(self.snr_list()), key=itemgetter(1)))
+        idx, val = zip(*nsmallest(n + 1, enumerate(self.snr_list(s=s)), key=itemgetter(1)))
         return zip(idx[1:], val[1:])
 
 
@@ -1390,36 +1509,66 @@ class DataModel:
     def afm_list(self, s=None, l=None) -> list:
         '''Returns a list of affine transformation matrices for all sections at the current level'''
         if s == None: s = self.level
-        lst = [self.afm(s=s, l=l) for l in range(len(self))]
-        return lst
+        return self.results(s=s).afm.tolist()
 
     def alt_cafm_list(self, s=None, end=None) -> list:
         '''Returns a list of cumulative affine transformation matrices for all sections at the current level'''
         if s == None: s = self.level
-        if end == None:
-            end = len(self)
-        lst = []
-        for i in range(0,end):
-            if i < end:
-                lst.append(self.alt_cafm(s=s, l=i))
-        return lst
+        return self.results(s=s).alt_cafm[:end].tolist()
 
     def cafm_list(self, s=None, end=None) -> list:
         '''Returns a list of cumulative affine transformation matrices for all sections at the current level'''
         if s == None: s = self.level
-        if end == None:
-            end = len(self)
-        lst = []
-        for i in range(0,end):
-            if i < end:
-                lst.append(self.cafm(s=s, l=i))
-        return lst
+        return self.results(s=s).cafm[:end].tolist()
+
+    def set_stack_cafm(self, s=None, full=False):
+        '''Sets the cumulative affine transformation matrices for all sections at the current level.
+        Without polynomial bias, only sections from the first one passed to cafm_changed() are recomputed.'''
+        if s == None: s = self.level
+        start = self._cafm_dirty.pop(s, None)
+        if self.poly_order != None:
+            self._unsaved.update((l, s) for l in range(len(self['stack'])))
+            self._cafm_cache.pop(s, None)
+            afms = StackAfms(self, s)
+            alt_cafms = self.results(s=s).alt_cafm
+            SetStackCafm(self, scale=s, poly_order=self.poly_order, afms=afms, alt_cafms=alt_cafms)
+            alt_SetStackCafm(self, scale=s, poly_order=self.poly_order, afms=afms)
+            if s in self._results:
+                self._results[s].mark_cafm()
+            return
+        if full or s not in self._cafm_cache:
+            start = 0
+            self._cafm_cache[s] = UpdateStackCafm(self, s, {})
+        elif start != None:
+            UpdateStackCafm(self, s, self._cafm_cache[s], start=start)
+        else:
+            return
+        self._unsaved.update((l, s) for l in range(start, len(self['stack'])))
+        if s in self._results and self._results[s].n == len(self._cafm_cache[s]['cafm']):
+            self._results[s].set_cafm(self._cafm_cache[s]['cafm'], self._cafm_cache[s]['alt_cafm'], start=start)
+
+    def results(self, s=None) -> LevelResults:
+        '''Returns the columnar numeric results of level s, brought up to date with the stack'''
+        if s == None: s = self.level
+        n = len(self['stack'])
+        if s not in self._results or self._results[s].n != n:
+            container = container_of(self._data)
+            r = container.results(s, n) if container and s in container.pending else None
+            self._results[s] = r or LevelResults(n)
+        return self._results[s].refresh(self['stack'], s)
 
-    def set_stack_cafm(self, s=None):
-        '''Sets the cumulative affine transformation matrices for all sections at the current level'''
+    def results_changed(self, l, s=None):
+        '''Marks the results of section l as changed, and with them the cafms of section l onward'''
         if s == None: s = self.level
-        SetStackCafm(self, scale=s, poly_order=self.poly_order)
-        alt_SetStackCafm(self, scale=s, poly_order=self.poly_order)
+        if s in self._results:
+            self._results[s].mark(l)
+        self._unsaved.add((l, s))
+        self.cafm_changed(l, s=s)
+
+    def cafm_changed(self, l, s=None):
+        '''Marks the cafms of section l onward as out of date, after its afm or include changed'''
+        if s == None: s = self.level
+        self._cafm_dirty[s] = min(self._cafm_dirty.get(s, l), l)
 
     def _reset_section_results(self, index, s=None):
         '''Resets alignment results for a single section to identity values.'''
@@ -1434,6 +1583,8 @@ class DataModel:
         }
         for key in ('mir_afm', 'mir_aim', 'affine_matrix', 'snr', 'alt_cafm'):
             sec.pop(key, None)
+        self.results_changed(index, s=s)
+        self.clear_swim_images(index, s=s)
 
     def replace_image(self, index, new_source_path):
         '''Replace a single image in the stack. Returns (success: bool, message: str).'''
@@ -1542,8 +1693,16 @@ class DataModel:
         if not self.is_zarr_generated(s=s):
             return list(range(len(self)))
 
+        # Same test as zarrCafmHashComports, with the Zarr attributes read once
+        zattrs = zarr.open(os.path.join(self.data_dir_path, 'zarr', s)).attrs.asdict()
+        fu = self.first_included(s=s)
         for i in range(len(self)):
-            if not self.zarrCafmHashComports(s=s, l=i):
+            if i == fu:
+                continue
+            try:
+                if zattrs[str(i)][1] != str(self.cafmHash(s=s, l=i)):
+                    answer.append(i)
+            except KeyError:
                 answer.append(i)
 
             # if self.include(s=s, l=i):
@@ -1551,9 +1710,12 @@ class DataModel:
             #     if not os.file_path.exists(self.path_aligned_cafm(s=s, l=i)):
             #         answer.append(i)
 
-        data_dn_comport = self.needsAlignIndexes()
+        data_dn_comport = self.needsAlignIndexes(s=s)
+        if s in self._cafm_dirty:
+            data_dn_comport.append(self._cafm_dirty[s])
         if len(data_dn_comport):
-            '''If there are any sections that need to be aligned, add them to the list of sections that need to be generated'''
+            '''If there are any sections that need to be aligned (or whose cafm is not yet recomputed), add them
+            and the sections after them to the list of sections that need to be generated'''
             sweep = list(range(min(data_dn_comport),len(self)))
             answer = list(set(answer) | set(sweep))
 
@@ -1629,6 +1791,7 @@ class DataModel:
         if l == None: l = self.zpos
         '''Sets the Bounding Rectangle On/Off State for the Current Scale.'''
         self.SS['include'] = b
+        self.cafm_changed(self.zpos)
         self.signals.swimArgsChanged.emit()
 
     def skips_list(self, level=None) -> list:
@@ -1675,16 +1838,26 @@ class DataModel:
         '''Returns SWIM preferences as a hashable dictionary'''
         if s == None: s = self.level
         if l == None: l = self.zpos
-        return HashableDict(self._data['stack'][l]['levels'][s]['swim_settings'])
+        return HashableDict.of(self._swim_settings(s, l))
         # return self._data['stack'][l]['levels'][s]['swim_settings']
 
+    def _swim_settings(self, s, l):
+        '''The SwimSettings of a section, converting settings that were assigned as a plain dict.'''
+        d = self._data['stack'][l]['levels'][s]
+        ss = d['swim_settings']
+        if not isinstance(ss, SwimSettings):
+            ss = d['swim_settings'] = SwimSettings(ss)
+        return ss
+
 
     def ssHash(self, s=None, l=None):
         '''Constructs a hash from the SWIM settings for a given section and scale level.'''
         if s == None: s = self.level
         if l == None: l = self.zpos
         # return abs(hash(HashableDict(self.swim_settings(s=s, l=l))))
-        return hash(self.swim_settings(s=s, l=l))
+        # hash() of the memoized digest, as Python reduces a __hash__ value of 2**63 or more;
+        # the value names data directories and is stored in the zarr attributes
+        return hash(HashableDict.of(self._swim_settings(s, l)))
 
 
 
@@ -1902,7 +2075,9 @@ class DataModel:
 
     def set_calculate_bounding_rect(self, s=None):
         if s == None: s = self.level
-        dims = ComputeBoundingRect(self)
+        if s in self._cafm_dirty:
+            self.set_stack_cafm(s=s)
+        dims = ComputeBoundingRect(self, scale=s, cache=self._cafm_cache.get(s))
         self['level_data'][s]['output_settings']['bounding_box']['dims'] = dims
         return dims
 
@@ -2127,8 +2302,9 @@ class DataModel:
                 prev_settings.pop('init_afm')
                 prev_settings.pop('img_size')
                 prev_settings.pop('is_refinement')
-                self['stack'][i]['levels'][cur_level]['swim_settings'] = prev_settings
+                self['stack'][i]['levels'][cur_level]['swim_settings'] = SwimSettings(prev_settings)
                 ss = self['stack'][i]['levels'][cur_level]['swim_settings']
+                self.cafm_changed(i, s=cur_level)  # include is copied from prev_level
 
                 ss['level'] = cur_level
                 ss['img_size'] = self.image_size(cur_level)
@@ -2253,6 +2429,7 @@ class DataModel:
                 'tra_ref_toggle': 'tra',
                 'targ_karg_toggle': 1,
                 'annotate_match_signals': True,
+                'swim_backend': cfg.DEFAULT_SWIM_BACKEND,
             },
             rendering={
                 'normalize': [1, 255],
@@ -2347,12 +2524,22 @@ class DataModel:
 
 
     def save(self, silently=False):
+        '''Saves the project. With PROJECT_JOURNAL, silent saves only append the sections that changed
+        to the project journal (see journal.py); other saves write the whole project.'''
         clr = inspect.stack()[1].function
         p = self.data_file_path
+        if self._journal is None or self._journal.path != str(p):
+            self._journal = Journal(p)
+            self._saved = None
+        incremental = silently and cfg.PROJECT_JOURNAL and self._saved is not None and \
+                      self._saved['n'] == len(self['stack'])
         if hasattr(self, 'ht'):
             if type(self.ht) == Cache:
                 try:
-                    self.ht.pickle()
+                    if incremental:
+                        self.ht.flush()
+                    else:
+                        self.ht.pickle()
                 except Exception as e:
                     print_exception()
                     cfg.mw.warn(f"[{clr}] Cache failed to save; this is not fatal. Reason: {e.__class__.__name__}")
@@ -2364,8 +2551,13 @@ class DataModel:
                 cfg.mw.tell(f"Saving '{p}'...")
                 logger.critical(f"[{clr}]\nSaving >> '{p}'")
             try:
-                write('json')(p, self._data)
-            except:
+                if incremental:
+                    self._save_journal()
+                else:
+                    results = {s: self.results(s) for s in list(self._results)} if cfg.PROJECT_BINARY else None
+                    self._journal.write_full(self._data, results=results)
+                    self._mark_saved()
+            except Exception as e:
                 if not silently:
                     cfg.mw.err(f"[{clr}] Unable to save to file. Reason: {e.__class__.__name__}")
                 print_exception()
@@ -2381,6 +2573,50 @@ class DataModel:
         else:
             logger.info(f"Save successful!")
 
+    def _top(self):
+        return {k: v for k, v in self._data.items() if k != 'stack'}
+
+    def _settings_versions(self):
+        '''(swim settings, version) of every section and level; replaced or mutated settings differ.'''
+        versions = {}
+        for l, s, lvl in self._level_dicts():
+            ss = lvl.get('swim_settings')
+            versions[(l, s)] = (ss, getattr(ss, '_version', None))
+        return versions
+
+    def _mark_saved(self):
+        self._saved = {'n': len(self['stack']),
+                       'top': json.dumps(self._top(), ensure_ascii=False),
+                       'ss': self._settings_versions()}
+        self._unsaved = set()
+
+    def _save_journal(self):
+        '''Append the level dicts and section keys changed since the last save (and the top-level keys,
+        if changed) to the journal.'''
+        t0 = time.time()
+        changed = set(self._unsaved)
+        versions = self._settings_versions()
+        for k, (ss, v) in versions.items():
+            saved = self._saved['ss'].get(k)
+            if saved is None or saved[0] is not ss or saved[1] != v:
+                changed.add(k)
+        top = json.dumps(self._top(), ensure_ascii=False)
+        if not changed and top == self._saved['top']:
+            return
+        rec = {'t': time.time()}
+        if top != self._saved['top']:
+            rec['top'] = self._top()
+        stack = self['stack']
+        rec['levels'] = [[l, s, stack[l]['levels'][s]] for l, s in sorted(k for k in changed if k[1] != None)]
+        rec['sections'] = [[l, {k: v for k, v in stack[l].items() if k != 'levels'}]
+                           for l in sorted({l for l, s in changed if s == None})]
+        self._journal.append(rec)
+        self._saved['top'] = top
+        self._saved['ss'] = versions
+        self._unsaved = set()
+        logger.info(f"Journaled {len(rec['levels'])} level(s) of sections, {len(rec['sections'])} section(s)"
+                    f"{', top-level keys' if 'top' in rec else ''} in {time.time() - t0:.3g}s")
+
     def setZarrMade(self, b, s=None):
         if s == None: s = self.level
         self['level_data'][s]['zarr_made'] = b
@@ -2473,12 +2709,216 @@ def _normalize(obj):
     return obj
 
 
+def _digest(d):
+    '''Deterministic unsigned 64-bit hash of a dictionary, stable across Python sessions.'''
+    s = str(sorted(_normalize(d).items())).encode('utf-8')
+    return int(hashlib.sha256(s).hexdigest(), 16) % (2**64)
+
+
+class _Tracked:
+    '''Containers inside SwimSettings: every mutation bumps the version of the root settings.'''
+    _root = None
+
+    def _touch(self):
+        if self._root is not None:
+            self._root._version += 1
+
+
+def _track(value, root):
+    '''value as a container tracked by root (copied if it belongs to other settings).'''
+    if isinstance(value, _Tracked) and value._root is root:
+        return value
+    if isinstance(value, dict):
+        return _TrackedDict(value, root)
+    if isinstance(value, list):
+        return _TrackedList(value, root)
+    return value
+
+
+class _TrackedDict(_Tracked, dict):
+
+    def __init__(self, data=(), root=None):
+        dict.__init__(self)
+        self._root = root
+        for k, v in dict(data).items():
+            dict.__setitem__(self, k, _track(v, root))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, _track(value, self._root))
+        self._touch()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._touch()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            dict.__setitem__(self, k, _track(v, self._root))
+        self._touch()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, *args):
+        self._touch()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._touch()
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._touch()
+
+    def __reduce__(self):
+        # Copies and pickles are plain dictionaries
+        return dict, (dict(self),)
+
+
+class _TrackedList(_Tracked, list):
+
+    def __init__(self, data=(), root=None):
+        list.__init__(self, (_track(v, root) for v in data))
+        self._root = root
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            value = [_track(v, self._root) for v in value]
+        else:
+            value = _track(value, self._root)
+        list.__setitem__(self, i, value)
+        self._touch()
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self._touch()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self._touch()
+        return self
+
+    def append(self, value):
+        list.append(self, _track(value, self._root))
+        self._touch()
+
+    def extend(self, values):
+        list.extend(self, [_track(v, self._root) for v in values])
+        self._touch()
+
+    def insert(self, i, value):
+        list.insert(self, i, _track(value, self._root))
+        self._touch()
+
+    def pop(self, *args):
+        self._touch()
+        return list.pop(self, *args)
+
+    def remove(self, value):
+        list.remove(self, value)
+        self._touch()
+
+    def clear(self):
+        list.clear(self)
+        self._touch()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._touch()
+
+    def reverse(self):
+        list.reverse(self)
+        self._touch()
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+class SwimSettings(_TrackedDict):
+    '''The swim_settings of one section and level. Its hash (digest()) is computed once and kept
+    until the settings change, which any mutation of them, however deeply nested, records.'''
+
+    def __init__(self, data=()):
+        self._version = 0
+        self._digest = None
+        self._digest_version = -1
+        _TrackedDict.__init__(self, data, root=self)
+
+    def digest(self):
+        if self._digest_version != self._version:
+            self._digest = _digest(self)
+            self._digest_version = self._version
+        return self._digest
+
+
 class HashableDict(dict):
     ''' A hashable dictionary with a deterministic unsigned integer hash value.'''
+    _source = None  # SwimSettings this is an unchanged copy of
+    _source_version = None
+
+    @classmethod
+    def of(cls, settings):
+        '''Copy of settings whose hash is that of settings, for as long as neither changes.'''
+        h = cls(settings)
+        h._source = settings
+        h._source_version = settings._version
+        return h
+
     def __hash__(self):
         '''Return a deterministic hash of the dictionary, stable across Python sessions.'''
-        s = str(sorted(_normalize(self).items())).encode('utf-8')
-        return int(hashlib.sha256(s).hexdigest(), 16) % (2**64)
+        src = self._source
+        if src is not None and src._version == self._source_version:
+            return src.digest()
+        return _digest(self)
+
+    def _detach(self):
+        self._source = None
+
+    def __setitem__(self, key, value):
+        self._detach()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._detach()
+        dict.__delitem__(self, key)
+
+    def __ior__(self, other):
+        self._detach()
+        return dict.__ior__(self, other)
+
+    def update(self, *args, **kwargs):
+        self._detach()
+        dict.update(self, *args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        self._detach()
+        return dict.setdefault(self, key, default)
+
+    def pop(self, *args):
+        self._detach()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._detach()
+        return dict.popitem(self)
+
+    def clear(self):
+        self._detach()
+        dict.clear(self)
+
+    def __reduce__(self):
+        return HashableDict, (dict(self),)
 
 
 class HashableList(list):
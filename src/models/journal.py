@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+'''
+Incremental saves of a project.
+
+With PROJECT_JOURNAL, DataModel.save(silently=True) (called after most UI
+actions and after every align and generate) no longer rewrites the whole
+project. It appends one line to <project>.journal holding the level dicts of
+the sections that changed, and the top-level keys if they changed. Once the
+journal has JOURNAL_COMPACT_RECORDS records, or JOURNAL_COMPACT_SECONDS after
+the project file was last written, a background thread folds it into the
+project file: the journal is renamed to <project>.journal.compacting and
+replayed onto the file on disk, which is then replaced (in the format it
+is in, JSON or container, see container.py). The project in memory is not
+touched. Explicit saves and closing write the whole project as before (as a
+container with PROJECT_BINARY) and discard the journal.
+
+read_project() replays <project>.journal.compacting (a compaction that did
+not finish) and then <project>.journal over the JSON document or container.
+Records replace whole dicts, so a record replayed twice does no harm.
+
+'''
+import json
+import logging
+import os
+import threading
+import time
+
+import src.config as cfg
+from src.models.container import is_container, load_all, read_container, write_container
+from src.utils.readers import read
+
+__all__ = ['Journal', 'read_project', 'write_project', 'replay']
+
+logger = logging.getLogger(__name__)
+
+
+def read_project(path):
+    '''The project at path as last saved, including its journal.'''
+    if is_container(path):
+        try:
+            data = read_container(path)
+        except Exception as e:
+            logger.warning(f"Unable to read container: {path}. Reason: {e.__class__.__name__}")
+            return None
+    else:
+        data = read('json')(path)
+    if data:
+        replay(data, path)
+    return data
+
+
+def replay(data, path):
+    '''Apply the journal records of the project at path to data. Returns the number of records.'''
+    n = 0
+    for p in (f'{path}.journal.compacting', f'{path}.journal'):
+        if not os.path.exists(p):
+            continue
+        with open(p, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    logger.warning(f'Ignoring a truncated record at the end of {p}')
+                    break
+                _apply(data, rec)
+                n += 1
+    if n:
+        logger.info(f'Replayed {n} journal records of {path}')
+    return n
+
+
+def _apply(data, rec):
+    if 'top' in rec:
+        data.update(rec['top'])
+    for l, s, d in rec.get('levels', []):
+        data['stack'][l]['levels'][s] = d
+    for l, d in rec.get('sections', []):
+        data['stack'][l].update(d)
+
+
+def write_project(path, data, binary=None, results=None):
+    '''Write the whole project atomically, as a container if binary (default: PROJECT_BINARY)
+    and as JSON otherwise. results: {level: LevelResults} to reuse for a container.'''
+    if cfg.PROJECT_BINARY if binary is None else binary:
+        write_container(path, data, results=results)
+    else:
+        _write(path, data)
+
+
+def _write(path, data):
+    load_all(data)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+class Journal:
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.journal = f'{self.path}.journal'
+        self.compacting = f'{self.path}.journal.compacting'
+        self.n_records = 0
+        self.t_written = time.time()
+        self._lock = threading.Lock()  # appends vs. renaming the journal
+        self._write_lock = threading.Lock()  # writes of the project file
+        self._thread = None
+        if os.path.exists(self.journal):
+            with open(self.journal, 'rb+') as f:
+                content = f.read()
+                if content and not content.endswith(b'\n'):
+                    # Drop a record cut short by a crash, so that appended records start on their own line
+                    f.truncate(content.rfind(b'\n') + 1)
+            self.n_records = content.count(b'\n')
+
+    def append(self, rec):
+        line = json.dumps(rec, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            with open(self.journal, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+            self.n_records += 1
+        if self.n_records >= cfg.JOURNAL_COMPACT_RECORDS or \
+                time.time() - self.t_written > cfg.JOURNAL_COMPACT_SECONDS:
+            self.compact()
+
+    def compact(self):
+        '''Fold the journal into the project file in a background thread.'''
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._compact, daemon=True)
+        self._thread.start()
+
+    def _compact(self):
+        t0 = time.time()
+        with self._write_lock:
+            with self._lock:
+                if not os.path.exists(self.compacting):
+                    if not os.path.exists(self.journal):
+                        return
+                    os.replace(self.journal, self.compacting)
+                    self.n_records = 0
+            try:
+                binary = is_container(self.path)
+                data = read_container(self.path) if binary else read('json')(self.path)
+                n = 0
+                with open(self.compacting, encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            _apply(data, json.loads(line))
+                        except ValueError:
+                            break
+                        n += 1
+                write_project(self.path, data, binary=binary)
+                os.remove(self.compacting)
+                self.t_written = time.time()
+                logger.info(f'Compacted {n} journal records into {self.path} in {time.time() - t0:.3g}s')
+            except:
+                logger.warning(f'Unable to compact the journal of {self.path}; it is kept and replayed on open')
+
+    def write_full(self, data, results=None):
+        '''Write the whole project and discard the journal it supersedes.'''
+        with self._write_lock:
+            write_project(self.path, data, results=results)
+            with self._lock:
+                for p in (self.journal, self.compacting):
+                    try:
+                        os.remove(p)
+                    except FileNotFoundError:
+                        pass
+                self.n_records = 0
+            self.t_written = time.time()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+'''
+Columnar copy of the numeric results of one level.
+
+The stack dicts remain the source of truth (they are what a project saves).
+LevelResults keeps the afm, cafm, alt_cafm, SNR and per-ingredient timings of
+every section of a level in contiguous NumPy arrays, so that lists, plots and
+bias fitting over the whole stack do not walk the dicts section by section.
+Rows are re-read from the dicts once the DataModel marks them as changed
+(results_changed); cafm rows are copied from set_stack_cafm.
+
+'''
+import logging
+import statistics
+
+import numpy as np
+
+__all__ = ['LevelResults']
+
+logger = logging.getLogger(__name__)
+
+_IDENTITY = np.array([[1., 0., 0.], [0., 1., 0.]])
+
+
+class LevelResults:
+
+    def __init__(self, n):
+        self.n = n
+        self.afm = np.tile(_IDENTITY, (n, 1, 1))
+        self.cafm = np.tile(_IDENTITY, (n, 1, 1))
+        self.alt_cafm = np.tile(_IDENTITY, (n, 1, 1))
+        self.snr = np.zeros(n)  # mean of the SNR components, as DataModel.snr()
+        self.snr_std = np.zeros(n)
+        self.snr_components = np.full((n, 0), np.nan)  # padded with NaN
+        self.t_swim = np.full((n, 0), np.nan)  # per ingredient, padded with NaN
+        self.t_mir = np.full((n, 0), np.nan)
+        self._stale = set(range(n))
+        self._stale_cafm = set(range(n))
+
+    @classmethod
+    def of(cls, arrays):
+        '''Results whose columns are the given arrays (e.g. mapped from a project container), up to date.'''
+        r = cls.__new__(cls)
+        r.n = len(arrays['afm'])
+        for name, a in arrays.items():
+            setattr(r, name, a)
+        r._stale = set()
+        r._stale_cafm = set()
+        return r
+
+    def mark(self, l):
+        '''Re-read the results and cafms of section l on the next refresh'''
+        self._stale.add(l)
+        self._stale_cafm.add(l)
+
+    def mark_cafm(self, start=0):
+        '''Re-read the cafms of sections start.. on the next refresh'''
+        self._stale_cafm.update(range(start, self.n))
+
+    def set_cafm(self, cafms, alt_cafms, start=0):
+        '''Copy the (N,3,3) cafm arrays computed by UpdateStackCafm for sections start..'''
+        self.cafm[start:] = cafms[start:, :2]
+        self.alt_cafm[start:] = alt_cafms[start:, :2]
+        self._stale_cafm.difference_update(range(start, self.n))
+
+    def refresh(self, stack, s):
+        if self._stale:
+            for l in self._stale:
+                self._read(stack[l]['levels'][s], l)
+            logger.debug(f'Refreshed results of {len(self._stale)} sections at {s}')
+            self._stale = set()
+        if self._stale_cafm:
+            for l in self._stale_cafm:
+                lvl = stack[l]['levels'][s]
+                self.cafm[l] = _matrix(lvl.get('cafm'))
+                self.alt_cafm[l] = _matrix(lvl.get('alt_cafm'))
+            self._stale_cafm = set()
+        return self
+
+    def _read(self, lvl, l):
+        self.afm[l] = _matrix(lvl.get('mir_afm'))
+        r = lvl.get('results') or {}
+        components = r.get('snr')
+        try:
+            self.snr[l] = components if type(components) == float else statistics.fmean(map(float, components))
+        except:
+            self.snr[l] = 0.
+        if type(components) != list:
+            components = [] if components is None else [components]
+        self._put('snr_components', l, components)
+        try:
+            self.snr_std[l] = float(r.get('snr_std_deviation', 0.))
+        except:
+            self.snr_std[l] = 0.
+        ings = sorted((k for k in r if k.startswith('ing') and k[3:].isdigit()), key=lambda k: int(k[3:]))
+        for key in ('t_swim', 't_mir'):
+            self._put(key, l, [r[k].get(key, np.nan) if isinstance(r[k], dict) else np.nan for k in ings])
+
+    def _put(self, name, l, values):
+        '''Set row l of a NaN-padded 2D column, widening it if needed'''
+        a = getattr(self, name)
+        try:
+            values = np.asarray(values, dtype='float64').ravel()
+        except:
+            values = np.empty(0)
+        if len(values) > a.shape[1]:
+            a = np.hstack((a, np.full((self.n, len(values) - a.shape[1]), np.nan)))
+            setattr(self, name, a)
+        a[l] = np.nan
+        a[l, :len(values)] = values
+
+
+def _matrix(m):
+    try:
+        return np.asarray(m, dtype='float64').reshape(2, 3)
+    except:
+        return _IDENTITY
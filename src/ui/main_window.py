@@ -34,6 +34,8 @@ import src.config as cfg
 import src.resources.icons_rc
 import src.shaders.shaders
 from src.workers.scale import ScaleWorker
+from src.core.poolservice import PoolService
+from src.core.dispatch import DispatchService
 from src.workers.align import AlignWorker
 from src.workers.generate import ZarrWorker
 from src.utils.helpers import getData, print_exception, get_scale_val, \
@@ -373,6 +375,24 @@ class MainWindow(QMainWindow):
         self.pm = None
         self.pt = None
 
+        # Warm worker pool shared by the scale, align and generate stages (see poolservice.py)
+        self.pool = None
+        if cfg.USE_POOL_SERVICE:
+            try:
+                self.pool = PoolService(log_quiet=cfg.LOG_HOT_PATH_QUIET)
+            except:
+                print_exception()
+                logger.warning('Unable to start the worker pool service, stages will start their own pools')
+
+        # Align and generate tasks can instead be run by agents on other nodes (see dispatch.py)
+        self.dispatcher = None
+        if cfg.DISPATCH_QUEUE_DIR:
+            try:
+                self.dispatcher = DispatchService(cfg.DISPATCH_QUEUE_DIR, local_agents=cfg.DISPATCH_LOCAL_AGENTS)
+            except:
+                print_exception()
+                logger.warning(f'Unable to use the task queue {cfg.DISPATCH_QUEUE_DIR}, running stages locally')
+
         # self.uiUpdateTimer = QTimer()
         # self.uiUpdateTimer.setSingleShot(True)
         # self.uiUpdateTimer.timeout.connect(self.dataUpdateWidgets)
@@ -578,7 +598,11 @@ class MainWindow(QMainWindow):
                 caller = inspect.stack()[1].function
                 # logger.info(f'[{caller}]')
 
-                thumbs = self.dm.get_signals_filenames(l=z)
+                signals = self.dm.swim_signals(l=z)  # None unless they are kept in the level's store
+                if signals is None:
+                    thumbs = self.dm.get_signals_filenames(l=z)
+                else:
+                    thumbs = [sig for sig in signals if sig is not None]
                 snr_vals = copy.deepcopy(self.dm.snr_components(l=z))
                 # logger.info(f'snr_vals = {snr_vals}')
                 count = 0
@@ -590,7 +614,7 @@ class MainWindow(QMainWindow):
                 # if method == 'grid_custom':
                 if method == 'grid':
                     regions = self.dm.quadrants
-                    names = self.dm.get_grid_filenames(l=z)
+                    names = signals or self.dm.get_grid_filenames(l=z)
                     # logger.critical(f'# names: {len(names)}')
                     # logger.critical(f'snr vals: {snr_vals}')
                     # logger.critical(f'name:\n{names}')
@@ -626,9 +650,12 @@ class MainWindow(QMainWindow):
                 elif method == 'manual':
                     #Todo #mode check mode for hint vs strict
                     indexes = []
-                    for n in thumbs:
-                        fn, _ = os.path.splitext(n)
-                        indexes.append(int(fn[-1]))
+                    if signals is None:
+                        for n in thumbs:
+                            fn, _ = os.path.splitext(n)
+                            indexes.append(int(fn[-1]))
+                    else:
+                        indexes = [i for i, sig in enumerate(signals) if sig is not None]
 
                     for i in range(0,4):
                         if i in indexes:
@@ -694,14 +721,20 @@ class MainWindow(QMainWindow):
 
                 # logger.info(f'Files:\n{files}')
 
+                matches = self.dm.swim_matches(l=z)  # None unless they are kept in the level's store
+                if matches is None:
+                    images = [path if os.path.exists(path) else None for _, path in files]
+                else:
+                    images = [None if m is None else m[('k', 't').index(tkarg)] for m in matches]
+
                 if method == 'grid':
                     # for i in range(n_cutouts):
                     for i in range(0, 4):
                         use = self.dm.quadrants[i]
 
                         # logger.info(f'file  : {files[i]}  exists? : {os.file_path.exists(files[i])}  use? : {use}')
-                        path = os.path.join(self.dm.data_dir_path, 'matches', self.dm.scale, files[i][1])
-                        if use and os.path.exists(path):
+                        path = images[i]
+                        if use and path is not None:
                             self.pt.matchesList[i].path = path
                             try:
                                 # self.pt.matchesList[i].showPixmap()
@@ -715,8 +748,8 @@ class MainWindow(QMainWindow):
                 if self.dm.current_method == 'manual':
                     # self.pt.matchesList[3].hide()
                     for i in range(0, 3):
-                        path = os.path.join(self.dm.data_dir_path, 'matches', self.dm.scale, files[i][1])
-                        if os.path.exists(path):
+                        path = images[i]
+                        if path is not None:
                             self.pt.matchesList[i].path = path
                             self.pt.matchesList[i].set_data(path)
                         else:
@@ -1058,7 +1091,8 @@ class MainWindow(QMainWindow):
             if dm.is_aligned():
                 logger.info('Regenerating Zarr...')
                 self._zarrThread = QThread()
-                self._zarrworker = ZarrWorker(dm=dm, renew=renew, ignore_cache=_ignore_cache)
+                self._zarrworker = ZarrWorker(dm=dm, renew=renew, ignore_cache=_ignore_cache,
+                                              pool=self.dispatcher or self.pool)
                 self._zarrThread.started.connect(self._zarrworker.run)  # Step 5: Connect signals and slots
                 self._zarrThread.finished.connect(self._zarrThread.deleteLater)
                 self._zarrworker.moveToThread(self._zarrThread)  # Step 4: Move worker to the thread
@@ -1133,6 +1167,7 @@ class MainWindow(QMainWindow):
             indexes=indexes,
             prev_snr=self._snr_before,
             ignore_cache=_ignore_cache,
+            pool=self.dispatcher or self.pool,
         )  # Step 3: Create a worker object
         self._alignworker.progress.connect(self.setPbar)
         self._alignworker.initPbar.connect(self.resetPbar)
@@ -1164,7 +1199,7 @@ class MainWindow(QMainWindow):
 
         self.resetPbar((-1, "Preparing worker thread..."))
 
-        self._scaleworker = ScaleWorker(src=src, out=out, scales=scales, opts=opts)
+        self._scaleworker = ScaleWorker(src=src, out=out, scales=scales, opts=opts, pool=self.pool)
         self._scaleThread.started.connect(self._scaleworker.run)  # Step 5: Connect signals and slots
         self._scaleThread.finished.connect(self._scaleThread.deleteLater)
         self._scaleworker.finished.connect(self._scaleThread.quit)
@@ -1922,6 +1957,20 @@ class MainWindow(QMainWindow):
         #     print_exception()
         #     self.warn('Having trouble shutting down Python console kernel')
 
+        if self.dispatcher:
+            try:
+                self.dispatcher.shutdown()
+            except:
+                print_exception()
+
+        if self.pool:
+            self.tell('Stopping Worker Pool...')
+            try:
+                self.pool.shutdown()
+            except:
+                print_exception()
+                self.warn('Having trouble shutting down the worker pool')
+
         self.tell('Graceful, Goodbye!')
         # time.sleep(1)
         QApplication.quit()
@@ -25,6 +25,7 @@ from qtpy.QtWidgets import *
 
 import src.config as cfg
 from src.models.data import DataModel
+from src.models.journal import read_project
 from src.utils.funcs_image import ImageSize
 from src.utils.helpers import print_exception, natural_sort, is_tacc, is_joel, hotkey, derive_search_paths
 from src.ui.dialogs.importimages import ImportImagesDialog
@@ -477,7 +478,7 @@ class ManagerTab(QWidget):
     def _getUUID(self, path):
         # uuid = ''
         if os.path.exists(path):
-            data = read('json')(path) # returns None if not valid JSON
+            data = read_project(path) # returns None if not a valid project
             if isinstance(data, dict):
                 try:
                     uuid = data['info']['images_uuid']
@@ -944,7 +945,7 @@ class ManagerTab(QWidget):
         # Load alignment data model if a remembered alignment is selected
         if self.comboTransformed.currentText():
             try:
-                self.dm = DataModel(data=read('json')(self.comboTransformed.currentText()), readonly=True)
+                self.dm = DataModel(data=read_project(self.comboTransformed.currentText()), readonly=True)
             except:
                 self.dm = None
                 print_exception()
@@ -1023,7 +1024,7 @@ class ManagerTab(QWidget):
         logger.info('')
         cfg.preferences['alignment_combo_text'] = self.comboTransformed.currentText()
         try:
-            self.dm = DataModel(data=read('json')(self.comboTransformed.currentText()), readonly=True)
+            self.dm = DataModel(data=read_project(self.comboTransformed.currentText()), readonly=True)
         except:
             self.dm = None
             print_exception()
@@ -1119,7 +1120,7 @@ class ManagerTab(QWidget):
                 return
 
             self.parent.tell(f"Opening: {file_path}...")
-            data = read('json')(file_path)
+            data = read_project(file_path)
             dm = DataModel(
                 data=data,
                 file_path=file_path,
@@ -353,7 +353,7 @@ class ProjectTable(QWidget):
         # sig1 = os.file_path.join(dir_signals, '%s_%s_1%s' % (fn, method, extension))
         # sig2 = os.file_path.join(dir_signals, '%s_%s_2%s' % (fn, method, extension))
         # sig3 = os.file_path.join(dir_signals, '%s_%s_3%s' % (fn, method, extension))
-        sigs = self.dm.get_enum_signals_filenames(s=s, l=l)
+        sigs = self.dm.swim_signals(s=s, l=l) or self.dm.get_enum_signals_filenames(s=s, l=l)
         notes = self.dm.notes(s=s,l=l)
         try:
             last_aligned = self.dm['stack'][l]['levels'][s]['results']['datetime']
@@ -17,6 +17,22 @@ import src.config as cfg
 logger = logging.getLogger(__name__)
 
 
+def load_image(src):
+    '''QImage of an image file, or of a 2-D uint8 array (a signal or match window read from a level's
+    swim store).'''
+    if isinstance(src, np.ndarray):
+        a = np.ascontiguousarray(src, dtype=np.uint8)
+        h, w = a.shape
+        return QImage(a.data, w, h, w, QImage.Format_Grayscale8).copy()
+    return QImage(src)
+
+
+def image_size(src):
+    if isinstance(src, np.ndarray):
+        return [src.shape[1], src.shape[0]]
+    return ImageSize(src)
+
+
 class ThumbnailFast(QLabel):
     clicked = Signal(QMouseEvent)
     left_click = Signal(float, float)
@@ -72,15 +88,16 @@ class ThumbnailFast(QLabel):
     def showPixmap(self):
         self._noImage = 0
         # self.setPixmap(QPixmap(self.file_path))
-        self.setPixmap(QPixmap.fromImage(QImage(self.path)))
+        self.setPixmap(QPixmap.fromImage(load_image(self.path)))
         # self.update()
 
     def set_data(self, path):
+        '''path: image file, or 2-D uint8 array'''
         # logger.critical('')
         self._noImage = 0
         self.path = path
         try:
-            img = QImage(path)
+            img = load_image(path)
             if img.isNull():
                 self.set_no_image()
                 return
@@ -341,12 +358,12 @@ class CorrSignalThumbnail(QLabel):
         self.snr = 0.0
         self.extra = extra
         self.name = name
-        if self.path:
+        if isinstance(path, np.ndarray) or self.path:
             # logger.info(f'name = {name} / file_path = {self.file_path}')
             try:
                 # self.setPixmap(QPixmap(file_path))
-                self.setPixmap(QPixmap.fromImage(QImage(path)))
-                self.siz = ImageSize(path)
+                self.setPixmap(QPixmap.fromImage(load_image(path)))
+                self.siz = image_size(path)
             except:
                 logger.warning(f"Failed to load: {path}")
                 self.set_no_image()
@@ -478,6 +495,7 @@ class CorrSignalThumbnail(QLabel):
 
 
     def set_data(self, path, snr):
+        '''path: image file, or 2-D uint8 array'''
         # logger.critical('')
         self._noImage = 0
         self.path = path
@@ -486,13 +504,13 @@ class CorrSignalThumbnail(QLabel):
             # self.setPixmap(QPixmap(self.file_path))
             # self.setPixmap(QPixmap(self.file_path))
             # self.label.setText('%.3f' % self.snr)
-            if os.path.exists(path):
-                img = QImage(path)
+            if isinstance(path, np.ndarray) or (path and os.path.exists(path)):
+                img = load_image(path)
                 if img.isNull():
                     self.set_no_image()
                     return
                 self.setPixmap(QPixmap.fromImage(img))
-                self.siz = ImageSize(self.path)
+                self.siz = image_size(path)
             else:
                 self.set_no_image()
 
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+'''Long-running co-processes for the SWiFT-IR binaries.
+
+swim has a batch mode (`swim WxH` with no further arguments) that reads one
+command per stdin line and answers each with one result line, written
+unbuffered to stdout, or a "Can't read_img" line on stderr. A pool worker can
+therefore keep one swim process per window size alive and stream every
+ingredient of every recipe it runs through it, instead of paying a fork/exec
+(and the decode of both images, which swim caches by file name) per call.
+
+mir and iscale2 write through buffered stdio and exit at the end of each
+script, so run_binary() still starts them once per request, with the same
+timeout handling.'''
+
+import atexit
+import logging
+import os
+import queue
+import subprocess as sp
+import threading
+import time
+
+__all__ = ['CoProcess', 'CoProcessError', 'run_swim', 'run_binary', 'shutdown']
+
+logger = logging.getLogger(__name__)
+
+# swim keeps these options (as pointers into its line buffer) from one batch line to the next, so a
+# process that has seen one of them may only serve requests that pass it again on every line.
+_STICKY_SWIM_FLAGS = ('-b', '-k', '-t', '-v')
+
+_coprocs = {}
+
+
+class CoProcessError(Exception):
+    retry = True  # whether the request may succeed on a restarted process
+
+
+class CoProcess:
+    '''A persistent swim batch-mode process, driven one request (a list of command
+    lines) at a time. The process is restarted after it crashes, times out or
+    fails to read an image, and recycled after max_requests requests.'''
+
+    def __init__(self, cmd, args=(), max_requests=1000):
+        self.cmd = [cmd] + list(args)
+        self.max_requests = max_requests
+        self.n_requests = 0
+        self.sticky = set()
+        self._proc = None
+        self._q = None
+        self._pumps = ()
+
+    def start(self):
+        self._proc = sp.Popen(self.cmd, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE,
+                              universal_newlines=True, bufsize=1)
+        self._q = queue.Queue()
+        self._pumps = [threading.Thread(target=_pump, args=(name, stream, self._q), daemon=True)
+                       for name, stream in (('out', self._proc.stdout), ('err', self._proc.stderr))]
+        for t in self._pumps:
+            t.start()
+        self.n_requests = 0
+        self.sticky = set()
+        logger.debug(f'Started co-process {self.cmd} (pid {self._proc.pid})')
+
+    def alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def stop(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+            self._proc.wait(timeout=1)
+        except:
+            self._proc.kill()
+            self._proc.wait()
+        self._close()
+
+    def _close(self):
+        '''Close the pipes of the exited process, once their pumps have read them to the end.'''
+        for t in self._pumps:
+            t.join(timeout=1)
+        for t, name, stream in zip(self._pumps, ('stdout', 'stderr'), (self._proc.stdout, self._proc.stderr)):
+            if t.is_alive():  # a child of swim still holds the pipe open
+                logger.warning(f'Leaving the {name} pipe of {self.cmd[0]} (pid {self._proc.pid}) open')
+                continue
+            stream.close()
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        self._proc = None
+        self._pumps = ()
+
+    def accepts(self, lines):
+        '''True if this process can serve lines without carrying over options of earlier requests.'''
+        return all(all(f in line.split() for f in self.sticky) for line in lines)
+
+    def request(self, lines, timeout=None):
+        '''Send command lines, return (stdout lines, stderr lines) once every line is answered.
+        Raises CoProcessError as soon as swim reports an image it can't read: it answers none of
+        the later lines that name that image.'''
+        if not self.alive() or self.n_requests >= self.max_requests or not self.accepts(lines):
+            self.stop()
+            self.start()
+        self.n_requests += 1
+        for line in lines:
+            self.sticky.update(f for f in _STICKY_SWIM_FLAGS if f in line.split())
+        try:
+            self._proc.stdin.write(''.join(line + '\n' for line in lines))
+            self._proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            self.stop()
+            raise CoProcessError(f'{self.cmd[0]} exited before accepting the request')
+
+        out, err = [], []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(out) < len(lines):
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                stream, line = self._q.get(timeout=remaining)
+            except queue.Empty:
+                self.stop()
+                e = CoProcessError(f'{self.cmd[0]} timed out after {timeout}s')
+                e.retry = False
+                raise e
+            if line is None:
+                rc = self._proc.wait()
+                self._close()
+                raise CoProcessError(f'{self.cmd[0]} exited with return code {rc}')
+            if stream == 'out':
+                out.append(line)
+            elif line.startswith("Can't read_img"):
+                # Its image cache now holds the failed file name, so restart before the next request
+                self.stop()
+                e = CoProcessError(f'{self.cmd[0]}: {line}')
+                e.retry = False
+                raise e
+            else:
+                err.append(line)
+        return out, err
+
+
+def _pump(name, stream, q):
+    for line in iter(stream.readline, ''):
+        q.put((name, line.rstrip('\n')))
+    q.put((name, None))
+
+
+def run_swim(swim_c, size_arg, cmd_input, timeout=None):
+    '''Run newline-separated swim commands on this process' `swim size_arg` co-process.
+    A crashed co-process is restarted and the request retried once (not after a timeout or
+    an unreadable image).
+    Returns (stdout, stderr, rc) like run_command.'''
+    lines = [l for l in cmd_input.split('\n') if l.strip()]
+    key = (swim_c, size_arg)
+    if key not in _coprocs:
+        _coprocs[key] = CoProcess(swim_c, [size_arg])
+    cp = _coprocs[key]
+    msg = ''
+    for attempt in (0, 1):
+        try:
+            out, err = cp.request(lines, timeout=timeout)
+            return '\n'.join(out), '\n'.join(err), 0
+        except CoProcessError as e:
+            msg = str(e)
+            if not e.retry:
+                logger.warning(msg)
+                break
+            logger.warning(msg + ('' if attempt else ', restarting'))
+    return '', msg, 1
+
+
+def run_binary(cmd, arg_list=(), cmd_input=None, timeout=None):
+    '''Run cmd once, feeding it cmd_input. Returns (stdout, stderr, rc). The process is
+    killed if it does not finish within timeout seconds (rc is then None).'''
+    with sp.Popen([cmd] + list(arg_list), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE,
+                  universal_newlines=True) as proc:
+        try:
+            out, err = proc.communicate(cmd_input, timeout=timeout)
+        except sp.TimeoutExpired:
+            proc.kill()
+            out, err = proc.communicate()
+            logger.warning(f'{os.path.basename(cmd)} timed out after {timeout}s')
+            return out, err, None
+    return out, err, proc.returncode
+
+
+def shutdown():
+    for cp in _coprocs.values():
+        cp.stop()
+    _coprocs.clear()
+
+
+atexit.register(shutdown)
@@ -18,11 +18,14 @@ except:
 __all__ = [
     'ImageSize',
     'BiasMat',
+    'BiasMats',
     'BiasFuncs',
     'ApplyBiasFuncs',
     'InitCafm',
     'SetSingleCafm',
     'SetStackCafm',
+    'StackAfms',
+    'UpdateStackCafm',
     'ComputeBoundingRect',
     'invertAffine',
 ]
@@ -213,58 +216,47 @@ class UnknownImageFormat(Exception):
 # Return the bias matrix at position x in the stack as given by the bias_funcs
 def BiasMat(x, bias_funcs):
     logger.debug('BiasMat:')
+    return BiasMats([x], bias_funcs)[0, :2]
 
-    #  xdot = np.array([4.0,3.0,2.0,1.0])
 
+def BiasMats(x, bias_funcs, right=False):
+    '''Bias matrices (N,3,3) at each of the positions x in the stack as given by the bias_funcs. The derivative
+    polynomials are evaluated over all positions at once. right=True composes them as alt_BiasMat.'''
+    x = np.asarray(x, dtype='float64')
     poly_order = len(bias_funcs['x']) - 1
     xdot = np.arange(poly_order, 0, -1, dtype='float64')
 
-    p = bias_funcs['scale_x']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    scale_x_bias = 1 - fdp(x)  # scale_x is multiplicative
-
-    p = bias_funcs['scale_y']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    scale_y_bias = 1 - fdp(x)  # scale_y is multiplicative
-
-    p = bias_funcs['skew_x']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    skew_x_bias = -fdp(x)
-   
-    p = bias_funcs['rot']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    rot_bias = -fdp(x)
-
-    p = bias_funcs['x']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    x_bias = -fdp(x)
-
-    p = bias_funcs['y']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    y_bias = -fdp(x)
+    def dp(key):
+        return np.polyval(bias_funcs[key][:-1] * xdot, x)
 
-    # Create scale, skew, rot, and translation matrices
-    scale_bias_mat = np.array([[scale_x_bias, 0.0, 0.0], [0.0, scale_y_bias, 0.0]])
-    skew_x_bias_mat = np.array([[1.0, skew_x_bias, 0.0], [0.0, 1.0, 0.0]])
-    rot_bias_mat = np.array([[np.cos(rot_bias), -np.sin(rot_bias), 0.0], [np.sin(rot_bias), np.cos(rot_bias), 0.0]])
-    trans_bias_mat = np.array([[1.0, 0.0, x_bias], [0.0, 1.0, y_bias]])
-
-    bias_mat = identityAffine()
-
-    # Compose bias matrix as trans*rot*skew*scale with pre-multiplication (i.e. left action)
-    bias_mat = composeAffine(scale_bias_mat, bias_mat)
-    bias_mat = composeAffine(skew_x_bias_mat, bias_mat)
-    bias_mat = composeAffine(rot_bias_mat, bias_mat)
-    bias_mat = composeAffine(trans_bias_mat, bias_mat)
-
-    # logger.info('<<<< BiasMat')
+    scale_x_bias = 1 - dp('scale_x')  # scale_x is multiplicative
+    scale_y_bias = 1 - dp('scale_y')  # scale_y is multiplicative
+    skew_x_bias = -dp('skew_x')
+    rot_bias = -dp('rot')
+    x_bias = -dp('x')
+    y_bias = -dp('y')
 
+    # Create scale, skew, rot, and translation matrices
+    n = len(x)
+    scale_bias_mat = np.tile(np.eye(3), (n, 1, 1))
+    scale_bias_mat[:, 0, 0] = scale_x_bias
+    scale_bias_mat[:, 1, 1] = scale_y_bias
+    skew_x_bias_mat = np.tile(np.eye(3), (n, 1, 1))
+    skew_x_bias_mat[:, 0, 1] = skew_x_bias
+    rot_bias_mat = np.tile(np.eye(3), (n, 1, 1))
+    rot_bias_mat[:, 0, 0] = np.cos(rot_bias)
+    rot_bias_mat[:, 0, 1] = -np.sin(rot_bias)
+    rot_bias_mat[:, 1, 0] = np.sin(rot_bias)
+    rot_bias_mat[:, 1, 1] = np.cos(rot_bias)
+    trans_bias_mat = np.tile(np.eye(3), (n, 1, 1))
+    trans_bias_mat[:, 0, 2] = x_bias
+    trans_bias_mat[:, 1, 2] = y_bias
+
+    # Compose bias matrix as trans*rot*skew*scale with pre-multiplication (i.e. left action),
+    # or post-multiplication for alt_cafm
+    bias_mat = scale_bias_mat
+    for m in (skew_x_bias_mat, rot_bias_mat, trans_bias_mat):
+        bias_mat = np.matmul(bias_mat, m) if right else np.matmul(m, bias_mat)
     return bias_mat
 
 
@@ -273,10 +265,9 @@ def BiasMat(x, bias_funcs):
 # Find the bias functions that best fit the trends in cafm across the whole stack
 # For now the form of the functions is an Nth-order polynomial
 # def BiasFuncs(layerator, bias_funcs=None, poly_order=4):
-def BiasFuncs(dm, scale, poly_order=0, bias_funcs=None):
+def BiasFuncs(dm, scale, poly_order=0, bias_funcs=None, cafms=None):
+    '''cafms: optional (N,2,3) or (N,3,3) array fitted instead of the alt_cafm of the stack'''
     poly_order = int(poly_order)
-    # n_tasks = sum(1 for _ in copy.deepcopy(layerator))
-    n_tasks = len(dm)
     if type(bias_funcs) == type(None):
         init_scalars = True
         bias_funcs = {}
@@ -290,64 +281,29 @@ def BiasFuncs(dm, scale, poly_order=0, bias_funcs=None):
         init_scalars = False
         poly_order = len(bias_funcs['x']) - 1
 
-    scale_x_array = np.zeros((n_tasks, 2))
-    scale_y_array = np.zeros((n_tasks, 2))
-    skew_x_array = np.zeros((n_tasks, 2))
-    rot_array = np.zeros((n_tasks, 2))
-    x_array = np.zeros((n_tasks, 2))
-    y_array = np.zeros((n_tasks, 2))
-
-    # for align_idx in range(len(al_stack)):
-    for i, layer in enumerate(dm()):
-        c_afm = np.array(layer['levels'][scale]['alt_cafm'])
-
-        # Decompose the affine matrix into scale, skew, rotation, and translation
-        rot = np.arctan2(c_afm[1, 0], c_afm[0, 0])
-        # scale_x = np.sqrt(c_afm[0, 0] ** 2 + c_afm[1, 0] ** 2)
-        # scale_y = (c_afm[1, 1] * np.cos(rot)) - (c_afm[0, 1] * np.sin(rot))
-        # skew_x = ((c_afm[0, 1] * np.cos(rot)) + (c_afm[1, 1] * np.sin(rot))) / scale_y
+    if cafms is None:
+        cafms = [layer['levels'][scale]['alt_cafm'] for layer in dm()]
+    cafms = np.asarray(cafms, dtype='float64')
+    n = len(cafms)
+    idx = np.arange(n, dtype='float64')
+    rot, scale_x, scale_y, skew_x = np.zeros(n), np.zeros(n), np.zeros(n), np.zeros(n)
+
+    # Decompose the affine matrices into scale, skew, rotation, and translation. Section by section:
+    # the vectorized arctan2 and sqrt may differ in the last bit, which would change every cafm hash.
+    for i, c_afm in enumerate(cafms):
+        rot[i] = np.arctan2(c_afm[1, 0], c_afm[0, 0])
         # calculations that avoid using sin and cos:
-        scale_x = np.sqrt(c_afm[0, 0] ** 2 + c_afm[1, 0] ** 2)
-        scale_y = ((c_afm[1, 1] * c_afm[0,0]) - (c_afm[0, 1] * c_afm[1, 0])) / scale_x
-        skew_x = ((c_afm[0, 0] * c_afm[0, 1]) + (c_afm[1, 0] * c_afm[1, 1])) / (scale_x * scale_y)
-        det = (c_afm[0, 0] * c_afm[1, 1]) - (c_afm[0, 1] * c_afm[1, 0])
-
-        scale_x_array[i] = [i, scale_x]
-        scale_y_array[i] = [i, scale_y]
-        skew_x_array[i]  = [i, skew_x]
-        rot_array[i]     = [i, rot]
-        x_array[i]       = [i, c_afm[0, 2]]
-        y_array[i]       = [i, c_afm[1, 2]]
-
-    p = np.polyfit(scale_x_array[:, 0], scale_x_array[:, 1], poly_order)
-    bias_funcs['scale_x'][:-1] += p[:-1]
-    if init_scalars:
-        bias_funcs['scale_x'][poly_order] = p[poly_order]
-
-    p = np.polyfit(scale_y_array[:, 0], scale_y_array[:, 1], poly_order)
-    bias_funcs['scale_y'][:-1] += p[:-1]
-    if init_scalars:
-        bias_funcs['scale_y'][poly_order] = p[poly_order]
-
-    p = np.polyfit(skew_x_array[:, 0], skew_x_array[:, 1], poly_order)
-    bias_funcs['skew_x'][:-1] += p[:-1]
-    if init_scalars:
-        bias_funcs['skew_x'][poly_order] = p[poly_order]
-
-    p = np.polyfit(rot_array[:, 0], rot_array[:, 1], poly_order)
-    bias_funcs['rot'][:-1] += p[:-1]
-    if init_scalars:
-        bias_funcs['rot'][poly_order] = p[poly_order]
-
-    p = np.polyfit(x_array[:, 0], x_array[:, 1], poly_order)
-    bias_funcs['x'][:-1] += p[:-1]
-    if init_scalars:
-        bias_funcs['x'][poly_order] = p[poly_order]
-
-    p = np.polyfit(y_array[:, 0], y_array[:, 1], poly_order)
-    bias_funcs['y'][:-1] += p[:-1]
-    if init_scalars:
-        bias_funcs['y'][poly_order] = p[poly_order]
+        scale_x[i] = np.sqrt(c_afm[0, 0] ** 2 + c_afm[1, 0] ** 2)
+        scale_y[i] = ((c_afm[1, 1] * c_afm[0, 0]) - (c_afm[0, 1] * c_afm[1, 0])) / scale_x[i]
+        skew_x[i] = ((c_afm[0, 0] * c_afm[0, 1]) + (c_afm[1, 0] * c_afm[1, 1])) / (scale_x[i] * scale_y[i])
+
+    terms = {'scale_x': scale_x, 'scale_y': scale_y, 'skew_x': skew_x, 'rot': rot,
+             'x': cafms[:, 0, 2], 'y': cafms[:, 1, 2]}
+    for key, values in terms.items():
+        p = np.polyfit(idx, values, poly_order)
+        bias_funcs[key][:-1] += p[:-1]
+        if init_scalars:
+            bias_funcs[key][poly_order] = p[poly_order]
 
     logging.info("init_scalars=%s\nReturning Biases: %s\n" % (str(init_scalars), str(bias_funcs)))
 
@@ -433,50 +389,97 @@ def SetSingleCafm(dm, scale, index, c_afm, include, bias_mat=None, method='grid'
 
 
 
+def StackAfms(dm, scale, start=0):
+    '''Returns the afms of sections start.. as an (N-start,3,3) array, identity for sections that are not included'''
+    stack = dm()
+    afms = np.tile(np.eye(3), (len(stack) - start, 1, 1))
+    for i in range(start, len(stack)):
+        lvl = stack[i]['levels'][scale]
+        if not lvl['swim_settings']['include']:
+            continue
+        try:
+            afms[i - start, :2] = lvl['mir_afm']
+        except Exception as e:
+            logger.warning(f"[{i}] afm not found, using identity. Reason: {e.__class__.__name__}")
+    return afms
+
+
+def _cumulative(afms, c_afm_init, bias=None, right=False):
+    '''Cumulative afms (N,3,3) of a stack of afms, starting from c_afm_init. bias[i] is applied after afms[i].
+    Matrices are composed one section at a time in the same order as SetSingleCafm, so results (and
+    cafm hashes) are unchanged. right=True composes on the right, as alt_SetSingleCafm does.'''
+    out = np.empty_like(afms)
+    c = np.vstack((np.asarray(c_afm_init)[:2], [0., 0., 1.]))
+    for i in range(len(afms)):
+        if right:
+            c = np.matmul(c, afms[i])
+            if bias is not None:
+                c = np.matmul(c, bias[i])
+        else:
+            c = np.matmul(afms[i], c)
+            if bias is not None:
+                c = np.matmul(bias[i], c)
+        out[i] = c
+    return out
+
+
+def _set_stack(dm, scale, key, cafms, start=0):
+    '''Writes an (N-start,3,3) array of cafms back to sections start.. as 2x3 lists'''
+    stack = dm()
+    for i, c in enumerate(cafms[:, :2].tolist(), start=start):
+        stack[i]['levels'][scale][key] = c
+
+
+def UpdateStackCafm(dm, scale, cache, start=0):
+    '''Calculate cafm and alt_cafm without bias correction from section start on. cache holds the
+    'afms', 'cafm' and 'alt_cafm' arrays of the previous call and is updated in place; the running
+    products before start are taken from it, so only sections start.. are read and written.'''
+    n = len(dm())
+    if start <= 0 or len(cache.get('afms', ())) != n:
+        start = 0
+        cache['afms'] = StackAfms(dm, scale)
+    else:
+        start = min(start, n)
+        cache['afms'][start:] = StackAfms(dm, scale, start=start)
+    logger.info(f'Setting Stack CAFM from section {start} of {n}...')
+    for key, right in (('cafm', False), ('alt_cafm', True)):
+        c_afm_init = cache[key][start - 1] if start else identityAffine()
+        cafms = _cumulative(cache['afms'][start:], c_afm_init, right=right)
+        if start:
+            cache[key][start:] = cafms
+        else:
+            cache[key] = cafms
+        _set_stack(dm, scale, key, cafms, start=start)
+    cache['bounds_from'] = min(cache.get('bounds_from', start), start)
+    return cache
+
+
 # def SetStackCafm(iterator, level, poly_order=None):
-def SetStackCafm(dm, scale, poly_order=None):
-    '''Calculate cafm across the whole stack with optional bias correction'''
+def SetStackCafm(dm, scale, poly_order=None, afms=None, alt_cafms=None):
+    '''Calculate cafm across the whole stack with optional bias correction. afms (from StackAfms) and
+    the alt_cafms the bias is fitted to may be passed in, otherwise they are read from the stack.'''
     caller = inspect.stack()[1].function
     global _set_stack_calls
     _set_stack_calls +=1
     logger.critical(f'[{caller}] Setting Stack CAFM (call # {_set_stack_calls})...')
 
-    # logger.info(f'Setting Stack CAFM (iterator={str(iterator)}, level={level}, poly_order={poly_order})...')
-    # cfg.mw.tell('<span style="color: #FFFF66;"><b>Setting Stack CAFM...</b></span>')
-    # cfg.mw.tell('Setting Stack CAFM...')
+    if afms is None:
+        afms = StackAfms(dm, scale)
     use_poly = (poly_order != None)
+    bias = None
     if use_poly:
-        SetStackCafm(dm, scale=scale, poly_order=None) # first initializeStack Cafms without bias correction
-    bias_mat = None
-    if use_poly:
-        # If null_biases==True, Iteratively determine and null out bias in cafm
-        bias_funcs = BiasFuncs(dm, scale, poly_order=poly_order)
+        # If null_biases==True, Iteratively determine and null out bias in cafm. The bias functions are
+        # fitted to alt_cafm, which this does not change, so only the last pass needs to be composed.
+        if alt_cafms is None:
+            alt_cafms = [d['levels'][scale]['alt_cafm'] for d in dm()]
+        bias_funcs = BiasFuncs(dm, scale, poly_order=poly_order, cafms=alt_cafms)
         c_afm_init = InitCafm(bias_funcs)
+        bias_funcs = BiasFuncs(dm, scale, bias_funcs=bias_funcs, poly_order=poly_order, cafms=alt_cafms)
+        bias = BiasMats(np.arange(len(afms)), bias_funcs)
     else:
         c_afm_init = identityAffine()
 
-    bias_iters = (1,2)[use_poly]
-    for bi in range(bias_iters):
-        # logger.critical(f'\n\nbi = {bi}\n')
-        c_afm = c_afm_init
-        for i, d in enumerate(dm()):
-            # try:
-            #     # assert 'affine_matrix' in d['levels'][scale]['results']
-            #     cfg.pt.ht.haskey()
-            # except AssertionError as e:
-            #     logger.error(f"AssertionError, section #{i}: {str(e)}")
-            #     break
-            if use_poly:
-                bias_mat = BiasMat(i, bias_funcs)
-            # method = d['levels'][scale]['swim_settings']['method_opts']['method']
-            method = d['levels'][scale]['swim_settings']['method_opts']['method']
-            include = dm['stack'][i]['levels'][scale]['swim_settings']['include']
-            # include = dm['stack'][i]['levels'][scale]['swim_settings']['include'] #1129
-            c_afm = SetSingleCafm(dm, scale, i, c_afm, include, bias_mat=bias_mat, method=method) # <class
-            # 'numpy.ndarray'>
-
-        if bi < bias_iters - 1:
-            bias_funcs = BiasFuncs(dm, scale, bias_funcs=bias_funcs, poly_order=poly_order)
+    _set_stack(dm, scale, 'cafm', _cumulative(afms, c_afm_init, bias=bias))
 
     cfg.mw.hud.done()
     return c_afm_init,
@@ -484,55 +487,7 @@ def SetStackCafm(dm, scale, poly_order=None):
 
 def alt_BiasMat(x, bias_funcs):
     logger.debug('BiasMat:')
-
-    poly_order = len(bias_funcs['x']) - 1
-    xdot = np.arange(poly_order, 0, -1, dtype='float64')
-
-    p = bias_funcs['scale_x']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    scale_x_bias = 1 - fdp(x)  # scale_x is multiplicative
-
-    p = bias_funcs['scale_y']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    scale_y_bias = 1 - fdp(x)  # scale_y is multiplicative
-
-    p = bias_funcs['skew_x']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    skew_x_bias = -fdp(x)
-
-    p = bias_funcs['rot']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    rot_bias = -fdp(x)
-
-    p = bias_funcs['x']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    x_bias = -fdp(x)
-
-    p = bias_funcs['y']
-    dp = p[:-1] * xdot
-    fdp = np.poly1d(dp)
-    y_bias = -fdp(x)
-
-    # Create scale, skew, rot, and translation matrices
-    scale_bias_mat = np.array([[scale_x_bias, 0.0, 0.0], [0.0, scale_y_bias, 0.0]])
-    skew_x_bias_mat = np.array([[1.0, skew_x_bias, 0.0], [0.0, 1.0, 0.0]])
-    rot_bias_mat = np.array([[np.cos(rot_bias), -np.sin(rot_bias), 0.0], [np.sin(rot_bias), np.cos(rot_bias), 0.0]])
-    trans_bias_mat = np.array([[1.0, 0.0, x_bias], [0.0, 1.0, y_bias]])
-
-    bias_mat = identityAffine()
-
-    # Compose bias matrix as trans*rot*skew*scale with pre-multiplication (i.e. left action)
-    bias_mat = composeAffine(bias_mat, scale_bias_mat)
-    bias_mat = composeAffine(bias_mat, skew_x_bias_mat)
-    bias_mat = composeAffine(bias_mat, rot_bias_mat)
-    bias_mat = composeAffine(bias_mat, trans_bias_mat)
-
-    return bias_mat
+    return BiasMats([x], bias_funcs, right=True)[0, :2]
 
 
 def alt_InitCafm(bias_funcs):
@@ -582,36 +537,31 @@ def alt_SetSingleCafm(dm, scale, index, alt_c_afm, include, bias_mat=None, metho
     return alt_c_afm
 
 
-def alt_SetStackCafm(dm, scale, poly_order=None):
-    '''Calculate cafm across the whole stack with optional bias correction'''
+def alt_SetStackCafm(dm, scale, poly_order=None, afms=None):
+    '''Calculate alt_cafm across the whole stack with optional bias correction'''
     caller = inspect.stack()[1].function
     global _set_stack_calls
     _set_stack_calls += 1
     logger.critical(f'[{caller}] Setting Stack CAFM (call # {_set_stack_calls})...')
 
+    if afms is None:
+        afms = StackAfms(dm, scale)
     use_poly = (poly_order != None)
     if use_poly:
-        alt_SetStackCafm(dm, scale=scale, poly_order=None)  # first initializeStack Cafms without bias correction
-    bias_mat = None
-    if use_poly:
-        # If null_biases==True, Iteratively determine and null out bias in cafm
-        bias_funcs = BiasFuncs(dm, scale, poly_order=poly_order)
+        # Each pass fits the bias functions to the alt_cafms of the previous one, starting without bias correction
+        alt_cafms = _cumulative(afms, identityAffine(), right=True)
+        bias_funcs = BiasFuncs(dm, scale, poly_order=poly_order, cafms=alt_cafms)
         c_afm_init = alt_InitCafm(bias_funcs)
+        for bi in range(2):
+            bias = BiasMats(np.arange(len(afms)), bias_funcs, right=True)
+            alt_cafms = _cumulative(afms, c_afm_init, bias=bias, right=True)
+            if bi < 1:
+                bias_funcs = BiasFuncs(dm, scale, bias_funcs=bias_funcs, poly_order=poly_order, cafms=alt_cafms)
     else:
         c_afm_init = identityAffine()
+        alt_cafms = _cumulative(afms, c_afm_init, right=True)
 
-    bias_iters = (1, 2)[use_poly]
-    for bi in range(bias_iters):
-        alt_c_afm = c_afm_init
-        for i, d in enumerate(dm()):
-            if use_poly:
-                bias_mat = alt_BiasMat(i, bias_funcs)
-            method = d['levels'][scale]['swim_settings']['method_opts']['method']
-            include = dm['stack'][i]['levels'][scale]['swim_settings']['include']
-            alt_c_afm = alt_SetSingleCafm(dm, scale, i, alt_c_afm, include, bias_mat=bias_mat, method=method)
-
-        if bi < bias_iters - 1:
-            bias_funcs = BiasFuncs(dm, scale, bias_funcs=bias_funcs, poly_order=poly_order)
+    _set_stack(dm, scale, 'alt_cafm', alt_cafms)
 
     cfg.mw.hud.done()
     return c_afm_init,
@@ -711,9 +661,11 @@ def reptoshape(mat, pattern):
     return mat
 
 # def ComputeBoundingRect(al_stack, level=None):
-def ComputeBoundingRect(dm, scale=None):
+def ComputeBoundingRect(dm, scale=None, cache=None):
     '''
     Determines Bounding Rectangle size for alignment stack. Must be preceded by a call to SetStackCafm.
+    With the cache of UpdateStackCafm, the running bounds of the sections before the first changed cafm
+    are reused, and only the bounds of the sections after it are computed.
 
     To get result for current level, in the main process, use:
     from src.image_funcs import ComputeBoundingRect, ImageSize
@@ -749,18 +701,33 @@ array([[   0,    0],
     '''
     logger.info('Computing Bounding Rect...')
     if scale == None: scale = dm.level
+    siz = dm.image_size(s=scale)
+
+    if cache is not None and 'cafm' in cache:
+        start = cache.pop('bounds_from', 0)
+        running = cache.get('running_bounds')
+        if running is None or len(running) != len(cache['cafm']) or cache.get('bounds_siz') != list(siz):
+            start = 0
+        prev = running[start - 1] if start else None
+        r = _running_bounds(_section_bounds(cache['cafm'][start:], siz), prev)
+        if start:
+            running[start:] = r
+        else:
+            cache['running_bounds'] = running = r
+        cache['bounds_siz'] = list(siz)
+    else:
+        cafms = np.tile(np.eye(3), (len(dm()), 1, 1))
+        for i, item in enumerate(dm()):
+            cafms[i, :2] = item['levels'][scale]['cafm']
+        running = _running_bounds(_section_bounds(cafms, siz))
 
     if cfg.SUPPORT_NONSQUARE:
         '''Non-square'''
-        # model_bounds = None
-        model_bounds = [[0,0]] #Todo initializeStack this better
-        siz = dm.image_size(s=scale)
-        for item in dm():
-            # method = item['levels'][scale]['swim_settings']['method_opts']['method']
-            c_afm = np.array(item['levels'][scale]['cafm'])
-            model_bounds = np.append(model_bounds, modelBounds2(c_afm, siz), axis=0)
-        border_width_x = max(0 - model_bounds[:, 0].min(), model_bounds[:, 0].max() - siz[0])
-        border_width_y = max(0 - model_bounds[:, 1].min(), model_bounds[:, 1].max() - siz[1])
+        # The bounds always include the origin
+        x0, y0, x1, y1 = running[-1] if len(running) else (0, 0, 0, 0)
+        x0, y0, x1, y1 = min(x0, 0), min(y0, 0), max(x1, 0), max(y1, 0)
+        border_width_x = max(0 - x0, x1 - siz[0])
+        border_width_y = max(0 - y0, y1 - siz[1])
         rect = [int(-border_width_x),
                 int(-border_width_y),
                 int(siz[0] + 2 * border_width_x),
@@ -768,18 +735,8 @@ array([[   0,    0],
         logger.debug('Returning: %s' % str(rect))
     else:
         '''Old code/square only'''
-        model_bounds = None
-        siz = dm.image_size(s=scale)
-        for item in dm():
-            c_afm = np.array(item['levels'][scale]['cafm'])
-            if type(model_bounds) == type(None):
-                model_bounds = modelBounds2(c_afm, siz)
-            else:
-                model_bounds = np.append(model_bounds, modelBounds2(c_afm, siz), axis=0)
-        border_width = max(0 - model_bounds[:, 0].min(),
-                           0 - model_bounds[:, 1].min(),
-                           model_bounds[:, 0].max() - siz[0],
-                           model_bounds[:, 1].max() - siz[0])
+        x0, y0, x1, y1 = running[-1]
+        border_width = max(0 - x0, 0 - y0, x1 - siz[0], y1 - siz[0])
         rect = (int(-border_width), int(-border_width), int(siz[0] + 2 * border_width), int(siz[0] + 2 * border_width))
         logger.critical('ComputeBoundingRectangle Return: %s' % str(rect))
 
@@ -787,6 +744,26 @@ array([[   0,    0],
     return rect
 
 
+def _section_bounds(cafms, siz):
+    '''(N,4) array of the bounds [x0, y0, x1, y1] of each of an (N,3,3) array of cafms, as modelBounds2'''
+    w, h = si_unpackSize(siz)
+    inv = np.linalg.inv(cafms)
+    corners = np.array([[0., w, 0., w], [0., 0., h, h]])
+    c = np.matmul(inv[:, :2, :2], corners) + inv[:, :2, 2:]  # (N,2,4): x and y of the four corners
+    return np.concatenate((np.floor(c.min(axis=2)), np.ceil(c.max(axis=2))), axis=1).astype('int32')
+
+
+def _running_bounds(bounds, prev=None):
+    '''Running [min x0, min y0, max x1, max y1] over the (N,4) section bounds, continuing from prev'''
+    r = bounds.copy()
+    if prev is not None and len(r):
+        r[0, :2] = np.minimum(r[0, :2], prev[:2])
+        r[0, 2:] = np.maximum(r[0, 2:], prev[2:])
+    r[:, :2] = np.minimum.accumulate(r[:, :2], axis=0)
+    r[:, 2:] = np.maximum.accumulate(r[:, 2:], axis=0)
+    return r
+
+
 def format_cafm(cafm):
     if isinstance(cafm, (np.ndarray, np.generic) ):
         cafm = cafm.tolist()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+'''Multiprocess-safe logging for alignment workers.
+
+Pool workers do not write log files themselves. worker_init() (the pool
+initializer) routes the project loggers of each worker through a single
+QueueHandler, and a LogListener in the parent process drains the queue
+into rotating per-project log files (<project>/logs/recipemaker.log, ...).
+Installing the handlers is idempotent, so a long-lived worker never writes a
+record more than once however many recipes it runs.
+
+Per-ingredient progress messages are logged at the HOTPATH level through
+hot(). With the hot path quiet, they are skipped before they are formatted.'''
+
+import logging
+import logging.handlers
+import multiprocessing
+import os
+
+__all__ = ['PROJECT_LOGS', 'HOTPATH', 'LogListener', 'worker_init', 'install_queue_handler',
+           'attach_file_handlers', 'set_hot_path_quiet', 'hot_enabled', 'hot']
+
+logger = logging.getLogger(__name__)
+
+# logger name -> file name in the project's logs directory
+PROJECT_LOGS = {
+    'recipemaker': 'recipemaker.log',
+    'MAlogger': 'manual_align.log',
+    'exceptlogger': 'exceptions.log',
+    'tnLogger': 'thumbnails.log',
+}
+
+HOTPATH = 15
+logging.addLevelName(HOTPATH, 'HOTPATH')
+
+_hot_path_quiet = False
+
+
+class _Dispatcher(logging.Handler):
+    '''Hands each record to the handler of the project log its logger writes to.'''
+
+    def __init__(self, handlers):
+        super().__init__()
+        self.handlers = handlers
+
+    def handle(self, record):
+        h = self.handlers.get(record.name)
+        if h is not None:
+            h.handle(record)
+
+    def close(self):
+        for h in self.handlers.values():
+            h.close()
+        super().close()
+
+
+class LogListener:
+    '''Writes the records that pool workers put on self.queue to rotating logs in logs_dir
+    (records are dropped while logs_dir is None). The queue is created from ctx unless an
+    existing one (e.g. a warm pool's) is given. Use as a context manager around the
+    lifetime of the pool or stage.'''
+
+    def __init__(self, logs_dir, queue=None, ctx=None, max_bytes=10 * 1024 ** 2, backups=3):
+        self.queue = queue if queue is not None else (ctx or multiprocessing).Queue()
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._dispatcher = _Dispatcher({})
+        self.set_logs_dir(logs_dir)
+        self._listener = logging.handlers.QueueListener(self.queue, self._dispatcher)
+
+    def set_logs_dir(self, logs_dir):
+        handlers = {}
+        if logs_dir:
+            os.makedirs(logs_dir, exist_ok=True)
+            for name, fn in PROJECT_LOGS.items():
+                h = logging.handlers.RotatingFileHandler(os.path.join(logs_dir, fn), maxBytes=self.max_bytes,
+                                                         backupCount=self.backups, delay=True)
+                h.setFormatter(logging.Formatter('%(asctime)s %(processName)s %(levelname)s %(message)s'))
+                handlers[name] = h
+        old, self._dispatcher.handlers = self._dispatcher.handlers, handlers
+        for h in old.values():
+            h.close()
+
+    def start(self):
+        self._listener.start()
+        return self
+
+    def stop(self):
+        try:
+            self._listener.stop()
+        finally:
+            self._dispatcher.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def worker_init(queue=None, quiet=False):
+    '''Pool initializer: send the project logs to queue, set the hot path quiet.'''
+    set_hot_path_quiet(quiet)
+    if queue is not None:
+        install_queue_handler(queue)
+
+
+def install_queue_handler(queue):
+    for name in PROJECT_LOGS:
+        lg = logging.getLogger(name)
+        _remove_handlers(lg)
+        h = logging.handlers.QueueHandler(queue)
+        h._logpipe = True
+        lg.addHandler(h)
+        lg.setLevel(logging.DEBUG)
+        lg.propagate = False
+        lg.disabled = False
+
+
+def attach_file_handlers(logs_dir):
+    '''Write the project logs to logs_dir directly, for processes without a queue. Idempotent.'''
+    for name, fn in PROJECT_LOGS.items():
+        lg = logging.getLogger(name)
+        if any(getattr(h, '_logpipe', False) for h in lg.handlers):
+            continue
+        h = logging.FileHandler(os.path.join(logs_dir, fn), delay=True)
+        h._logpipe = True
+        lg.addHandler(h)
+        lg.disabled = False
+
+
+def has_handlers(name='recipemaker'):
+    return any(getattr(h, '_logpipe', False) for h in logging.getLogger(name).handlers)
+
+
+def _remove_handlers(lg):
+    for h in [h for h in lg.handlers if getattr(h, '_logpipe', False)]:
+        lg.removeHandler(h)
+        h.close()
+
+
+def set_hot_path_quiet(quiet):
+    global _hot_path_quiet
+    _hot_path_quiet = bool(quiet)
+
+
+def hot_enabled(lg):
+    return not _hot_path_quiet and lg.isEnabledFor(HOTPATH)
+
+
+def hot(lg, msg, *args):
+    '''Log a per-ingredient (hot path) message, unless the hot path is quiet.'''
+    if hot_enabled(lg):
+        lg.log(HOTPATH, msg, *args)
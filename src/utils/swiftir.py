@@ -25,6 +25,12 @@ import os
 import numpy as np
 import tifffile
 # import scipy
+try:
+    import cv2
+except ImportError:
+    # OpenCV is optional. Without it, windows are resampled and transformed
+    # with the pure NumPy fallbacks below (see _warpLinear).
+    cv2 = None
 
 apo = []
 apo0 = []
@@ -169,6 +175,11 @@ def mirAffine(pa, pb):
                              [pb[1,0] + (pb[0,0]-pb[0,1])]]))
         N = 3
     if N==3:
+        if cv2 is None:
+            # Exact solution of AFM [PA; 1] = PB
+            pa1 = np.vstack((pa, np.ones((1,3))))
+            afm = np.linalg.solve(pa1.transpose(), pb.transpose()).transpose()
+            return (afm, 0, 0)
         afm = cv2.getAffineTransform(pa.astype('float32').transpose(),
                                      pb.astype('float32').transpose())
         return (afm, 0, 0)
@@ -326,6 +337,10 @@ def extractStraightWindow(img, xy=None, siz=512):
     siz = si_unpackSize(siz)
     if xy is None:
         xy = [img.shape[1]/2, img.shape[0]/2]
+    if cv2 is None:
+        afm = np.array([[1., 0, xy[0] - siz[0]/2],
+                        [0, 1., xy[1] - siz[1]/2]])
+        return _warpLinear(img, afm, siz, replicate=True)
     return cv2.getRectSubPix(img, siz, (xy[0]-.5, xy[1]-.5))
 
 def extractROI(img, rect):
@@ -362,9 +377,37 @@ def extractTransformedWindow(img, xy=None, tfm=None, siz=512):
     tsiz = np.matmul(tfm, np.array([siz[0], siz[1]])/2)
     dxy = xy - tsiz
     afm = np.hstack((tfm, np.reshape(dxy, (2,1))))
+    if cv2 is None:
+        return _warpLinear(img, afm, siz)
     return cv2.warpAffine(img, afm, siz,
                           flags=cv2.WARP_INVERSE_MAP + cv2.INTER_LINEAR)
 
+def _warpLinear(img, afm, siz, replicate=False):
+    '''_WARPLINEAR - NumPy stand-in for cv2.warpAffine with WARP_INVERSE_MAP
+    win = _WARPLINEAR(img, afm, siz) returns a float32 window of size SIZ
+    (W,H) in which pixel (x,y) is bilinearly interpolated from IMG at
+    AFM [x, y, 1]'. Pixels outside of IMG are zero, or replicate the
+    nearest edge pixel if REPLICATE is True (as cv2.getRectSubPix does).
+    Only the pixels that are actually needed are read from IMG, so IMG
+    may be a memory map.'''
+    w, h = int(siz[0]), int(siz[1])
+    xx = np.arange(w, dtype='float64').reshape(1, w)
+    yy = np.arange(h, dtype='float64').reshape(h, 1)
+    sx = afm[0,0]*xx + afm[0,1]*yy + afm[0,2]
+    sy = afm[1,0]*xx + afm[1,1]*yy + afm[1,2]
+    x0 = np.floor(sx).astype(np.intp)
+    y0 = np.floor(sy).astype(np.intp)
+    fx = (sx - x0).astype('float32')
+    fy = (sy - y0).astype('float32')
+    H, W = img.shape[0], img.shape[1]
+    def tap(yi, xi):
+        v = img[np.clip(yi, 0, H-1), np.clip(xi, 0, W-1)].astype('float32')
+        if not replicate:
+            v[(xi < 0) | (xi >= W) | (yi < 0) | (yi >= H)] = 0
+        return v
+    return (tap(y0, x0)*(1-fx)*(1-fy) + tap(y0, x0+1)*fx*(1-fy) +
+            tap(y0+1, x0)*(1-fx)*fy + tap(y0+1, x0+1)*fx*fy)
+
 
 def shiftAffine(afm, dx):
     return afm + np.array([[0,0,dx[0]],[0,0,dx[1]]])
@@ -501,6 +544,9 @@ def fft(img):
     '''FFT - Discrete Fourier Transform
     FFT(img) returns the two-dimensional DFT of a real YxX image as an YxXx2
     tensor where real and imaginary parts follow each other.'''
+    if cv2 is None:
+        spec = np.fft.fft2(img.astype('float32'))
+        return np.stack((spec.real, spec.imag), 2).astype('float32')
     return cv2.dft(img.astype('float32'), flags=cv2.DFT_COMPLEX_OUTPUT)
 
 def ifft(img):
@@ -508,6 +554,10 @@ def ifft(img):
     IFFT(spec) returns the two-dimensional inverse DFT of a (complex) YxXx2
     spectrum as a real YxX image. (Any complex part of the result is dropped.)
     The input must be an YxXx2 tensor as produced by FFT.'''
+    if cv2 is None:
+        # cv2.idft does not normalize, so neither do we
+        n = img.shape[0] * img.shape[1]
+        return (np.fft.ifft2(img[:,:,0] + 1j*img[:,:,1]).real * n).astype('float32')
     return cv2.idft(img, flags=cv2.DFT_REAL_OUTPUT)
 
 def alignmentImage(sta, mov, wht=-.65):
@@ -560,8 +610,8 @@ def extractFoldedAroundPoint(img, xy, rad=5):
     Optional third argument RAD specifies radius of the extracted area.
     Full size of extracted area is (2 RAD + 1) x (2 RAD + 1).'''
     n = 2*rad + 1
-    xx = range(n) + xy[0] - rad
-    yy = range(n) + xy[1] - rad
+    xx = np.arange(n) + xy[0] - rad
+    yy = np.arange(n) + xy[1] - rad
     # Fold to nonnegative:
     S = img.shape
     xx = xx % S[1]
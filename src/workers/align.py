@@ -1,13 +1,12 @@
 #!/usr/bin/env python3
 
-import sys
 import copy
 import glob
 import json
 import logging
-import multiprocessing as mp
 import os
 import re
+import shutil
 import ctypes
 import subprocess as sp
 import time
@@ -25,7 +24,12 @@ numcodecs.blosc.use_threads = False
 
 from src.utils.readers import read
 from src.utils.writers import write
-from src.core.recipemaker import run_recipe
+from src.core.recipemaker import run_recipe, run_thumbnail
+from src.core.swimstore import SwimImageStore
+from src.utils import logpipe
+from src.utils.logpipe import LogListener
+from src.core.poolservice import imap_unordered, get_context, kill_process_groups, process_group_init
+from src.core import memgovernor, memmodel, scheduler
 from src.utils.helpers import print_exception, compute_worker_count, estimate_swim_memory
 import src.config as cfg
 
@@ -47,7 +51,7 @@ class AlignWorker(QObject):
     hudMessage = Signal(str)
     hudWarning = Signal(str)
 
-    def __init__(self, dm, path, scale, indexes, prev_snr, ignore_cache=False):
+    def __init__(self, dm, path, scale, indexes, prev_snr, ignore_cache=False, pool=None, resume=True):
         super().__init__()
         logger.info('Initializing...')
         self.scale = scale
@@ -56,6 +60,9 @@ class AlignWorker(QObject):
         self.indexes = indexes
         self.prev_snr = prev_snr
         self.ignore_cache = ignore_cache
+        self.pool = pool  # PoolService of the main window, if any
+        self.governor = None  # MemoryGovernor of the running stage, if concurrency adapts to memory use
+        self.resume = resume  # carry over sections completed by an interrupted run of the same sections
         # self.regen_indexes = regen_indexes
         self.dm = dm
         self.result = None
@@ -78,6 +85,8 @@ class AlignWorker(QObject):
         self._mutex.lock()
         self._running = False
         self._mutex.unlock()
+        if self.pool:
+            self.pool.cancel()
         self.finished.emit()
 
     
@@ -102,6 +111,7 @@ class AlignWorker(QObject):
 
         # Set global configuration for the alignment process
         _glob_config = {
+            'stage': time.time_ns(),  # workers drop their per-file caches when this changes
             'dev_mode': cfg.DEV_MODE,
             'verbose_swim': cfg.VERBOSE_SWIM,
             'log_recipe_to_file': cfg.LOG_RECIPE_TO_FILE,
@@ -114,13 +124,52 @@ class AlignWorker(QObject):
             'keep_signals': not are_large,
             'keep_matches': not are_large,
             'generate_thumbnails': not are_large,
+            'swim_backend': dm.swim_backend,
+            'mir_ethresh': cfg.MIR_ETHRESH,
+            'memmap_images': cfg.MEMMAP_IMAGES,
+            'reuse_neighbours': cfg.ALIGN_CONTIGUOUS_RUNS,
+            'swim_coprocess': cfg.USE_SWIM_COPROCESS,
+            'binary_timeout': cfg.BINARY_TIMEOUT,
+            'zarr_windows': cfg.SWIM_READ_ZARR_WINDOWS,
+            'window_halo': cfg.ZARR_WINDOW_HALO,
+            'adaptive_recipe': cfg.ADAPTIVE_RECIPES,
+            'afm_tolerance': cfg.RECIPE_AFM_TOLERANCE,
+            'snr_tolerance': cfg.RECIPE_SNR_TOLERANCE,
+            'max_extra_passes': cfg.RECIPE_MAX_EXTRA_PASSES,
+            'defer_thumbnails': cfg.DEFER_THUMBNAILS,
+            'swim_store': cfg.SWIM_IMAGE_STORE and not are_large,
         }
 
+        path_swim_store = None
+        if _glob_config['swim_store']:
+            path_swim_store = dm.path_swim_store(s=scale)
+            try:
+                SwimImageStore.create(path_swim_store, len(dm), n_ingredients=cfg.SWIM_STORE_INGREDIENTS,
+                                      match_px=cfg.TARGET_THUMBNAIL_SIZE)
+            except:
+                print_exception()
+                self.hudWarning.emit(f'Unable to create {path_swim_store}, signals and matches will not be kept')
+                _glob_config['swim_store'] = False
+                _glob_config['keep_signals'] = _glob_config['keep_matches'] = False
+
         firstInd = dm.first_included(s=scale)
 
         print(self.dm.swim_settings(s=scale, l=5))
 
+        # Sections ingested by an earlier run of the same sections of this level that did not finish.
+        # Their results are in the cache, so resuming only re-aligns them if their settings have changed
+        # since. A run that ignores the cache starts over.
+        checkpoint = dm['level_data'][scale].get('checkpoint')
+        if checkpoint and (self.ignore_cache or not self.resume or
+                           checkpoint.get('indexes') != sorted(self.indexes)):
+            checkpoint = None
+        done = set(checkpoint['done']) if checkpoint else set()
+        done = {i for i in done if dm.ht.haskey(dm.swim_settings(s=scale, l=i))}
+        if done:
+            self.hudMessage.emit(f'Resuming: {len(done)} sections were aligned by an interrupted run')
+
         tasks = []
+        redraw = []  # (task, cached result) of resumed sections that only lack their thumbnail or GIF
         _actual_indexes = []
         for i, sec in [(i, dm()[i]) for i in self.indexes]:
             i = dm().index(sec)
@@ -128,6 +177,9 @@ class AlignWorker(QObject):
             ss['first_index'] = firstInd == i
             ss['file_path'] = dm.path(s=scale, l=i)
             ss['path_reference'] = dm.path_ref(s=scale, l=i)
+            ss['path_zarr_raw'] = dm.path_zarr_raw(s=scale)
+            ss['path_swim_store'] = path_swim_store
+            ss['ss_hash'] = dm.ssHash(s=scale, l=i)  # what the images in the store are made with
             ss['dir_signals'] = dm.dir_signals(s=scale, l=i)
             ss['dir_matches'] = dm.dir_matches(s=scale, l=i)
             ss['dir_tmp'] = dm.dir_tmp(s=scale, l=i)
@@ -152,7 +204,10 @@ class AlignWorker(QObject):
                     result_cached = self.dm.ht.haskey(self.dm.swim_settings(s=scale, l=i))
                     thumbs_exist = Path(ss['path_thumb_transformed']).exists() and Path(ss['path_gif']).exists()
                     must_generate = _glob_config['generate_thumbnails'] and not thumbs_exist
-                    if must_generate or not result_cached:
+                    # The deferred thumbnails of sections ingested before an interruption may not have
+                    # been rendered: render them from the cached result instead of aligning again
+                    resumed = i in done and _glob_config['defer_thumbnails']
+                    if (must_generate and not resumed) or not result_cached:
                         _actual_indexes.append(i)
                         tasks.append(ss)
                     else:
@@ -163,6 +218,7 @@ class AlignWorker(QObject):
                             dm['stack'][i]['levels'][scale].update({'mir_afm': result['mir_afm']})
                             dm['stack'][i]['levels'][scale].update({'mir_aim': result['mir_aim']})
                             dm['stack'][i]['levels'][scale].update({'snr': result['snr']})
+                            dm.results_changed(i, s=scale)
                         except:
                             print_exception()
                             self.hudWarning.emit(f'[{i}] Cached data exists, but certain keys are missing. This '
@@ -170,6 +226,8 @@ class AlignWorker(QObject):
                             _actual_indexes.append(i)
                             tasks.append(ss)
                             continue
+                        if must_generate:
+                            redraw.append((ss, result))
                         logger.info(f"[{i}] Cache hit")
 
         # _prev_snr = dm.indexes_to_snr_list(_actual_indexes)
@@ -180,24 +238,16 @@ class AlignWorker(QObject):
         img_size = dm.image_size(s=scale)
         max_window = [0, 0]
         for t in tasks:
-            mo = t['method_opts']
-            method = mo['method']
-            if method == 'grid':
-                if not t.get('is_refinement', False):
-                    # Coarsest scale uses 1x1 ingredient (largest window)
-                    w, h = mo['size_1x1']
-                    max_window = [max(max_window[0], w), max(max_window[1], h)]
-                # All scales use 2x2 ingredient
-                w, h = mo['size_2x2']
-                max_window = [max(max_window[0], w), max(max_window[1], h)]
-            elif method == 'manual':
-                s = mo['size']
-                max_window = [max(max_window[0], s), max(max_window[1], s)]
+            w, h = swim_window(t)
+            max_window = [max(max_window[0], w), max(max_window[1], h)]
         if max_window[0] > 0:
-            per_worker = estimate_swim_memory(img_size, max_window)
+            # Fitted to the peaks measured for past tasks on this machine, once there are enough
+            per_worker = memmodel.predict('align', img_size[0] * img_size[1], max_window[0] * max_window[1],
+                                          default=estimate_swim_memory(img_size, max_window))
         else:
             per_worker = 1
         self.cpus, info = compute_worker_count(len(tasks), per_worker)
+        self.governor = memgovernor.for_stage(self.pool, len(tasks), info)
 
         self.hudMessage.emit(
             f'{info["n_tasks"]} tasks, {info["cpus"]} workers '
@@ -205,32 +255,63 @@ class AlignWorker(QObject):
             f'{info["per_worker_mb"]:.0f} MB/worker, '
             f'{info["available_gb"]:.1f}/{info["total_gb"]:.0f} GB RAM, '
             f'{info["phys_cores"]} cores, limited by {info["limiting_factor"]})'
+            + (f', adapting up to {self.governor.ceiling} workers to memory use' if self.governor else '')
         )
 
+        chunksize = 1
+        if cfg.SCHEDULE_BY_COST:
+            # Costliest first (from past timings, window sizes and failures), so that no long section is
+            # left for the end. Contiguous runs of sections stay on one worker for neighbour reuse.
+            costs = scheduler.estimate_costs(tasks, [dm['stack'][t['index']]['levels'][scale].get('results')
+                                                     for t in tasks])
+            tasks, chunksize = scheduler.schedule(tasks, costs, self.cpus,
+                                                  contiguous=_glob_config['reuse_neighbours'])
+        elif _glob_config['reuse_neighbours']:
+            # Hand each worker contiguous runs of sections so that it can reuse the decoded
+            # images and patch FFTs of its previous section. ~4 runs per worker keeps the load balanced.
+            tasks.sort(key=lambda t: t['index'])
+            chunksize = max(1, len(tasks) // (self.cpus * cfg.RUNS_PER_WORKER))
+
+        # Thumbnails and GIFs are rendered by a separate, lower priority pool, fed with each
+        # section as its alignment result arrives, so that they do not hold up the alignment workers.
+        thumbs = None
+        if _glob_config['generate_thumbnails'] and _glob_config['defer_thumbnails']:
+            thumbs = ThumbnailStage(tasks + [t for t, _ in redraw], cfg.THUMBNAIL_WORKERS)
+            for t, result in redraw:
+                thumbs.submit(dict(result, index=t['index']))
+            if redraw:
+                self.hudMessage.emit(f'Resuming: rendering the thumbnails of {len(redraw)} sections aligned before')
+
+        # Results are ingested as they arrive and checkpointed every CHECKPOINT_EVERY results or
+        # CHECKPOINT_SECONDS, so that an interrupted run keeps (and can resume from) what it finished.
+        checkpoint = dm['level_data'][scale]['checkpoint'] = {
+            'started': checkpoint['started'] if checkpoint else time.time(),
+            'indexes': sorted(self.indexes),
+            'done': sorted(done),
+        }
+        self._n_ingested, self._t_checkpoint = 0, time.time()
+
+        def on_result(r):
+            self.ingest_result(r, scale)
+            if thumbs:
+                thumbs.submit(r)
+
+        img_px = img_size[0] * img_size[1]
+        recorder = memmodel.recorder('align', [(img_px, int(np.prod(swim_window(t)))) for t in tasks])
+
         desc = f"Compute Alignment"
-        dt, succ, fail, results = self.run_multiprocessing(run_recipe, tasks, desc)
+        dt, succ, fail, results = self.run_multiprocessing(run_recipe, tasks, desc, chunksize=chunksize,
+                                                           on_result=on_result, recorder=recorder)
         self.dm.t_align = dt
+        if recorder:
+            self.hudMessage.emit(f"Memory model (align): {recorder.model.describe('align')}")
         if fail:
             self.hudWarning.emit(f"Something went wrong! # Success: {succ} / # Failed: {fail}")
 
-        for r in results:
-            if r['complete']:
-                layer = int(r['index'])
-                try:
-                    assert np.array(r['affine_matrix']).shape == (2, 3)
-                except:
-                    self.hudWarning.emit(f'[{i}] No affine was returned for this layer. This may indicate a failed alignment.')
-                    continue
-                ss = dm.swim_settings(s=scale, l=layer)
-                self.dm.ht.put(ss, r)
-                dm['stack'][layer]['levels'][scale].update({'results': r})
-                dm['stack'][layer]['levels'][scale].update({'mir_afm': r['mir_afm']})
-                dm['stack'][layer]['levels'][scale].update({'mir_aim': r['mir_aim']})
-                dm['stack'][layer]['levels'][scale].update({'affine_matrix': r['affine_matrix']})
-                dm['stack'][layer]['levels'][scale].update({'snr': r['snr']})
-                # self.dict_to_file(i, 'results.json', r)
-            else:
-                logger.warning(f"Recipe Maker reports incomplete alignment, index={r['index']}")
+        if self.running():
+            dm['level_data'][scale].pop('checkpoint', None)
+        else:
+            self.cancelled(tasks, scale)
 
         if not self.dm['level_data'][scale]['aligned']:
             self.dm['level_data'][scale]['initial_snr'] = self.dm.snr_list()
@@ -238,12 +319,21 @@ class AlignWorker(QObject):
         # Clear stale flag - results are now fresh after alignment
         self.dm['level_data'][scale]['results_stale'] = False
 
-        dm.ht.pickle()
+        dm.ht.flush()
 
         try:
             dm.set_stack_cafm()
         except:
             print_exception()
+
+        # The thumbnails and GIFs of every section must exist before the results are presented
+        if thumbs:
+            if self.running():
+                self.hudMessage.emit(f'Generating {thumbs.pending()} thumbnails...')
+                thumbs.join()
+            else:
+                thumbs.terminate()
+
         dm.save(silently=True)
 
         try:
@@ -255,33 +345,107 @@ class AlignWorker(QObject):
 
 
 
-    def run_multiprocessing(self, func, tasks, desc):
+    def ingest_result(self, r, scale):
+        '''Store one alignment result in the data model and cache, checkpointing periodically.'''
+        dm = self.dm
+        if r['complete']:
+            layer = int(r['index'])
+            try:
+                assert np.array(r['affine_matrix']).shape == (2, 3)
+            except:
+                self.hudWarning.emit(f'[{layer}] No affine was returned for this layer. This may indicate a failed alignment.')
+                return
+            ss = dm.swim_settings(s=scale, l=layer)
+            dm.ht.put(ss, r)
+            dm['stack'][layer]['levels'][scale].update({'results': r})
+            dm['stack'][layer]['levels'][scale].update({'mir_afm': r['mir_afm']})
+            dm['stack'][layer]['levels'][scale].update({'mir_aim': r['mir_aim']})
+            dm['stack'][layer]['levels'][scale].update({'affine_matrix': r['affine_matrix']})
+            dm['stack'][layer]['levels'][scale].update({'snr': r['snr']})
+            dm.results_changed(layer, s=scale)
+            dm['level_data'][scale]['checkpoint']['done'].append(layer)
+        else:
+            logger.warning(f"Recipe Maker reports incomplete alignment, index={r['index']}")
+
+        self._n_ingested += 1
+        if self._n_ingested % cfg.CHECKPOINT_EVERY == 0 or \
+                time.time() - self._t_checkpoint > cfg.CHECKPOINT_SECONDS:
+            self.checkpoint()
+
+    def cancelled(self, tasks, scale):
+        '''Remove the temporary files of the sections a cancelled run did not finish, and report them.'''
+        done = set(self.dm['level_data'][scale]['checkpoint']['done'])
+        remaining = sorted(t['index'] for t in tasks if t['index'] not in done)
+        for t in tasks:
+            if t['index'] not in done:
+                shutil.rmtree(t['dir_tmp'], ignore_errors=True)
+        self.checkpoint()
+        if self.ignore_cache:
+            again = 'Re-aligning while ignoring the cache starts over, aligning without it'
+        else:
+            again = 'Aligning again'
+        self.hudWarning.emit(f'Alignment cancelled: {len(tasks) - len(remaining)} of {len(tasks)} sections finished. '
+                             f'{again} will only do the remaining {len(remaining)}: {index_ranges(remaining)}')
+
+    def checkpoint(self):
+        t0 = time.time()
+        try:
+            self.dm.ht.flush()
+            self.dm.save(silently=True)
+        except:
+            print_exception()
+        self._t_checkpoint = time.time()
+        logger.info(f'Checkpoint after {self._n_ingested} results ({self._t_checkpoint - t0:.3g}s)')
+
+    def run_multiprocessing(self, func, tasks, desc, chunksize=1, on_result=None, recorder=None):
         # Returns 4 objects dt, succ, fail, results
+        # on_result (optional) is called with each result as it arrives
+        # recorder (optional) records the peak memory of each task in the memory model
         print(f"----> {desc} ---->")
         _break = 0
         self.initPbar.emit((len(tasks), desc))
         t0 = time.time()
-        if sys.platform == 'win32':
-            ctx = mp.get_context('spawn')
-        else:
-            ctx = mp.get_context('forkserver')
         n = len(tasks)
         i, results = 0, []
-        # with ctx.Pool(processes=self.cpus, maxtasksperchild=1) as pool:
-        with ctx.Pool(processes=self.cpus) as pool:
+        # Workers log through a queue, drained into the project's rotating logs by a listener in this process
+        logs_dir = os.path.join(self.dm.data_file_path, 'logs') if cfg.LOG_RECIPE_TO_FILE else None
+        listener = None
+        if self.pool:
+            self.pool.logs.set_logs_dir(logs_dir)
+        elif logs_dir:
+            listener = LogListener(logs_dir, ctx=get_context(), max_bytes=cfg.LOG_MAX_BYTES,
+                                   backups=cfg.LOG_BACKUPS).start()
+        initargs = (listener.queue if listener else None, cfg.LOG_HOT_PATH_QUIET)
+        results_iter = imap_unordered(func, tasks, self.cpus, chunksize=chunksize, service=self.pool,
+                                      initializer=logpipe.worker_init, initargs=initargs,
+                                      governor=self.governor, recorder=recorder)
+        try:
             for result in tqdm.tqdm(
-                    pool.imap_unordered(func, tasks),
+                    results_iter,
                     total=n,
                     desc=desc,
                     position=0,
                     leave=True):
                 results.append(result)
+                if on_result:
+                    on_result(result)
                 i += 1
                 self.progress.emit(i)
                 if not self.running():
                     _break = 1
                     print(f"<==== BREAKING ABRUPTLY <====")
                     break
+        finally:
+            results_iter.close()
+            if self.pool and not self.running():
+                # Cancelled: rather than wait for the tasks in flight, stop them and their swim/mir processes
+                self.pool.abort(cfg.CANCEL_TIMEOUT)
+            if listener:
+                listener.stop()
+            if self.pool:
+                self.pool.logs.set_logs_dir(None)
+        if self.governor:
+            logger.info(f'{desc}: {self.governor.summary()}')
         fail = len(tasks) - len(results)
         succ = len(results) - fail
         dt = time.time() - t0
@@ -418,17 +582,43 @@ class AlignWorker(QObject):
 
 
 
-def run_command(cmd, arg_list=None, cmd_input=None):
-    # logger.info("\n================== Run Command ==================")
-    cmd_arg_list = [cmd]
-    if arg_list != None:
-        cmd_arg_list = [a for a in arg_list]
-        cmd_arg_list.insert(0, cmd)
-    # Note: decode bytes if universal_newlines=False in Popen (cmd_stdout.decode('utf-8'))
-    cmd_proc = sp.Popen(cmd_arg_list, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
-    cmd_stdout, cmd_stderr = cmd_proc.communicate(cmd_input)
-    # logger.info(f"\nSTDOUT:\n{cmd_stdout}\n\nSTDERR:\n{cmd_stderr}\n")
-    return ({'out': cmd_stdout, 'err': cmd_stderr, 'rc': cmd_proc.returncode})
+class ThumbnailStage:
+    '''Post-alignment stage that renders each section's thumbnail and GIF in its own pool of
+    n_workers processes, running at a lower (nice) priority than the alignment workers.
+    Sections are submitted as their alignment results stream in.'''
+
+    def __init__(self, tasks, n_workers):
+        self._tasks = {t['index']: t for t in tasks}
+        self._pending = []
+        self._pool = get_context().Pool(processes=max(1, n_workers), initializer=process_group_init,
+                                        initargs=(_lower_priority,))
+
+    def submit(self, result):
+        task = self._tasks.get(result['index'])
+        if task is None:
+            return
+        task = dict(task, afm=result.get('affine_matrix', [[1., 0., 0.], [0., 1., 0.]]))
+        self._pending.append(self._pool.apply_async(run_thumbnail, (task,)))
+
+    def pending(self):
+        return sum(1 for r in self._pending if not r.ready())
+
+    def join(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        pids = [p.pid for p in self._pool._pool]
+        self._pool.terminate()
+        self._pool.join()
+        kill_process_groups(pids, cfg.CANCEL_TIMEOUT)
+
+
+def _lower_priority():
+    try:
+        os.nice(cfg.THUMBNAIL_NICE)
+    except (AttributeError, OSError):
+        pass  # not available on this platform
 
 
 def run_subprocess(task):
@@ -495,6 +685,29 @@ def save2file(dm, name):
         f.write(proj_json)
 
 
+def index_ranges(indexes):
+    '''Sorted indexes as a compact string, e.g. [1, 2, 3, 7, 9, 10] -> '1-3, 7, 9-10'.'''
+    runs = []
+    for i in indexes:
+        if runs and i == runs[-1][1] + 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return ', '.join(f'{a}-{b}' if b > a else f'{a}' for a, b in runs)
+
+
+def swim_window(ss):
+    '''(width, height) of the largest SWIM window of an alignment task.'''
+    mo = ss['method_opts']
+    if mo['method'] == 'grid':
+        # Coarsest scale uses the 1x1 ingredient (largest window), all scales the 2x2 ingredients
+        sizes = [mo['size_2x2']] if ss.get('is_refinement', False) else [mo['size_1x1'], mo['size_2x2']]
+        return max(w for w, h in sizes), max(h for w, h in sizes)
+    elif mo['method'] == 'manual':
+        return mo['size'], mo['size']
+    return 0, 0
+
+
 def convert_zarr(task):
     try:
         ID = task[0]
@@ -1,11 +1,8 @@
 #!/usr/bin/env python3
 import copy
 import logging
-import multiprocessing as mp
 import os
 import shutil
-import subprocess as sp
-import sys
 import time
 import ctypes
 from math import floor
@@ -27,7 +24,11 @@ from qtpy.QtCore import Signal, QObject, QMutex
 from src.utils.helpers import get_bindir, print_exception, compute_worker_count
 from src.utils.funcs_image import ImageSize
 from src.core.thumbnailer import Thumbnailer
+from src.core.poolservice import imap_unordered
+from src.core import memgovernor, memmodel
 from src.utils.swiftir import applyAffine
+from src.utils.coprocess import run_binary
+import src.config as cfg
 
 __all__ = ['ZarrWorker']
 
@@ -44,13 +45,15 @@ class ZarrWorker(QObject):
     GENERATE_ANIMATIONS = True
     GENERATE_MINI_ZARR = False
 
-    def __init__(self, dm, renew=False, ignore_cache=False):
+    def __init__(self, dm, renew=False, ignore_cache=False, pool=None):
         super().__init__()
         logger.info(f'Initializing [renew={renew}] [ignore_cache={ignore_cache}]...')
         self.dm = dm
         self.level = dm.level
         self.renew = renew
         self.ignore_cache = ignore_cache
+        self.pool = pool  # PoolService of the main window, if any
+        self.governor = None  # MemoryGovernor of the running stage, if concurrency adapts to memory use
         self._running = True
         self._mutex = QMutex()
 
@@ -66,6 +69,8 @@ class ZarrWorker(QObject):
         self._mutex.lock()
         self._running = False
         self._mutex.unlock()
+        if self.pool:
+            self.pool.cancel()
 
     def run(self):
         print(f"====> Running Background Thread ====>")
@@ -78,7 +83,7 @@ class ZarrWorker(QObject):
         logger.critical(f"\n\nPerforming apply cumulative "
                         f"transformation as Zarr protocol...\n")
         dm = self.dm
-        dm.set_stack_cafm()
+        dm.set_stack_cafm(full=True)  # Output must not depend on every change having been marked
         grp = Path(dm.data_dir_path) / 'zarr' / f's{dm.lvl()}'
         zarrExist = (grp / '.zattrs').exists()
         print(f"\nZarr exist? {zarrExist}\n")
@@ -148,8 +153,10 @@ class ZarrWorker(QObject):
         img_w, img_h = dm.image_size()
         bb_w, bb_h = rect[2], rect[3]
         _OVERHEAD = 150 * 1024 * 1024
-        per_worker_mir = _OVERHEAD + img_w * img_h + 2 * bb_w * bb_h
+        px = img_w * img_h + 2 * bb_w * bb_h
+        per_worker_mir = memmodel.predict('generate', px, default=_OVERHEAD + px)
         self.cpus, info = compute_worker_count(len(tasks), per_worker_mir)
+        self.governor = memgovernor.for_stage(self.pool, len(tasks), info)
 
         self.hudMessage.emit(
             f'{info["n_tasks"]} tasks, {info["cpus"]} workers '
@@ -159,7 +166,8 @@ class ZarrWorker(QObject):
         )
 
         desc = f"Generate Cumulative Transformation Images"
-        t, *_ = self.run_multiprocessing(run_mir, tasks, desc)
+        t, *_ = self.run_multiprocessing(run_mir, tasks, desc,
+                                         recorder=memmodel.recorder('generate', [(px, 0)] * len(tasks)))
 
         scale_factor = dm.images['thumbnail_scale_factor'] // dm.lvl()
         Thumbnailer(dm).reduce_tuples(to_reduce, scale_factor=scale_factor)
@@ -237,8 +245,9 @@ class ZarrWorker(QObject):
                 logger.info('Stopping Neuroglancer...')
                 ng.server.stop()
             # Each worker reads transformed TIFF + writes to zarr
-            per_worker_zarr = _OVERHEAD + 2 * bb_w * bb_h
+            per_worker_zarr = memmodel.predict('generate_zarr', 2 * bb_w * bb_h, default=_OVERHEAD + 2 * bb_w * bb_h)
             self.cpus, info = compute_worker_count(len(tasks), per_worker_zarr)
+            self.governor = memgovernor.for_stage(self.pool, len(tasks), info)
             self.hudMessage.emit(
                 f'{info["n_tasks"]} tasks, {info["cpus"]} workers '
                 f'({info["per_worker_mb"]:.0f} MB/worker, '
@@ -247,7 +256,8 @@ class ZarrWorker(QObject):
             )
             desc = f"Copy-convert to Zarr"
             # t, *_ = self.run_multiprocessing(convert_zarr, tasks, desc)
-            t, *_ = self.run_multiprocessing(convert_zarr_block, tasks, desc)
+            t, *_ = self.run_multiprocessing(convert_zarr_block, tasks, desc,
+                                             recorder=memmodel.recorder('generate_zarr', [(2 * bb_w * bb_h, 0)] * len(tasks)))
             self.dm.t_convert_zarr = t
         else:
             self.dm.t_convert_zarr = 0.
@@ -304,23 +314,19 @@ class ZarrWorker(QObject):
         return failed > 0
 
 
-    def run_multiprocessing(self, func, tasks, desc):
+    def run_multiprocessing(self, func, tasks, desc, recorder=None):
         # Returns 4 objects dt, succ, fail, results
         print(f"----> {desc} ---->")
         _break = 0
         self.initPbar.emit((len(tasks), desc))
         t0 = time.time()
-        if sys.platform == 'win32':
-            ctx = mp.get_context('spawn')
-        else:
-            ctx = mp.get_context('forkserver')
-
         n = len(tasks)
         i, results = 0, []
-        # with ctx.Pool(processes=self.cpus, maxtasksperchild=1) as pool:
-        with ctx.Pool(processes=self.cpus) as pool:
+        results_iter = imap_unordered(func, tasks, self.cpus, service=self.pool, governor=self.governor,
+                                      recorder=recorder)
+        try:
             for result in tqdm.tqdm(
-                    pool.imap_unordered(func, tasks),
+                    results_iter,
                     total=n,
                     desc=desc,
                     position=0,
@@ -332,6 +338,13 @@ class ZarrWorker(QObject):
                     _break = 1
                     print(f"<==== BREAKING ABRUPTLY <====")
                     break
+        finally:
+            results_iter.close()
+            if self.pool and not self.running():
+                # Cancelled: stop the tasks in flight and their mir processes instead of waiting for them
+                self.pool.abort(cfg.CANCEL_TIMEOUT)
+        if not self.running():
+            self.hudWarning.emit(f'{desc} cancelled after {len(results)} of {n} tasks')
         fail = len(tasks) - len(results)
         succ = len(results) - fail
         dt = time.time() - t0
@@ -385,22 +398,6 @@ def set_zarr_attribute(z, key, value):
 
 
 
-def run_command(cmd, arg_list=None, cmd_input=None):
-    # logger.info("\n================== Run Command ==================")
-    cmd_arg_list = [cmd]
-    if arg_list != None:
-        cmd_arg_list = [a for a in arg_list]
-        cmd_arg_list.insert(0, cmd)
-    # Note: decode bytes if universal_newlines=False in Popen (cmd_stdout.decode('utf-8'))
-    cmd_proc = sp.Popen(cmd_arg_list, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
-    cmd_stdout, cmd_stderr = cmd_proc.communicate(cmd_input)
-    # logger.info(f"\nSTDOUT:\n{cmd_stdout}\n\nSTDERR:\n{cmd_stderr}\n")
-    # exit_code = cmd_proc.wait() #1031+
-    # type(cmd_proc.returncode) = int
-    # type(cmd_proc.wait()) = int
-    return ({'out': cmd_stdout, 'err': cmd_stderr, 'rc': cmd_proc.returncode})
-
-
 def run_mir(task):
     in_fn = task[0]
     out_fn = task[1]
@@ -426,6 +423,7 @@ def run_mir(task):
     b = cafm[1][0]
     d = cafm[1][1]
     f = cafm[1][2] + offset_y
+    partial = os.path.join(os.path.dirname(out_fn), '.partial_' + os.path.basename(out_fn))
 
     mir_script = \
         'B %d %d 1\n' \
@@ -433,9 +431,14 @@ def run_mir(task):
         'F %s\n' \
         'A %g %g %g %g %g %g\n' \
         'RW %s\n' \
-        'E' % (bb_x, bb_y, border, in_fn, a, c, e, b, d, f, out_fn)
-    o = run_command(mir_c, arg_list=[], cmd_input=mir_script)
-    rc = o['rc']
+        'E' % (bb_x, bb_y, border, in_fn, a, c, e, b, d, f, partial)
+    # mir writes to a partial file that replaces out_fn once complete, so that a cancelled or
+    # failed task never leaves behind an output that a later run would take for a cache hit
+    _, _, rc = run_binary(mir_c, cmd_input=mir_script, timeout=cfg.BINARY_TIMEOUT)
+    if rc == 0 and os.path.exists(partial):
+        os.replace(partial, out_fn)
+    elif os.path.exists(partial):
+        os.remove(partial)
     # logger.critical(pformat(o))
     # return 0
     return rc
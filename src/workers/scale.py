@@ -4,7 +4,6 @@ import numcodecs
 numcodecs.blosc.use_threads = False
 
 import os
-import sys
 import time
 import logging
 from copy import deepcopy
@@ -12,7 +11,6 @@ from pathlib import Path
 
 from os import kill
 from subprocess import PIPE, Popen
-import multiprocessing as mp
 import subprocess as sp
 import zarr
 import imagecodecs
@@ -25,11 +23,14 @@ numcodecs.blosc.use_threads = False
 import numpy as np
 
 from src.core.thumbnailer import Thumbnailer
+from src.core.poolservice import imap_unordered
+from src.core import memgovernor, memmodel
 from src.utils.helpers import print_exception, get_bindir, get_scale_val, path_to_str, compute_worker_count
 # from src.funcs_zarr import preallocate_zarr
 from src.utils.funcs_zarr import remove_zarr
 from src.utils.readers import read
 from src.utils.writers import write
+import src.config as cfg
 from qtpy.QtCore import Signal, QObject, QMutex
 
 __all__ = ['ScaleWorker']
@@ -46,7 +47,7 @@ class ScaleWorker(QObject):
     hudMessage = Signal(str) # (# tasks, description)
     hudWarning = Signal(str) # (# tasks, description)
 
-    def __init__(self, src, out, scales, opts):
+    def __init__(self, src, out, scales, opts, pool=None):
         super().__init__()
         logger.info('')
         self.src = src
@@ -54,6 +55,7 @@ class ScaleWorker(QObject):
         self.opts = opts
         self.scales = list(scales)
         self.paths = self.opts['paths']
+        self.pool = pool  # PoolService of the main window, if any
         self.result = None
         self._mutex = QMutex()
         self._running = True
@@ -73,6 +75,8 @@ class ScaleWorker(QObject):
         self._mutex.lock()
         self._running = False
         self._mutex.unlock()
+        if self.pool:
+            self.pool.cancel()
         self.finished.emit()
 
 
@@ -118,7 +122,8 @@ class ScaleWorker(QObject):
                 # iscale2 subprocess: reads source image + writes scaled output
                 # Each iscale2 process is independent — use multiprocessing for full parallelism
                 _ISCALE2_OVERHEAD = 100 * 1024 * 1024  # subprocess overhead
-                per_worker = _ISCALE2_OVERHEAD + src_size[0] * src_size[1] + siz[0] * siz[1]
+                px = src_size[0] * src_size[1] + siz[0] * siz[1]
+                per_worker = memmodel.predict('scale', px, default=_ISCALE2_OVERHEAD + px)
                 cpus, info = compute_worker_count(len(tasks), per_worker)
                 self.hudMessage.emit(
                     f'Reducing {s}: {info["n_tasks"]} tasks, {info["cpus"]} workers '
@@ -126,19 +131,19 @@ class ScaleWorker(QObject):
                     f'{info["available_gb"]:.1f}/{info["total_gb"]:.0f} GB RAM, '
                     f'{info["phys_cores"]} cores, limited by {info["limiting_factor"]})'
                 )
-                if sys.platform == 'win32':
-                    ctx = mp.get_context('spawn')
-                else:
-                    ctx = mp.get_context('forkserver')
-                with ctx.Pool(processes=cpus) as pool:
-                    for i, result in enumerate(tqdm.tqdm(
-                            pool.imap_unordered(run, tasks),
-                            total=len(tasks),
-                            desc=desc, position=0,
-                            leave=True)):
-                        self.progress.emit(i)
-                        if not self.running():
-                            break
+                for i, result in enumerate(tqdm.tqdm(
+                        imap_unordered(run, tasks, cpus, service=self.pool,
+                                       governor=memgovernor.for_stage(self.pool, len(tasks), info),
+                                       recorder=memmodel.recorder('scale', [(px, 0)] * len(tasks))),
+                        total=len(tasks),
+                        desc=desc, position=0,
+                        leave=True)):
+                    self.progress.emit(i)
+                    if not self.running():
+                        break
+                if self.pool and not self.running():
+                    # Cancelled: stop the iscale2 processes in flight instead of waiting for them
+                    self.pool.abort(cfg.CANCEL_TIMEOUT)
 
 
                 dt = time.time() - t
@@ -236,7 +241,7 @@ class ScaleWorker(QObject):
             # Each worker reads TIFF at this scale + writes to zarr
             # chunk_z=1 ensures each image maps to independent chunks (no contention)
             _ZARR_OVERHEAD = 250 * 1024 * 1024  # forkserver child process
-            per_worker_zarr = _ZARR_OVERHEAD + 2 * x * y
+            per_worker_zarr = memmodel.predict('scale_zarr', 2 * x * y, default=_ZARR_OVERHEAD + 2 * x * y)
             cpus, info = compute_worker_count(len(tasks), per_worker_zarr)
             self.hudMessage.emit(
                 f'Converting {s} to Zarr: {info["n_tasks"]} tasks, {info["cpus"]} workers '
@@ -244,23 +249,22 @@ class ScaleWorker(QObject):
                 f'{info["available_gb"]:.1f}/{info["total_gb"]:.0f} GB RAM, '
                 f'{info["phys_cores"]} cores, limited by {info["limiting_factor"]})'
             )
-            if sys.platform == 'win32':
-                ctx = mp.get_context('spawn')
-            else:
-                ctx = mp.get_context('forkserver')
-            with ctx.Pool(processes=cpus) as pool:
-                for result in tqdm.tqdm(
-                        pool.imap_unordered(convert_zarr, tasks),
-                        total=len(tasks),
-                        desc=desc,
-                        position=0,
-                        leave=True):
-
-                    all_results.append(result)
-                    i += 1
-                    self.progress.emit(i)
-                    if not self.running():
-                        break
+            for result in tqdm.tqdm(
+                    imap_unordered(convert_zarr, tasks, cpus, service=self.pool,
+                                   governor=memgovernor.for_stage(self.pool, len(tasks), info),
+                                   recorder=memmodel.recorder('scale_zarr', [(2 * x * y, 0)] * len(tasks))),
+                    total=len(tasks),
+                    desc=desc,
+                    position=0,
+                    leave=True):
+
+                all_results.append(result)
+                i += 1
+                self.progress.emit(i)
+                if not self.running():
+                    break
+            if self.pool and not self.running():
+                self.pool.abort(cfg.CANCEL_TIMEOUT)
 
             dt = time.time() - t
             self._timing_results['t_scale_convert'][s] = dt
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import os
+import sys
+import unittest
+
+sys.path.insert(1, os.path.dirname(os.path.split(os.path.realpath(__file__))[0]))
+
+import numpy as np
+
+try:
+    from src.utils.funcs_image import BiasFuncs, BiasMats, composeAffine, identityAffine
+except ImportError as e:  # imagecodecs, ...
+    BiasFuncs = None
+
+
+def baseline_bias_funcs(cafms, poly_order):
+    '''BiasFuncs as it was before it took arrays: the cafm hashes of existing projects depend on
+    every bit of its result.'''
+    n = len(cafms)
+    arrays = {k: np.zeros((n, 2)) for k in ('scale_x', 'scale_y', 'skew_x', 'rot', 'x', 'y')}
+    for i, c in enumerate(cafms):
+        c_afm = np.array(c)
+        rot = np.arctan2(c_afm[1, 0], c_afm[0, 0])
+        scale_x = np.sqrt(c_afm[0, 0] ** 2 + c_afm[1, 0] ** 2)
+        scale_y = ((c_afm[1, 1] * c_afm[0, 0]) - (c_afm[0, 1] * c_afm[1, 0])) / scale_x
+        skew_x = ((c_afm[0, 0] * c_afm[0, 1]) + (c_afm[1, 0] * c_afm[1, 1])) / (scale_x * scale_y)
+        for k, v in (('scale_x', scale_x), ('scale_y', scale_y), ('skew_x', skew_x), ('rot', rot),
+                     ('x', c_afm[0, 2]), ('y', c_afm[1, 2])):
+            arrays[k][i] = [i, v]
+    bias_funcs = {}
+    for k, a in arrays.items():
+        bias_funcs[k] = np.zeros(poly_order + 1)
+        p = np.polyfit(a[:, 0], a[:, 1], poly_order)
+        bias_funcs[k][:-1] += p[:-1]
+        bias_funcs[k][poly_order] = p[poly_order]
+    return bias_funcs
+
+
+def baseline_bias_mat(x, bias_funcs, right=False):
+    '''BiasMat (right=False) and alt_BiasMat (right=True) of a single section, as before BiasMats.'''
+    poly_order = len(bias_funcs['x']) - 1
+    xdot = np.arange(poly_order, 0, -1, dtype='float64')
+    dp = {k: np.poly1d(bias_funcs[k][:-1] * xdot)(x) for k in bias_funcs}
+    rot_bias = -dp['rot']
+    mats = [np.array([[1 - dp['scale_x'], 0.0, 0.0], [0.0, 1 - dp['scale_y'], 0.0]]),
+            np.array([[1.0, -dp['skew_x'], 0.0], [0.0, 1.0, 0.0]]),
+            np.array([[np.cos(rot_bias), -np.sin(rot_bias), 0.0], [np.sin(rot_bias), np.cos(rot_bias), 0.0]]),
+            np.array([[1.0, 0.0, -dp['x']], [0.0, 1.0, -dp['y']]])]
+    bias_mat = identityAffine()
+    for m in mats:
+        bias_mat = composeAffine(bias_mat, m) if right else composeAffine(m, bias_mat)
+    return bias_mat
+
+
+def random_cafms(rng, n):
+    cafms = []
+    for _ in range(n):
+        c = np.eye(3)[:2] + rng.normal(0, [[.05, .05, 100.], [.05, .05, 100.]])
+        cafms.append(c.tolist())
+    return cafms
+
+
+@unittest.skipIf(BiasFuncs is None, 'funcs_image dependencies are not installed')
+class TestBiasFuncs(unittest.TestCase):
+
+    def test_bit_identical_to_baseline(self):
+        rng = np.random.default_rng(0)
+        for k in range(200):
+            cafms = random_cafms(rng, int(rng.integers(5, 400)))
+            poly_order = k % 4
+            expected = baseline_bias_funcs(cafms, poly_order)
+            got = BiasFuncs(None, 's1', poly_order, cafms=cafms)
+            for key in expected:
+                np.testing.assert_array_equal(got[key], expected[key], err_msg=f'stack {k}, {key}')
+
+    def test_bias_mats_bit_identical_to_baseline(self):
+        rng = np.random.default_rng(1)
+        for k in range(60):
+            poly_order = k % 4 + 1
+            bias_funcs = {key: rng.normal(0, .3, poly_order + 1) / 10. ** np.arange(poly_order, -1, -1)
+                          for key in ('scale_x', 'scale_y', 'skew_x', 'rot', 'x', 'y')}
+            n = int(rng.integers(5, 200))
+            for right in (False, True):
+                got = BiasMats(np.arange(n), bias_funcs, right=right)
+                for i in range(n):
+                    np.testing.assert_array_equal(got[i, :2], baseline_bias_mat(i, bias_funcs, right),
+                                                  err_msg=f'stack {k}, section {i}, right={right}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import gc
+import os
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+import warnings
+
+sys.path.insert(1, os.path.dirname(os.path.split(os.path.realpath(__file__))[0]))
+
+from src.utils.coprocess import CoProcess, CoProcessError, run_swim, shutdown
+
+# Stands in for `swim WxH` in batch mode: one stdout line per command line, except that an image it
+# can't read gets one "Can't read_img" line on stderr, and later lines naming it get no answer at all.
+FAKE_SWIM = textwrap.dedent('''
+    import os, sys
+    bad = set()
+    for line in sys.stdin:
+        args = line.split()
+        missing = [a for a in args if a.endswith('.tif') and not os.path.exists(a)]
+        if missing:
+            if missing[0] not in bad:
+                bad.add(missing[0])
+                print("Can't read_img " + missing[0], file=sys.stderr, flush=True)
+            continue
+        print('10.0: 32.0 32.0 1.0 ' + ' '.join(args[1:]), flush=True)
+''')
+
+
+class TestCoProcess(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.swim = os.path.join(self.dir.name, 'swim.py')
+        with open(self.swim, 'w') as f:
+            f.write(FAKE_SWIM)
+        self.img = os.path.join(self.dir.name, 'a.tif')
+        open(self.img, 'w').close()
+        self.missing = os.path.join(self.dir.name, 'missing.tif')
+
+    def tearDown(self):
+        shutdown()
+        self.dir.cleanup()
+
+    def quadrants(self, image):
+        return [f'ww_32 {self.img} {x} {y} {image} {x} {y}' for x, y in ((8, 8), (24, 8), (8, 24), (24, 24))]
+
+    def test_answers_every_line(self):
+        cp = CoProcess(sys.executable, [self.swim])
+        out, err = cp.request(self.quadrants(self.img), timeout=30)
+        self.assertEqual(len(out), 4)
+        cp.stop()
+
+    def test_unreadable_image_fails_fast(self):
+        cp = CoProcess(sys.executable, [self.swim])
+        t0 = time.monotonic()
+        with self.assertRaises(CoProcessError) as cm:
+            cp.request(self.quadrants(self.missing), timeout=30)
+        self.assertLess(time.monotonic() - t0, 10)
+        self.assertFalse(cm.exception.retry)
+        self.assertFalse(cp.alive())
+        # The restarted process serves the next request
+        out, err = cp.request(self.quadrants(self.img), timeout=30)
+        self.assertEqual(len(out), 4)
+        cp.stop()
+
+    def test_restarts_close_pipes(self):
+        cp = CoProcess(sys.executable, [self.swim])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ResourceWarning)
+            for _ in range(3):
+                with self.assertRaises(CoProcessError):
+                    cp.request(self.quadrants(self.missing), timeout=30)
+                cp.request(self.quadrants(self.img), timeout=30)
+                cp.stop()
+            time.sleep(0.5)  # let the pumps of the stopped processes end
+            gc.collect()
+        self.assertEqual([str(w.message) for w in caught if issubclass(w.category, ResourceWarning)], [])
+
+    def test_run_swim_unreadable_image(self):
+        t0 = time.monotonic()
+        out, err, rc = run_swim(sys.executable, self.swim, '\n'.join(self.quadrants(self.missing)), timeout=30)
+        self.assertLess(time.monotonic() - t0, 10)
+        self.assertEqual((out, rc), ('', 1))
+        self.assertIn("Can't read_img", err)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(1, os.path.dirname(os.path.split(os.path.realpath(__file__))[0]))
+
+from src.core.dispatch import DispatchService, FileQueue
+
+
+class TestDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.dir.name, 'queue')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_local_agents(self):
+        svc = DispatchService(self.root, local_agents=2, processes=1, poll=0.05, agent_timeout=30)
+        try:
+            out = list(svc.stream(abs, range(-40, 0), chunksize=3))
+        finally:
+            svc.shutdown()
+        self.assertEqual(sorted(out), list(range(1, 41)))
+        for d in ('pending', 'claimed', 'results'):
+            self.assertEqual(os.listdir(os.path.join(self.root, d)), [])
+
+    def test_chunk_finished_twice(self):
+        svc = DispatchService(self.root, poll=0.05, agent_timeout=30)
+        q = FileQueue(self.root)
+
+        def claim(agent):
+            while True:
+                claimed = q.claim(agent)
+                if claimed:
+                    return claimed
+                time.sleep(0.01)
+
+        def agents():
+            name, (func, chunk) = claim('slow')
+            q.release('slow', name)  # as requeue_stale() does when 'slow' looks stale
+            name, (func, chunk) = claim('other')
+            q.finish('other', name, (True, [func(t) for t in chunk]))
+            while os.listdir(q._path('results')):
+                time.sleep(0.01)
+            q.finish('slow', name, (True, [func(t) for t in chunk]))  # the slow agent finishes it too
+            name, (func, chunk) = claim('other')
+            q.finish('other', name, (True, [func(t) for t in chunk]))
+
+        t = threading.Thread(target=agents)
+        t.start()
+        out = list(svc.stream(abs, [-1, -2], chunksize=1))
+        t.join()
+        self.assertEqual(sorted(out), [1, 2])
+        self.assertEqual(os.listdir(q._path('results')), [])
+
+    def test_liveness_by_heartbeat_changes(self):
+        q = FileQueue(self.root)
+        q.heartbeat('a')
+        p = q._path('agents', 'a')
+        os.utime(p, (1000, 1000))  # a file server clock far behind this machine's
+        self.assertEqual(q.agents(0.2), ['a'])
+        time.sleep(0.3)
+        os.utime(p, (1001, 1001))
+        self.assertEqual(q.agents(0.2), ['a'])
+        time.sleep(0.3)
+        self.assertEqual(q.agents(0.2), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import os
+import sys
+import unittest
+
+sys.path.insert(1, os.path.dirname(os.path.split(os.path.realpath(__file__))[0]))
+
+from src.core.poolservice import imap_unordered
+
+
+class Service:
+    '''Runs tasks in this process, as a service whose tasks run on other machines.'''
+
+    remote = True
+
+    def stream(self, func, tasks, processes=None, chunksize=1, governor=None):
+        for t in tasks:
+            yield func(t)
+
+
+class Recorder:
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, i, peak):
+        self.records.append((i, peak))
+
+    def done(self):
+        pass
+
+
+class TestImapUnordered(unittest.TestCase):
+
+    def test_remote_service_is_not_recorded(self):
+        recorder = Recorder()
+        out = list(imap_unordered(abs, [-1, -2, 3], 1, service=Service(), recorder=recorder))
+        self.assertEqual(out, [1, 2, 3])
+        self.assertEqual(recorder.records, [])
+
+    def test_local_service_is_recorded(self):
+        recorder = Recorder()
+        service = Service()
+        service.remote = False
+        out = list(imap_unordered(abs, [-1, -2, 3], 1, service=service, recorder=recorder))
+        self.assertEqual(out, [1, 2, 3])
+        self.assertEqual(sorted(i for i, _ in recorder.records), [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import os
+import sys
+import unittest
+
+sys.path.insert(1, os.path.dirname(os.path.split(os.path.realpath(__file__))[0]))
+
+try:
+    from src.models.data import DataModel, SwimSettings
+except ImportError as e:  # numpy, zarr, qtpy, ...
+    DataModel = None
+    _reason = str(e)
+
+IDENTITY = [[1., 0., 0.], [0., 1., 0.]]
+
+# ssHash() of these settings in releases before swim settings hashes were memoized. They name the
+# data directories of sections and are stored in the zarr attributes, so they must not change.
+# (Section 0 has a SHA-256 digest of 2**63 or more, which hash() reduces.)
+BASELINE = {
+    0: 810564593454690272,
+    1: 4072021662756892461,
+    2: 4017569319659987764,
+    3: 8115078980667553850,
+    4: 1356684826951602587,
+    5: 7936077320675112670,
+}
+
+
+def settings(i):
+    return {'index': i, 'name': f'img{i:03d}.tif', 'level': 's4', 'include': True, 'is_refinement': False,
+            'img_size': [1024, 1024], 'init_afm': IDENTITY, 'iterations': 3, 'whitening': -0.68,
+            'method_opts': {'method': 'grid', 'size_1x1': [512, 512], 'size_2x2': [256, 256],
+                            'quadrants': [1, 1, 1, 1]}}
+
+
+@unittest.skipIf(DataModel is None, 'DataModel dependencies are not installed')
+class TestSsHash(unittest.TestCase):
+
+    def setUp(self):
+        self.dm = DataModel.__new__(DataModel)
+        self.dm._data = {'stack': [{'levels': {'s4': {'swim_settings': settings(i)}}} for i in BASELINE]}
+
+    def test_matches_baseline(self):
+        for i, h in BASELINE.items():
+            self.assertEqual(self.dm.ssHash(s='s4', l=i), h)
+
+    def test_follows_changes(self):
+        self.assertEqual(self.dm.ssHash(s='s4', l=0), BASELINE[0])
+        ss = self.dm['stack'][0]['levels']['s4']['swim_settings']
+        self.assertIsInstance(ss, SwimSettings)
+        ss['method_opts']['quadrants'][0] = 0
+        self.assertNotEqual(self.dm.ssHash(s='s4', l=0), BASELINE[0])
+        ss['method_opts']['quadrants'][0] = 1
+        self.assertEqual(self.dm.ssHash(s='s4', l=0), BASELINE[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.dirname(os.path.split(os.path.realpath(__file__))[0]))
+
+import numpy as np
+
+try:
+    from src.core.swimstore import SwimImageStore
+except ImportError as e:  # zarr, numcodecs
+    SwimImageStore = None
+
+try:
+    from src.models.data import DataModel
+except ImportError as e:  # zarr, qtpy, ...
+    DataModel = None
+
+
+@unittest.skipIf(SwimImageStore is None, 'zarr is not installed')
+class TestSwimImageStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'swim', 's4')
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_write_and_read_section(self):
+        store = SwimImageStore.create(self.path, 3, n_ingredients=2, signal_px=16, match_px=32)
+        sig = self.rng.integers(0, 256, (40, 40), dtype='uint8')
+        k, t = self.rng.random((64, 48)), self.rng.random((64, 48))
+        store.write_section(1, signals={(0, 2): sig, (1, 2): sig}, matches={(1, 2): (k, t)})
+        store = SwimImageStore(self.path, mode='r')
+        self.assertEqual(store.last_ingredient(1), 1)
+        self.assertIsNone(store.last_ingredient(0))
+        np.testing.assert_array_equal(store.signal(1, 1, 2), sig[12:28, 12:28])
+        self.assertIsNone(store.signal(1, 1, 0))
+        k_small, t_small = store.match(1, 1, 2)
+        self.assertEqual(k_small.shape, (32, 24))  # block-averaged by 2
+        self.assertEqual(t_small.shape, (32, 24))
+        self.assertIsNone(store.match(1, 0, 2))
+
+    def test_create_grows(self):
+        SwimImageStore.create(self.path, 2, n_ingredients=2, signal_px=16, match_px=32)
+        store = SwimImageStore.create(self.path, 5, n_ingredients=2, signal_px=16, match_px=32)
+        self.assertEqual(store.signals.shape[0], 5)
+        self.assertEqual(store.written.shape[0], 5)
+
+
+@unittest.skipIf(SwimImageStore is None or DataModel is None, 'DataModel dependencies are not installed')
+class TestDataModelSwimImages(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.dm = DataModel.__new__(DataModel)
+        self.dm._data = {'info': {'file_path': os.path.join(self.dir.name, 'project.align')}}
+        self.dm._swim_stores = {}
+        self.settings = {}  # section -> ssHash of its current swim settings
+        self.dm.ssHash = lambda s=None, l=None: self.settings.get(l, 1)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_no_store(self):
+        self.assertIsNone(self.dm.swim_signals(s='s4', l=0))
+        self.assertIsNone(self.dm.swim_matches(s='s4', l=0))
+
+    def test_last_ingredient_by_quadrant(self):
+        store = SwimImageStore.create(self.dm.path_swim_store(s='s4'), 2, n_ingredients=3, signal_px=16, match_px=32)
+        a = np.full((16, 16), 7, dtype='uint8')
+        b = np.full((16, 16), 9, dtype='uint8')
+        store.write_section(0, signals={(0, 0): a, (2, 1): b, (2, 3): b},
+                            matches={(2, 1): (np.zeros((20, 20)), np.ones((20, 20)))}, ss_hash=1)
+        signals = self.dm.swim_signals(s='s4', l=0)
+        self.assertEqual([x is None for x in signals], [True, False, True, False])
+        np.testing.assert_array_equal(signals[1], b)
+        matches = self.dm.swim_matches(s='s4', l=0)
+        self.assertEqual([x is None for x in matches], [True, False, True, True])
+        self.assertEqual(matches[1][0].shape, (20, 20))
+        # Nothing in the store for section 1: its images are looked up as files
+        self.assertIsNone(self.dm.swim_signals(s='s4', l=1))
+        # A store grown by a later alignment is reopened
+        store = SwimImageStore.create(self.dm.path_swim_store(s='s4'), 4, n_ingredients=3, signal_px=16, match_px=32)
+        os.utime(os.path.join(store.path, 'written', '.zarray'), ns=(0, 1))  # whatever the mtime resolution
+        store.write_section(3, signals={(0, 2): a}, ss_hash=1)
+        np.testing.assert_array_equal(self.dm.swim_signals(s='s4', l=3)[2], a)
+
+    def test_images_of_other_settings(self):
+        store = SwimImageStore.create(self.dm.path_swim_store(s='s4'), 2, n_ingredients=3, signal_px=16, match_px=32)
+        a = np.full((16, 16), 7, dtype='uint8')
+        b = np.full((16, 16), 9, dtype='uint8')
+        store.write_section(0, signals={(0, 0): a}, ss_hash=1)
+        # Settings changed: aligned again with them
+        self.settings[0] = 2
+        self.assertIsNone(self.dm.swim_signals(s='s4', l=0))
+        store.write_section(0, signals={(0, 0): b}, ss_hash=2)
+        np.testing.assert_array_equal(self.dm.swim_signals(s='s4', l=0)[0], b)
+        # Settings reverted (their results come from the cache): the images are not theirs
+        self.settings[0] = 1
+        self.assertIsNone(self.dm.swim_signals(s='s4', l=0))
+        self.assertIsNone(self.dm.swim_matches(s='s4', l=0))
+
+    def test_clear(self):
+        store = SwimImageStore.create(self.dm.path_swim_store(s='s4'), 2, n_ingredients=3, signal_px=16, match_px=32)
+        store.write_section(1, signals={(0, 0): np.ones((16, 16), dtype='uint8')}, ss_hash=1)
+        self.assertIsNotNone(self.dm.swim_signals(s='s4', l=1))
+        self.dm.clear_swim_images(1, s='s4')
+        self.assertIsNone(self.dm.swim_signals(s='s4', l=1))
+
+
+if __name__ == '__main__':
+    unittest.main()